@@ -0,0 +1,186 @@
+#!/bin/env python
+'''
+Live aggregator for casa_call events.
+
+Listen on a Unix domain (datagram) socket for the JSON events that
+casa_call.py sends when the environment variable CASA_BENCH_SOCKET names the
+socket, and keep per-task statistics across all benchmark runs on this host:
+number of calls, mean, minimum and maximum time, plus the runs and tasks in
+progress.  The statistics are rewritten to a JSON file every few seconds so
+that other tools (or a person with 'cat') can follow all jobs on a node while
+they run.
+
+    $ ./aggregator.py -s /tmp/casa_bench.sock -o casa_bench_stats.json &
+    $ export CASA_BENCH_SOCKET=/tmp/casa_bench.sock
+'''
+
+import os, os.path, time, json, socket
+from optparse import OptionParser
+
+# Largest event accepted
+max_event_size = 65536
+
+class TaskStats:
+    """ Running statistics of the calls to one task. """
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, delta):
+        self.calls += 1
+        self.total += delta
+        if self.min == None or delta < self.min:
+            self.min = delta
+        if self.max == None or delta > self.max:
+            self.max = delta
+
+    def to_dict(self):
+        mean = None
+        if self.calls > 0:
+            mean = self.total / self.calls
+        return {'calls': self.calls, 'total': self.total, 'mean': mean,
+                'min': self.min, 'max': self.max}
+
+class Aggregator:
+    """
+    Accumulate casa_call events.
+
+    * stale = seconds after which a run that sent no events is dropped from
+      the list of active runs
+    """
+    def __init__(self, stale=86400.0):
+        self.stale = stale
+        self.tasks = {}
+        self.runs = {}
+        self.events = 0
+        self.errors = []
+
+    def run(self, event):
+        """ Return the state kept for the run that sent *event*. """
+        run_id = event.get('run', 'unknown')
+        if run_id not in self.runs:
+            self.runs[run_id] = {'out_file': None, 'current': None,
+                                 'calls': 0, 'errors': 0}
+        state = self.runs[run_id]
+        state['last_seen'] = time.time()
+        return state
+
+    def add(self, event):
+        """ Account for one decoded *event*. """
+        self.events += 1
+        state = self.run(event)
+        kind = event.get('event')
+        if kind == 'run':
+            state['out_file'] = event.get('out_file')
+            state['host'] = event.get('host')
+            state['started'] = event.get('time')
+        elif kind == 'begin':
+            state['current'] = {'task': event.get('task'),
+                                'tag': event.get('tag'),
+                                'since': event.get('time')}
+        elif kind == 'end':
+            task = event.get('task')
+            if task not in self.tasks:
+                self.tasks[task] = TaskStats()
+            self.tasks[task].add( float(event.get('delta', 0.0)) )
+            state['calls'] += 1
+            state['current'] = None
+        elif kind == 'error':
+            state['errors'] += 1
+            state['current'] = None
+            self.errors.append(event)
+            self.errors = self.errors[-100:]
+
+    def expire(self, now=None):
+        """ Forget runs that have been silent longer than self.stale. """
+        if now == None:
+            now = time.time()
+        for run_id in self.runs.keys():
+            if now - self.runs[run_id]['last_seen'] > self.stale:
+                del self.runs[run_id]
+
+    def to_dict(self):
+        tasks = {}
+        for task in self.tasks:
+            tasks[task] = self.tasks[task].to_dict()
+        return {'time': time.time(), 'events': self.events, 'tasks': tasks,
+                'runs': self.runs, 'errors': self.errors}
+
+def write_stats(aggregator, fname):
+    """ Write the statistics of *aggregator* to *fname* atomically. """
+    tmp = fname + ".tmp"
+    f = open(tmp, "w")
+    json.dump(aggregator.to_dict(), f, indent=1, sort_keys=True)
+    f.close()
+    os.rename(tmp, fname)
+
+def listen(path):
+    """ Return a datagram socket bound to the Unix domain socket *path*. """
+    if os.path.exists(path):
+        os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    sock.settimeout(1.0)
+    return sock
+
+def serve(path, stats_file, interval=5.0, stale=86400.0, verbose=False):
+    """
+    Receive events on *path* until interrupted, writing the statistics to
+    *stats_file* every *interval* seconds.
+    """
+    aggregator = Aggregator(stale=stale)
+    sock = listen(path)
+    last_write = 0.0
+    try:
+        while True:
+            try:
+                data = sock.recv(max_event_size)
+            except socket.timeout:
+                data = None
+            if data:
+                try:
+                    event = json.loads(data)
+                except ValueError:
+                    event = None
+                if isinstance(event, dict):
+                    aggregator.add(event)
+                    if verbose:
+                        print data.strip()
+            now = time.time()
+            if now - last_write >= interval:
+                aggregator.expire(now)
+                write_stats(aggregator, stats_file)
+                last_write = now
+    except KeyboardInterrupt:
+        pass
+    finally:
+        write_stats(aggregator, stats_file)
+        sock.close()
+        os.remove(path)
+
+if __name__ == "__main__":
+    usage = """ %prog [options]
+
+    Collect casa_call events sent to a Unix domain socket and keep live
+    per-task statistics in a JSON file.  Benchmark scripts send events to the
+    socket named by the environment variable CASA_BENCH_SOCKET."""
+    parser = OptionParser( usage=usage )
+    parser.add_option( '-s', '--socket', default=None,
+        help="socket path (default: $CASA_BENCH_SOCKET or " + \
+             "/tmp/casa_bench.sock)" )
+    parser.add_option( '-o', '--output', default='casa_bench_stats.json',
+        help="statistics file" )
+    parser.add_option( '-i', '--interval', type="float", default=5.0,
+        help="seconds between updates of the statistics file" )
+    parser.add_option( '-x', '--expire', type="float", default=86400.0,
+        help="seconds after which a silent run is dropped" )
+    parser.add_option( '-v', '--verbose', action="store_true", default=False,
+        help="print events as they arrive" )
+    (options, args) = parser.parse_args()
+    path = options.socket
+    if path == None:
+        path = os.environ.get("CASA_BENCH_SOCKET", "/tmp/casa_bench.sock")
+    serve(path, options.output, interval=options.interval,
+          stale=options.expire, verbose=options.verbose)
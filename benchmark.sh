@@ -37,23 +37,47 @@ function casaGuidesTest ()
     # Extract script from CASA Guide:
     extractLog=`basename $extractScript`.log
     echo -e "Extracting CASA Guide.\nLogging to $extractLog"
-    $extractScript -b $CASAGuideURL >> $extractLog 2>> $extractLog
+    $extractScript -b $deferPlots $CASAGuideURL >> $extractLog 2>> $extractLog
     # Get name of output Python script (this is the newest python script in pwd)
     local scriptName=`\ls -1t *.py | head -n 1`
     # Set name for log file
     local logName="../$scriptName.log"
+    local sumName=${scriptName%.py}.benchmark.txt.summary
+    # A resumed test skips scripts that finished; their summary is in ../
+    if [ ! "$prepOnly" ] && [ "$CASA_BENCH_RESUME" ] && \
+        grep -q '^Statistics: .*"complete": true' $sumName 2> /dev/null
+    then
+        echo "Skipping $scriptName: its test already finished"
+        return
+    fi
     # Begin test
     execCommand="$env $time casapy -r $casapyVersion --nologger --nogui -c $scriptName >> $logName 2>> $logName"
     echo prepOnly = $prepOnly
-    if [ ! "$prepOnly" ]
+    if [ ! "$prepOnly" ] && [ "$cacheMode" -o "$maxRuns" ]
+    then
+        # Repeated runs; runner.py appends each run's summary to ../
+        echo -e "Beginning repeated benchmark test of $scriptName.\nLogging to ${logName##*/}"
+        date >> $logName
+        runner.py -m ${cacheMode:-none} -n ${maxRuns:-1} -a .. \
+            -c "$env $time casapy -r $casapyVersion --nologger --nogui -c" \
+            $scriptName >> $logName 2>> $logName
+        echo "Finished test of $scriptName"
+    elif [ ! "$prepOnly" ]
     then
         echo -e "Beginning benchmark test of $scriptName.\nLogging to ${logName##*/}"
         date >> $logName
         $execCommand
-        local sumName=`\ls -1t *.summary | head -n 1`
         echo -e "\n" >> ../$sumName; cat $sumName >> ../$sumName
         echo "Finished test of $scriptName"
-    else
+    fi
+    if [ ! "$prepOnly" ] && [ "$deferPlots" ]
+    then
+        # Make the plots the test queued, outside the timed run
+        echo -e "Making deferred plots of $scriptName.\nLogging to ${logName##*/}"
+        plotqueue.py -j 2 -c "$env casapy -r $casapyVersion --nologger --nogui -c" \
+            ${scriptName%.py}.benchmark.txt.plots >> $logName 2>> $logName
+    elif [ "$prepOnly" ]
+    then
         echo Manually start test with command:
         echo $execCommand
     fi
@@ -84,7 +108,10 @@ function extractionTest ()
         then
             echo -e "Acquiring data by HTTP.\nLogging to $outFile"
             date >> $outFile
-            $env $time wget -N -q --no-check-certificate $dataPath >> $outFile 2>> $outFile
+            # Segmented, resumable download; checked against dataMD5 if the
+            # parameter set gives it
+            $env $time download.py -j ${segments:-4} -C \
+                ${dataMD5:+-s md5:$dataMD5} $dataPath >> $outFile 2>> $outFile || exit 2
             tarball=`basename $dataPath`
         else
             echo "Data available by filesystem"
@@ -103,8 +130,13 @@ function extractionTest ()
 # Handle command line options
 useURL=
 useCWD=
+ioBench=
+cacheMode=
+deferPlots=
+segments=
+maxRuns=
 casapyVersion=4.1.0 # default casapy version
-while getopts 'udxhpr:' OPTION
+while getopts 'udxhpRkinDj:m:N:w:r:' OPTION
 do
     case $OPTION in
     u)  useURL=1 # Get data by HTTP; else filesystem
@@ -115,14 +147,42 @@ do
         ;;
     p)  prepOnly=1 # Prep the data for benchmark testing, but do not start test
         ;;
+    R)  export CASA_BENCH_RESUME=auto # Resume an interrupted test in CWD data
+        useCWD=1
+        ;;
+    k)  export CASA_BENCH_CHECKPOINT=1 # Snapshot data at checkpoints
+        ;;
+    i)  ioBench=1 # Measure the storage of the data directory before the test
+        ;;
+    n)  export CASA_BENCH_NOISEMON=5 # Sample system noise every 5 s
+        ;;
+    j)  segments="$OPTARG" # Download the data in this many segments
+        ;;
+    D)  deferPlots=--deferplots # Queue diagnostic plots; make them after the test
+        ;;
+    m)  cacheMode="$OPTARG" # Page cache mode: cold, warm or none
+        ;;
+    N)  maxRuns="$OPTARG" # Repeat each test until converged, at most N times
+        ;;
+    w)  export CASA_BENCH_WATCHDOG="$OPTARG" # Abort tasks hung past FACTOR x p99
+        ;;
     r)  casapyVersion="$OPTARG"
         ;;
-    ?|h)  printf "Usage: %s [-u] [-c] [-p] [-r version] CASAGuideName\n" $(basename $0) >&2
+    ?|h)  printf "Usage: %s [-u] [-c] [-p] [-R] [-k] [-i] [-n] [-m mode] [-N runs] [-w factor] [-r version] CASAGuideName\n" $(basename $0) >&2
         echo "  CASAGuideName = Name of CASA Guide from list below" >&2
         echo "  -u = get data by HTTP rather than filesystem" >&2
         echo "  -x = use extracted data; do not download; do not extract" >&2
         echo "  -d = do not download; use tarball in current directory" >&2
         echo "  -p = prepare the data only; do not run test" >&2
+        echo "  -R = resume an interrupted test from its last checkpoint; implies -x" >&2
+        echo "  -k = snapshot the data at checkpoints so a test can be resumed" >&2
+        echo "  -i = measure storage I/O of the data directory before the test" >&2
+        echo "  -n = monitor system noise and score the contamination of each run" >&2
+        echo "  -j SEGMENTS = download the data in SEGMENTS concurrent segments (default 4)" >&2
+        echo "  -D = make the diagnostic plots after the test rather than suppressing them" >&2
+        echo "  -m MODE = evict (cold) or pre-read (warm) the data before each run" >&2
+        echo "  -N RUNS = repeat each test until task times converge, at most RUNS times" >&2
+        echo "  -w FACTOR = abort a test when a task exceeds FACTOR times its usual p99 time" >&2
         echo "  -r VERSION = use specific casapy VERSION" >&2
         echo "  -h = print usage instructions and exit" >&2
         echo "" >&2
@@ -176,6 +236,13 @@ fi
 dir=`basename $dataPath .tgz`
 cd $dir
 
+# Characterize the storage the test runs on; summaries include the result
+if [ "$ioBench" ]
+then
+    echo -e "Measuring storage I/O.\nLogging to ../iobench.log"
+    iobench.py . >> ../iobench.log 2>> ../iobench.log
+fi
+
 # Extract and run casa guides tests
 for URL in $calibrationURL $imagingURL
 do
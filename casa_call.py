@@ -1,6 +1,77 @@
-import time, os
-from readcol import readcol
-import numpy as np
+'''
+Recording core of the benchmark scripts.
+
+Benchmark scripts written by 'extractCASAscript.py -b' import this module in
+casapy before any timing starts, so it imports only the standard library and
+the standard-library-only modules runarchive and streamstats.  noisemon is
+imported when the noise monitor or the watchdog needs it.  Summaries are
+made by casa_summary, which is imported (with hostinfo, iobench and
+openmetrics) only when a summary is written.
+'''
+
+import time, os, sys, glob, gzip, shutil, json, socket, atexit
+import math, signal, threading, traceback
+import runarchive, streamstats
+
+# Progress tracker of the run in progress; set by start_run()
+_progress = None
+
+# Task numbers up to and including _resume_point were completed by an earlier,
+# interrupted run and are skipped; set by start_run()
+_resume_point = 0
+
+# Directory holding data set snapshots, or None if checkpointing is off
+_checkpoint_dir = None
+_out_file = None
+
+# Identifier of this run in events; set by start_run()
+_run_id = None
+
+# Unix domain socket events are also sent to, or None; see start_run()
+_socket = None
+_socket_path = None
+
+# The call running now, if any
+_current = None
+
+# Background noise monitor process, if any; see start_noise_monitor()
+_noise_monitor = None
+
+# Process that called start_run().  Events of any other process (forked
+# helpers, MPI ranks other than 0) go to a record file of its own; see
+# record_file()
+_owner_pid = None
+
+# Process whose 'process' event was written last
+_announced_pid = None
+
+# Watchdog aborting hung task calls, if enabled; see start_run()
+_watchdog = None
+
+# Statistics of the calls logged by this process (a streamstats.RunStats),
+# the 'timeout' events of the run, and the interval (seconds; None if off)
+# and time of the last checkpoint of the summary; see checkpoint_summary()
+_stats = None
+_timeouts = []
+_summary_interval = None
+_summary_time = 0.0
+_summary_info = None
+
+# Seconds MPI ranks other than 0 wait for rank 0 to prepare the run, and the
+# clock difference between hosts allowed for; see wait_for_main()
+main_wait = 600.0
+clock_slack = 60.0
+
+# Exit status of a run aborted by the watchdog (as timeout(1))
+timeout_status = 124
+
+# Arguments of plot tasks naming the table plotted (besides the first
+# positional argument); see defer_plot()
+plot_table_args = ['vis', 'caltable']
+
+# Environment variables holding the MPI rank, in order of preference
+rank_variables = ["OMPI_COMM_WORLD_RANK", "PMI_RANK", "PMIX_RANK",
+                  "MV2_COMM_WORLD_RANK", "SLURM_PROCID"]
 
 class Call:
     """
@@ -18,94 +89,1065 @@ class Call:
             self.begin()
 
     def begin(self, user_time=None):
+        global _current
         if user_time == None:
             self._start = time.time()
         else:
             self._start=user_time
         self._status = "RUNNING"
+        if _run_id != None and user_time == None:
+            _current = self
+            emit( {'event': 'begin', 'task': self._task, 'tag': self._tag,
+                   'time': self._start}, _out_file )
+        if _progress != None:
+            _progress.begin(self)
+        if _watchdog != None and user_time == None:
+            _watchdog.arm(self)
+        if user_time == None:
+            # Taken again after the events, status file and watchdog above,
+            # so that their cost is not counted in the time of the call
+            self._start = time.time()
         
     def end(self, out_file=None, user_time=None):
+        global _current
+        # Taken before any bookkeeping, for the same reason as in begin()
         if user_time == None:
             self._stop = time.time()
         else: 
             self._stop = user_time
         self._delta = self._stop - self._start
         self._status = "DONE"
+        if _current is self:
+            _current = None
+        if _watchdog != None:
+            _watchdog.disarm(self)
         if out_file != None:
             self.to_file(fname=out_file)
+            if _stats != None and out_file == _out_file and \
+               record_file(out_file) == out_file:
+                _stats.add(self._task, self._start, self._stop, self._delta)
+                checkpoint_summary()
+        if _progress != None:
+            _progress.end(self)
+
+    def to_event(self):
+        """ Return the 'end' event of a finished call. """
+        return {'event': 'end', 'task': self._task, 'tag': self._tag,
+                'delta': self._delta, 'start': self._start,
+                'stop': self._stop}
 
     def to_string(self):
         if self._status != "DONE":
             return "Not finished."
-        line = ""
-        line += self._task+" "
-        line += self._tag+" "
-        line += str(self._delta)+" "
-        line += str(self._start)+" "
-        line += str(self._stop)+"\n"
-        return line
+        return event_string( self.to_event() )
 
     def to_file(self,fname="bench.txt"):
-        out_file = open(fname,"a")
-        out_file.writelines(self.to_string())
-        out_file.close()
+        emit( self.to_event(), fname )
 
-def summarize_bench(in_file=None,out_file=None):
+def event_string(event):
+    """ Return *event* (a dictionary) as one line of JSON. """
+    if _run_id != None and 'run' not in event:
+        event['run'] = _run_id
+    return json.dumps(event, sort_keys=True) + "\n"
+
+def mpi_rank():
+    """ Return the MPI rank of this process, or None outside MPI. """
+    for name in rank_variables:
+        value = os.environ.get(name, "")
+        if value.isdigit():
+            return int(value)
+    return None
+
+def part_file(fname, host=None, rank=None, pid=None):
+    """
+    Return the record file of a process (default this one) writing to
+    benchmarking file *fname*.
+    """
+    if host == None:
+        host = socket.gethostname()
+    if pid == None:
+        pid = os.getpid()
+        rank = mpi_rank()
+    return fname + ".part." + host + "." + str(rank or 0) + "." + str(pid)
+
+def record_file(fname):
+    """
+    Return the file this process appends the events for benchmarking file
+    *fname* to: *fname* itself in the process that started the run, a part
+    file (see part_file) in any other.
+    """
+    if _owner_pid == None or (os.getpid() == _owner_pid and not mpi_rank()):
+        return fname
+    return part_file(fname)
+
+def append_line(fname, line):
+    """
+    Append *line* to *fname* with a single write to a file opened for
+    appending, so that lines of concurrent writers do not interleave.
+    """
+    fd = os.open(fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+def clock_offset(fname):
+    """
+    Return the offset of this host's clock from the clock of the file system
+    holding *fname*, measured from the modification time of a probe file, or
+    None if it cannot be measured.  Offsets of two hosts writing to the same
+    file system give the offset between their clocks.
+    """
+    probe = fname + ".clock." + socket.gethostname() + "." + str(os.getpid())
+    try:
+        before = time.time()
+        fd = os.open(probe, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        os.write(fd, "x")
+        os.close(fd)
+        after = time.time()
+        mtime = os.stat(probe).st_mtime
+        os.remove(probe)
+    except OSError:
+        return None
+    return (before + after) / 2.0 - mtime
+
+def announce(fname):
+    """
+    Write the 'process' event identifying this process (host, pid, MPI rank
+    and clock offset) to its record file for benchmarking file *fname*.
+    """
+    global _announced_pid
+    _announced_pid = os.getpid()
+    event = {'event': 'process', 'time': time.time(),
+             'host': socket.gethostname(), 'pid': os.getpid(),
+             'ppid': os.getppid(), 'rank': mpi_rank(),
+             'fs_offset': clock_offset(fname)}
+    append_line(record_file(fname), event_string(event))
+
+def emit(event, fname=None):
+    """
+    Append *event* to the record file of this process for benchmarking file
+    *fname* and send it to the event socket, if any.
+    """
+    line = event_string(event)
+    if fname != None:
+        if _owner_pid != None and _announced_pid != os.getpid():
+            announce(fname)
+        append_line(record_file(fname), line)
+    if _socket != None:
+        try:
+            _socket.sendto(line, _socket_path)
+        except socket.error:
+            # Nobody is listening; events still go to the file
+            pass
+
+def read_events(in_file):
+    """
+    Read a benchmarking file. Return the list of events, one dictionary per
+    line.  Lines in the space separated format written by earlier versions
+    of this module are returned as 'end' events.
+    """
+    events = []
+    if in_file.endswith(".gz"):
+        f = gzip.open(in_file)
+    else:
+        f = open(in_file)
+    for line in f:
+        if line.startswith("{"):
+            try:
+                events.append( json.loads(line) )
+            except ValueError:
+                # Truncated by a crash
+                pass
+            continue
+        fields = line.split()
+        if len(fields) != 5:
+            continue
+        events.append( {'event': 'end', 'task': fields[0], 'tag': fields[1],
+                        'delta': float(fields[2]), 'start': float(fields[3]),
+                        'stop': float(fields[4])} )
+    f.close()
+    return events
+
+def read_bench(in_file):
+    """
+    Read a benchmarking file. Return a list of records, one dictionary per
+    logged call with keys task, tag, delta, start and stop.
+    """
+    records = []
+    for event in read_events(in_file):
+        if event.get('event') != 'end':
+            continue
+        records.append( {'task': event['task'], 'tag': event['tag'],
+                         'delta': event['delta'], 'start': event['start'],
+                         'stop': event['stop']} )
+    return records
+
+def run_files(out_file, kind):
+    """ Return the files out_file+'.'+kind+'.*' of a run, sorted. """
+    prefix = os.path.basename(out_file) + "." + kind + "."
+    names = [fname for fname in os.listdir(os.path.dirname(out_file) or ".")
+             if fname.startswith(prefix)]
+    return [os.path.join(os.path.dirname(out_file), fname)
+            for fname in sorted(names)]
+
+def record_files(out_file):
+    """ Return the record files of all processes of a run. """
+    files = []
+    if os.path.exists(out_file):
+        files.append(out_file)
+    return files + run_files(out_file, "part")
+
+def read_merged(out_file):
+    """
+    Read the record files of all processes of a run. Return the records of
+    read_bench, each with an additional key 'process' (host:rank:pid).
+    Times of processes on other hosts are shifted to the clock of the main
+    process using the file system clock offsets of their 'process' events.
+    """
+    merged = []
+    reference = {}
+    for fname in record_files(out_file):
+        events = read_events(fname)
+        info = {}
+        for event in events:
+            if event.get('event') == 'process':
+                info = event
+                break
+        if fname == out_file:
+            reference = info
+        shift = 0.0
+        if info.get('host') != reference.get('host') and \
+           info.get('fs_offset') != None and \
+           reference.get('fs_offset') != None:
+            shift = info['fs_offset'] - reference['fs_offset']
+        label = str(info.get('host')) + ":" + str(info.get('rank') or 0) + \
+            ":" + str(info.get('pid'))
+        for event in events:
+            if event.get('event') != 'end':
+                continue
+            merged.append( {'task': event['task'], 'tag': event['tag'],
+                            'delta': event['delta'],
+                            'start': event['start'] - shift,
+                            'stop': event['stop'] - shift,
+                            'process': label} )
+    return merged
+
+def rotate_bench(out_file):
+    """
+    Move the files of the previous run logged in *out_file* to its run
+    archive (see runarchive.py).  Only the main process (MPI rank 0) does
+    this, so that ranks starting the same script do not race.
+    """
+    if mpi_rank():
+        return
+    runarchive.archive_run(out_file, record_files(out_file) +
+                           run_files(out_file, "hang"))
+
+def read_expected(exp_file):
+    """
+    Read the expected flow written by extractCASAscript.py. Return a list of
+    (task, tasknum) tuples in script order.
+    """
+    flow = []
+    f = open(exp_file)
+    for line in f:
+        fields = line.split()
+        if len(fields) != 2:
+            continue
+        flow.append( (fields[0], int(fields[1])) )
+    f.close()
+    return flow
+
+class Progress:
+    """
+    Track the progress of a benchmark run against its expected flow.
+
+    The completed and total number of tasks, the task currently running and
+    an estimate of the time remaining are written to *status_file* (and to
+    stderr if *verbose*) whenever a call begins or ends.  Task numbers that
+    are skipped or logged out of order are reported as they happen.
+
+    * expected = list of (task, tasknum) tuples, see read_expected()
+    * history = list of records from earlier runs, see read_bench()
+    * status_file = file rewritten with the current status
+    * verbose = if true, also write a status line to stderr
+    """
+    def __init__(self, expected, history=[], status_file=None, verbose=True):
+        self._expected = expected
+        self._order = [num for task, num in expected]
+        self._tasks = dict( [(num, task) for task, num in expected] )
+        self._status_file = status_file
+        self._verbose = verbose
+        self._start = time.time()
+        self._done = set()
+        self._flagged = set()
+        self._last = 0
+        self._current = None
+        self._warnings = []
+        self._observed = []
+        # Historical mean duration per task number and per task name
+        by_tag = {}
+        by_task = {}
+        for rec in history:
+            by_tag.setdefault( (rec['task'], rec['tag']), [] ).append(rec['delta'])
+            by_task.setdefault( rec['task'], [] ).append(rec['delta'])
+        self._hist_tag = {}
+        for key, deltas in by_tag.items():
+            self._hist_tag[key] = sum(deltas) / len(deltas)
+        self._hist_task = {}
+        for key, deltas in by_task.items():
+            self._hist_task[key] = sum(deltas) / len(deltas)
+
+    def expected_time(self, num):
+        """ Return the expected duration of task number *num*. """
+        task = self._tasks[num]
+        key = (task, str(num))
+        if key in self._hist_tag:
+            return self._hist_tag[key]
+        if task in self._hist_task:
+            return self._hist_task[task]
+        if self._observed:
+            return sum(self._observed) / len(self._observed)
+        return 0.0
+
+    def eta(self):
+        """ Return the estimated number of seconds until the run finishes. """
+        remaining = 0.0
+        for num in self._order:
+            if num not in self._done:
+                remaining += self.expected_time(num)
+        if self._current != None and self._current[1] in self._tasks:
+            elapsed = time.time() - self._current[2]
+            remaining -= min( elapsed, self.expected_time(self._current[1]) )
+        return remaining
+
+    def warn(self, message):
+        self._warnings.append(message)
+        print >>sys.stderr, "casa_call: WARNING: " + message
+
+    def begin(self, call):
+        try:
+            num = int(call._tag)
+        except ValueError:
+            num = None
+        if num == None or num not in self._tasks:
+            self.warn( "task not in expected flow: " + call._task + " " + \
+                str(call._tag) )
+        elif num not in self._done and num < self._last:
+            self.warn( "task out of order: " + call._task + " " + str(num) )
+        elif num > self._last:
+            for skipped in self._order:
+                if self._last < skipped < num and skipped not in self._done \
+                        and skipped not in self._flagged:
+                    self._flagged.add(skipped)
+                    self.warn( "task skipped: " + self._tasks[skipped] + \
+                        " " + str(skipped) )
+            self._last = num
+        self._current = (call._task, num, call._start)
+        self.report()
+
+    def resume(self, num, records=[]):
+        """
+        Mark the expected task numbers up to *num* as completed by an earlier
+        run whose logged calls are *records*.
+        """
+        for done in self._order:
+            if done <= num:
+                self._done.add(done)
+        self._last = max(self._last, num)
+        for rec in records:
+            self._observed.append(rec['delta'])
+
+    def end(self, call):
+        try:
+            self._done.add( int(call._tag) )
+        except ValueError:
+            pass
+        self._observed.append(call._delta)
+        self._current = None
+        self.report()
+
+    def status_lines(self):
+        """ Return the current status as a list of 'key: value' lines. """
+        ndone = len( self._done.intersection(self._order) )
+        lines = []
+        lines.append( "completed: " + str(ndone) + "/" + \
+            str(len(self._order)) + "\n" )
+        if self._current != None:
+            lines.append( "current: " + self._current[0] + " " + \
+                str(self._current[1]) + "\n" )
+        else:
+            lines.append( "current: none\n" )
+        lines.append( "elapsed: %.1f\n" % (time.time() - self._start) )
+        lines.append( "eta: %.1f\n" % self.eta() )
+        for message in self._warnings:
+            lines.append( "warning: " + message + "\n" )
+        return lines
+
+    def report(self):
+        lines = self.status_lines()
+        if self._status_file != None:
+            tmp_file = self._status_file + ".tmp"
+            f = open(tmp_file, "w")
+            f.writelines(lines)
+            f.close()
+            os.rename(tmp_file, self._status_file)
+        if self._verbose:
+            eta = int( self.eta() )
+            line = "casa_call: " + lines[0].split()[1] + " tasks, " + \
+                lines[1].strip() + ", ETA %d:%02d:%02d" % \
+                (eta / 3600, (eta / 60) % 60, eta % 60)
+            print >>sys.stderr, line
+
+def read_history(out_file, max_runs=10, host=None):
+    """
+    Return the records of the last *max_runs* earlier runs of *out_file* in
+    its run archive, and of any out_file.1, out_file.2, ... kept by older
+    versions of the benchmark script header.  If *host* is given, archived
+    runs of other hosts are left out.
+    """
+    records = []
+    runs = runarchive.list_runs(out_file)
+    if host != None:
+        runs = [entry for entry in runs if entry['host'] == host]
+    for entry in runs[-max_runs:]:
+        fname = runarchive.run_file(out_file, entry)
+        if fname != None:
+            records += read_bench(fname)
+    for fname in glob.glob(out_file + ".*"):
+        if not fname[len(out_file)+1:].isdigit():
+            continue
+        records += read_bench(fname)
+    return records
+
+def percentile(values, fraction):
+    """ Return the nearest-rank *fraction* percentile of *values*. """
+    values = sorted(values)
+    rank = int(math.ceil(fraction * len(values)))
+    return values[max(rank, 1) - 1]
+
+def task_limits(records, factor, floor=0.0):
+    """
+    Return a dictionary task -> time limit: *factor* times the 99th
+    percentile of the call times of the task in *records*, at least *floor*
+    seconds.
+    """
+    times = {}
+    for rec in records:
+        times.setdefault(rec['task'], []).append(rec['delta'])
+    limits = {}
+    for task in times:
+        limits[task] = max(factor * percentile(times[task], 0.99), floor)
+    return limits
+
+def read_proc_file(path):
+    """ Return the contents of a /proc file, or a note why it is missing. """
+    try:
+        f = open(path)
+        text = f.read()
+        f.close()
+    except (IOError, OSError), e:
+        return "(" + str(e) + ")\n"
+    return text.replace("\0", " ").rstrip("\n") + "\n"
+
+def dump_state(fname, call, elapsed, limit):
+    """
+    Write the Python stacks of all threads and the /proc state (status,
+    wait channel, kernel stack, command line and open files) of this
+    process and its descendants to *fname*.
     """
-    Read and summarize a benchmarking file.
+    import noisemon
+    lines = ["Task " + call._task + " " + call._tag + " ran for " +
+             str(elapsed) + " s; limit " + str(limit) + " s\n"]
+    for thread_id, frame in sys._current_frames().items():
+        lines.append("\nPython stack of thread " + str(thread_id) + ":\n")
+        lines += traceback.format_stack(frame)
+    pids = sorted( noisemon.descendants(noisemon.process_times(),
+                                        [os.getpid()]) )
+    for pid in pids:
+        proc = "/proc/" + str(pid)
+        lines.append("\nProcess " + str(pid) + "\n")
+        for name in ["cmdline", "status", "wchan", "stack"]:
+            lines.append("--- " + name + "\n")
+            lines.append( read_proc_file(proc + "/" + name) )
+        lines.append("--- open files\n")
+        try:
+            for fd in sorted(os.listdir(proc + "/fd"), key=int):
+                try:
+                    lines.append(fd + " " + os.readlink(proc + "/fd/" + fd) +
+                                 "\n")
+                except OSError:
+                    pass
+        except OSError, e:
+            lines.append("(" + str(e) + ")\n")
+    f = open(fname, "w")
+    f.writelines(lines)
+    f.close()
+
+def kill_descendants():
+    """ Send SIGTERM to all descendants of this process. """
+    import noisemon
+    pids = noisemon.descendants(noisemon.process_times(), [os.getpid()])
+    for pid in pids:
+        if pid == os.getpid():
+            continue
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+class Watchdog:
+    """
+    Abort the run when a task call exceeds its time limit.
+
+    * limits = dictionary task -> seconds; tasks without a limit are not
+      watched
+    * out_file = benchmarking file of the run
+    * interval = seconds between checks
+
+    On a timeout the stacks and /proc state are written to
+    out_file+'.hang.<tag>', a 'timeout' event is logged, child processes are
+    terminated, the run is summarized and the process exits with status
+    timeout_status, so that a cycle of benchmark runs moves on.
+    """
+    def __init__(self, limits, out_file, interval=1.0):
+        self.limits = limits
+        self.out_file = out_file
+        self.interval = interval
+        self.call = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.watch)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Stop watching and wait for the thread to end. """
+        self.stopped.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def arm(self, call):
+        if call._task in self.limits:
+            self.lock.acquire()
+            self.call = call
+            self.lock.release()
+
+    def disarm(self, call):
+        self.lock.acquire()
+        if self.call is call:
+            self.call = None
+        self.lock.release()
+
+    def watch(self):
+        while not self.stopped.wait(self.interval):
+            self.lock.acquire()
+            call = self.call
+            self.lock.release()
+            if call == None:
+                continue
+            elapsed = time.time() - call._start
+            limit = self.limits.get(call._task)
+            if limit != None and elapsed > limit:
+                self.fire(call, elapsed, limit)
+
+    def fire(self, call, elapsed, limit):
+        hang_file = self.out_file + ".hang." + call._tag
+        dump_state(hang_file, call, elapsed, limit)
+        event = {'event': 'timeout', 'task': call._task, 'tag': call._tag,
+                 'time': time.time(), 'elapsed': elapsed, 'limit': limit,
+                 'dump': hang_file}
+        emit(event, self.out_file)
+        _timeouts.append(event)
+        print >>sys.stderr, "casa_call: " + call._task + " " + call._tag + \
+            " exceeded its limit of %.1f s; aborting the run" % limit
+        kill_descendants()
+        try:
+            finish_run(self.out_file, self.out_file + ".summary")
+        finally:
+            os._exit(timeout_status)
+
+def wait_for_main(out_file, since, timeout=None, poll=0.5):
+    """
+    Wait until the main process (MPI rank 0) has prepared the run logging to
+    *out_file*, i.e. has logged a 'run' event started at or after *since*
+    (less clock_slack). Return the event, or None after *timeout* seconds
+    (default main_wait).
+    """
+    if timeout == None:
+        timeout = main_wait
+    stop = time.time() + timeout
+    while True:
+        if os.path.exists(out_file):
+            for event in read_events(out_file):
+                if event.get('event') == 'run' and \
+                   event.get('time', 0) >= since - clock_slack:
+                    return event
+        if time.time() > stop:
+            print >>sys.stderr, "casa_call: WARNING: rank 0 did not " + \
+                "start the run in " + str(timeout) + " s; going on"
+            return None
+        time.sleep(poll)
+
+def resume_requested():
+    """
+    Tests if this run should resume an interrupted one. Set the environment
+    variable CASA_BENCH_RESUME to 'auto' (resume after the last checkpoint)
+    or to a task number.
+    """
+    return os.environ.get("CASA_BENCH_RESUME", "") != ""
+
+def todo(tasknum):
+    """
+    Tests if task number *tasknum* still has to run, i.e. was not completed
+    by the interrupted run being resumed.
+    """
+    return int(tasknum) > _resume_point
+
+def is_run_file(name, out_file):
     """
-    if in_file == None:
+    Tests if *name* in the data set directory belongs to the benchmarking
+    machinery (scripts, logs, benchmark files) rather than to the data.
+    """
+    if name.startswith( os.path.basename(out_file) ):
+        return True
+    for ext in [".py", ".pyc", ".expected", ".log", ".last", ".summary"]:
+        if name.endswith(ext):
+            return True
+    return False
+
+def copy_data(src, dst, out_file):
+    """ Copy the data set files in directory *src* to directory *dst*. """
+    for name in os.listdir(src):
+        if is_run_file(name, out_file):
+            continue
+        path = os.path.join(src, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.copytree( path, os.path.join(dst, name), symlinks=True )
+        else:
+            shutil.copy2( path, os.path.join(dst, name) )
+
+def checkpoint(tasknum):
+    """
+    Snapshot the data set after task number *tasknum* so that an interrupted
+    run can be resumed from here.  Does nothing unless checkpointing was
+    enabled by start_run().  Only the latest snapshot is kept, and only the
+    main process (MPI rank 0) takes it.
+    """
+    if _checkpoint_dir == None or not todo(tasknum) or mpi_rank():
         return
-    task, tag, delta, start, stop = readcol(in_file,twod=False)
-
-    dummy = os.popen("date")
-    date_stamp = dummy.readlines()
-    dummy = os.popen("uname -a")
-    uname_stamp = dummy.readlines()
-    dummy = os.popen("pwd")
-    pwd_stamp = dummy.readline()
-
-    lines = []
-    lines.append("Summary of file "+in_file+"\n")
-    lines.append(date_stamp[0]+"\n")
-    lines.append(uname_stamp[0]+"\n")
-    lines.append(pwd_stamp+"\n")
-    lines.append("\n")
-    total_time = np.max(stop) - np.min(start)
-    total_time_hr = total_time / 3600.0
-    lines.append("Total time: "+str(total_time)+" ("+str(total_time_hr)+" hr)\n")
-    time_logged = np.sum(delta)
-    lines.append("Time inside logged tasks: "+str(time_logged)+"\n")
-    lines.append("Time outside logged tasks: "+str(total_time-time_logged)+"\n")
-    lines.append("Total logged calls: "+str(len(task))+"\n")
-    lines.append("Average time per call: "+str(np.mean(delta))+"\n")
-
-    lines.append("\n")
-
-    tasks_called = np.unique(task)
-    n_calls = {}
-    t_per_call = {}
-    tot_t = {}
-
-    for this_task in tasks_called:
-        t_per_call[this_task] = np.mean(delta[task == this_task])
-        tot_t[this_task] = np.sum(delta[task == this_task])
-        n_calls[this_task] = np.sum(task == this_task)
-
-    tot_t_vec = np.zeros_like(tasks_called)
-    for i in range(len(tasks_called)):
-        tot_t_vec[i] = tot_t[tasks_called[i]]
-    order = np.argsort(tot_t_vec)
-    tasks_called = tasks_called[order]
-
-    for this_task in tasks_called:
-        lines.append(this_task+" "+str(n_calls[this_task])+ \
-                         " "+str(t_per_call[this_task])+ \
-                         " "+str(tot_t[this_task])+"\n")
-    if out_file == None:
-        for line in lines:
-            print line
+    name = os.path.join( _checkpoint_dir, str(tasknum) )
+    if not os.path.exists(_checkpoint_dir):
+        os.mkdir(_checkpoint_dir)
+    shutil.rmtree(name + ".tmp", ignore_errors=True)
+    os.mkdir(name + ".tmp")
+    copy_data( ".", name + ".tmp", _out_file )
+    os.rename(name + ".tmp", name)
+    for old in os.listdir(_checkpoint_dir):
+        if old.isdigit() and int(old) != int(tasknum):
+            shutil.rmtree( os.path.join(_checkpoint_dir, old) )
+
+def last_checkpoint(checkpoint_dir):
+    """ Return the task number of the newest snapshot, or 0 if none. """
+    if not os.path.isdir(checkpoint_dir):
+        return 0
+    nums = [int(name) for name in os.listdir(checkpoint_dir) if name.isdigit()]
+    if not nums:
+        return 0
+    return max(nums)
+
+def restore_checkpoint(checkpoint_dir, tasknum, out_file):
+    """
+    Replace the data set in the current directory with the snapshot taken
+    after task number *tasknum*.
+    """
+    for name in os.listdir("."):
+        if is_run_file(name, out_file):
+            continue
+        if os.path.isdir(name) and not os.path.islink(name):
+            shutil.rmtree(name)
+        else:
+            os.remove(name)
+    copy_data( os.path.join(checkpoint_dir, str(tasknum)), ".", out_file )
+
+def resume_run(out_file, resume, expected, prepare=True):
+    """
+    Prepare to resume an interrupted run. Return the task number after which
+    to continue and the records of the interrupted run that are kept.
+
+    With *resume* = 'auto', continue after the newest checkpoint, restoring
+    its snapshot, or after the last task if the interrupted run had in fact
+    finished.  Otherwise *resume* is the task number to continue after and
+    the data set is used as is.
+
+    Records of tasks after the resume point are dropped, since those tasks
+    run again.  The kept records are shifted in time so that they end when
+    the resumed run begins; the summary then covers one contiguous run.
+
+    If *prepare* is false the resume point is only determined: the snapshot
+    is not restored and *out_file* is not rewritten.  The MPI ranks other
+    than 0 do this after rank 0 has prepared the run.
+    """
+    records = []
+    if os.path.exists(out_file):
+        records = read_bench(out_file)
+    logged = set([rec['tag'] for rec in records])
+    nums = [num for task, num in expected]
+    checkpoint_dir = out_file + ".checkpoint"
+    if resume != "auto":
+        point = int(resume)
+    elif nums and set([str(num) for num in nums]).issubset(logged):
+        point = max(nums)
     else:
-        f = open(out_file,"w")
-        f.writelines(lines)
+        point = last_checkpoint(checkpoint_dir)
+        if point > 0 and prepare:
+            print >>sys.stderr, "casa_call: restoring snapshot after task " + \
+                str(point)
+            restore_checkpoint(checkpoint_dir, point, out_file)
+        elif records and prepare:
+            print >>sys.stderr, "casa_call: WARNING: no checkpoint to " + \
+                "resume from; running all tasks on the data set as is"
+    kept = [rec for rec in records if int(rec['tag']) <= point]
+    if kept:
+        shift = time.time() - max([rec['stop'] for rec in kept])
+        for rec in kept:
+            rec['start'] += shift
+            rec['stop'] += shift
+    if not prepare:
+        return point, kept
+    f = open(out_file + ".tmp", "w")
+    for rec in kept:
+        this_call = Call(rec['task'], rec['tag'], begin=False)
+        this_call._start = rec['start']
+        this_call._stop = rec['stop']
+        this_call._delta = rec['delta']
+        this_call._status = "DONE"
+        f.write( this_call.to_string() )
+    f.close()
+    os.rename(out_file + ".tmp", out_file)
+    return point, kept
+
+def plot_queue(out_file):
+    """ Return the deferred plot queue of benchmarking file *out_file*. """
+    return out_file + ".plots"
+
+def snapshot_tables(args, kwargs, dest):
+    """
+    Copy the tables named by the table arguments (see plot_table_args) of a
+    plot call to directory *dest* and point the arguments at the copies.
+    Return the number of tables copied.
+    """
+    copied = []
+    def copy(path):
+        if not isinstance(path, basestring) or not os.path.exists(path):
+            return path
+        if not os.path.isdir(dest):
+            os.makedirs(dest)
+        target = os.path.join(dest, os.path.basename(path.rstrip("/")))
+        if os.path.isdir(path):
+            shutil.copytree(path, target, symlinks=True)
+        else:
+            shutil.copy2(path, target)
+        copied.append(path)
+        return os.path.abspath(target)
+    if args:
+        args[0] = copy(args[0])
+    for name in plot_table_args:
+        if name in kwargs:
+            kwargs[name] = copy(kwargs[name])
+    return len(copied)
+
+def plot_value(value):
+    """
+    Return argument value *value* of a plot call in a form JSON holds.
+    Arrays (anything with a tolist method, e.g. numpy arrays) become
+    {'__ndarray__': list, 'dtype': type name}, which plotqueue.py turns back
+    into numpy arrays; array scalars become plain numbers.  Raise TypeError
+    for values that cannot be stored.
+    """
+    if value is None or isinstance(value, (bool, int, long, float,
+                                           basestring)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [plot_value(item) for item in value]
+    if isinstance(value, dict):
+        return dict([(str(k), plot_value(v)) for k, v in value.items()])
+    if hasattr(value, "tolist"):
+        items = value.tolist()
+        if not isinstance(items, list):
+            return plot_value(items)
+        return {'__ndarray__': plot_value(items),
+                'dtype': str(getattr(value, "dtype", ""))}
+    raise TypeError("cannot queue a plot argument of type " +
+                    type(value).__name__)
+
+def defer_plot(task, tag, *args, **kwargs):
+    """
+    Queue a call of diagnostic plot task *task* with the given arguments
+    instead of making it.  The call is appended as a JSON line to the plot
+    queue (see plot_queue) and made after the run, outside the timed calls
+    and without holding locks on the tables the run uses, by plotqueue.py.
+
+    *tag* is the number of the task the call comes before.  A call already
+    in the queue with the same tag and arguments, e.g. queued by the run a
+    resumed run continues, is not queued again.  Calls with arguments that
+    JSON cannot hold (see plot_value) are not queued; a warning is printed.
+
+    With the environment variable CASA_BENCH_PLOTSNAPSHOT set, the plotted
+    tables are first copied to <benchmark file>.plotdata/<n>/, so that
+    plotqueue.py -f can make the plots while the run goes on.  The copying
+    counts as time outside logged tasks.
+    """
+    fname = plot_queue(_out_file or "bench.txt")
+    try:
+        args = plot_value(list(args))
+        kwargs = plot_value(kwargs)
+    except TypeError, e:
+        print >>sys.stderr, "casa_call: WARNING: " + task + " " + \
+            str(tag) + " not queued: " + str(e)
+        return
+    key = json.dumps([str(tag), task, args, kwargs], sort_keys=True)
+    seq = 1
+    if os.path.exists(fname):
+        f = open(fname)
+        for line in f:
+            seq += 1
+            try:
+                if json.loads(line).get('key') == key:
+                    f.close()
+                    return
+            except ValueError:
+                pass
         f.close()
+    snapshot = False
+    if os.environ.get("CASA_BENCH_PLOTSNAPSHOT", "") != "":
+        snapshot = snapshot_tables(args, kwargs, os.path.join(
+            (_out_file or "bench.txt") + ".plotdata", str(seq))) > 0
+    entry = {'seq': seq, 'task': task, 'tag': str(tag), 'key': key,
+             'args': args, 'kwargs': kwargs, 'cwd': os.getcwd(),
+             'time': time.time(), 'snapshot': snapshot}
+    append_line(fname, json.dumps(entry, sort_keys=True) + "\n")
+
+def report_error(message):
+    """ Log an 'error' event for the call running now. """
+    event = {'event': 'error', 'time': time.time(), 'message': message}
+    if _current != None:
+        event['task'] = _current._task
+        event['tag'] = _current._tag
+    emit(event, _out_file)
+
+def _excepthook(exc_type, value, traceback):
+    global _current
+    report_error( exc_type.__name__ + ": " + str(value) )
+    _current = None
+    sys.__excepthook__(exc_type, value, traceback)
+
+def _at_exit():
+    if _current != None:
+        message = "exited while the task was running"
+        if hasattr(sys, "last_value"):
+            message += " (" + type(sys.last_value).__name__ + ": " + \
+                str(sys.last_value) + ")"
+        report_error(message)
+
+atexit.register(_at_exit)
+
+def start_noise_monitor(out_file, interval):
+    """
+    Start noisemon.py in the background, sampling every *interval* seconds
+    to out_file+'.noise' until this process exits.
+    """
+    global _noise_monitor
+    import noisemon, subprocess
+    stop_noise_monitor()
+    script = os.path.join(os.path.dirname(os.path.abspath(noisemon.__file__)),
+                          "noisemon.py")
+    _noise_monitor = subprocess.Popen( [sys.executable, script,
+        "-p", str(os.getpid()), "-i", str(interval), out_file + ".noise"] )
+
+def stop_noise_monitor():
+    """ Stop the background noise monitor, if any. """
+    global _noise_monitor
+    if _noise_monitor != None:
+        if _noise_monitor.poll() == None:
+            _noise_monitor.terminate()
+            _noise_monitor.wait()
+        _noise_monitor = None
+
+def start_run(out_file, expected_file=None, verbose=True, resume=None,
+              checkpoint=None, socket_path=None, noise_interval=None,
+              watchdog=None, summary_interval=None):
+    """
+    Begin tracking a benchmark run.
+
+    If *expected_file* exists, load the expected flow and the timings of
+    earlier runs of the same script on this host and report progress to the file
+    out_file+'.status' as calls are logged.
+
+    * out_file = benchmarking file of this run
+    * expected_file = expected flow written by extractCASAscript.py
+    * verbose = if true, also report progress on stderr
+    * resume = 'auto' or a task number to resume an interrupted run (see
+      resume_run); default from environment variable CASA_BENCH_RESUME
+    * checkpoint = if true, snapshot the data set to out_file+'.checkpoint'
+      at the checkpoints in the script; default true if environment variable
+      CASA_BENCH_CHECKPOINT is set
+    * socket_path = Unix domain (datagram) socket to also send events to,
+      e.g. the one aggregator.py listens on; default from environment
+      variable CASA_BENCH_SOCKET
+    * noise_interval = if given, sample system noise every noise_interval
+      seconds to out_file+'.noise' with noisemon.py; default from
+      environment variable CASA_BENCH_NOISEMON
+    * watchdog = if given, abort the run when a task call takes longer than
+      watchdog times the 99th percentile of its earlier calls on this host
+      (but at least CASA_BENCH_WATCHDOG_MIN seconds, default 600); default
+      from environment variable CASA_BENCH_WATCHDOG
+    * summary_interval = rewrite out_file+'.summary' from the statistics
+      kept so far at most every summary_interval seconds, as calls end;
+      default from environment variable CASA_BENCH_SUMMARY_INTERVAL, or 60;
+      '' turns it off
+
+    Events (run metadata, task begin and end, errors) are logged to
+    *out_file* as JSON lines; see read_events().
+
+    Under MPI only rank 0 removes the files of an earlier run, rewrites
+    *out_file* on resuming and starts the noise monitor; the other ranks
+    wait until rank 0 has logged its 'run' event (see wait_for_main).
+    """
+    global _progress, _resume_point, _checkpoint_dir, _out_file, _run_id
+    global _socket, _socket_path, _owner_pid, _announced_pid, _watchdog
+    global _stats, _timeouts, _summary_interval, _summary_time
+    main = not mpi_rank()
+    if not main:
+        wait_for_main(out_file, time.time())
+    _owner_pid = os.getpid()
+    _announced_pid = None
+    _progress = None
+    _resume_point = 0
+    _out_file = out_file
+    _run_id = socket.gethostname() + ":" + str(os.getpid()) + ":" + \
+        str(int(time.time()))
+    if socket_path == None:
+        socket_path = os.environ.get("CASA_BENCH_SOCKET", "")
+    _socket = None
+    _socket_path = None
+    if socket_path != "" and hasattr(socket, "AF_UNIX"):
+        _socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        _socket.setblocking(False)
+        _socket_path = socket_path
+    if sys.excepthook == sys.__excepthook__:
+        sys.excepthook = _excepthook
+    if resume == None:
+        resume = os.environ.get("CASA_BENCH_RESUME", "")
+    if checkpoint == None:
+        checkpoint = os.environ.get("CASA_BENCH_CHECKPOINT", "") != ""
+    _checkpoint_dir = None
+    if checkpoint:
+        _checkpoint_dir = out_file + ".checkpoint"
+    expected = []
+    if expected_file != None and os.path.exists(expected_file):
+        expected = read_expected(expected_file)
+    kept = []
+    if resume != "":
+        _resume_point, kept = resume_run(out_file, resume, expected, main)
+    elif main:
+        # Snapshots and noise samples of an earlier run do not match this run
+        if os.path.isdir(out_file + ".checkpoint"):
+            shutil.rmtree(out_file + ".checkpoint")
+        for name in [out_file + ".noise", plot_queue(out_file)]:
+            if os.path.exists(name):
+                os.remove(name)
+        if os.path.isdir(out_file + ".plotdata"):
+            shutil.rmtree(out_file + ".plotdata")
+    _stats = streamstats.run_from_records(kept)
+    _timeouts = []
+    if summary_interval == None:
+        summary_interval = os.environ.get("CASA_BENCH_SUMMARY_INTERVAL", "60")
+    _summary_interval = None
+    if summary_interval != "":
+        _summary_interval = float(summary_interval)
+    _summary_time = time.time()
+    if noise_interval == None:
+        noise_interval = os.environ.get("CASA_BENCH_NOISEMON", "")
+    if noise_interval != "" and main:
+        start_noise_monitor(out_file, float(noise_interval))
+    emit( {'event': 'run', 'time': time.time(), 'out_file': out_file,
+           'host': socket.gethostname(), 'pid': os.getpid(),
+           'cwd': os.getcwd(), 'resume_point': _resume_point}, out_file )
+    if watchdog == None:
+        watchdog = os.environ.get("CASA_BENCH_WATCHDOG", "")
+    if _watchdog != None:
+        _watchdog.stop()
+    _watchdog = None
+    if watchdog != "":
+        floor = float( os.environ.get("CASA_BENCH_WATCHDOG_MIN", "600") )
+        history = read_history(out_file, host=socket.gethostname())
+        _watchdog = Watchdog( task_limits(history, float(watchdog), floor),
+                              out_file )
+    if expected_file == None or not os.path.exists(expected_file):
+        return
+    _progress = Progress( expected,
+                          history=read_history(out_file,
+                                               host=socket.gethostname()),
+                          status_file=out_file + ".status",
+                          verbose=verbose )
+    _progress.resume(_resume_point, kept)
+    _progress.report()
+
+def summarize_bench(in_file=None,out_file=None):
+    """
+    Read and summarize a benchmarking file, merging the record files of all
+    processes of the run; see casa_summary.summarize_bench.
+    """
+    stop_noise_monitor()
+    import casa_summary
+    casa_summary.summarize_bench(in_file, out_file)
+
+def checkpoint_summary(force=False):
+    """
+    Rewrite the summary of the run in progress from the streaming statistics
+    if the summary interval has passed since it was last written (or if
+    *force*), so that an interrupted run still leaves a summary.
+    """
+    global _summary_time, _summary_info
+    if _stats == None or _summary_interval == None:
+        return
+    if not force and time.time() - _summary_time < _summary_interval:
+        return
+    _summary_time = time.time()
+    import casa_summary, hostinfo
+    if _summary_info == None:
+        _summary_info = hostinfo.fingerprint()
+    casa_summary.write_summary( casa_summary.summary_lines(_out_file, _stats,
+        _summary_info, timeouts=_timeouts, complete=False),
+        _out_file + ".summary" )
+
+def finish_run(out_file, summary_file=None):
+    """
+    Write the summary of the run to *summary_file* (default
+    out_file+'.summary') at the end of a benchmark script.
+
+    The summary is made from the statistics kept while the run went on,
+    without reading the benchmarking file again.  Runs with record files of
+    other processes (see record_file) are summarized from all record files
+    by summarize_bench.  Only the main process (MPI rank 0) writes the
+    summary.
+    """
+    if mpi_rank():
+        return
+    if summary_file == None:
+        summary_file = out_file + ".summary"
+    if _stats == None or out_file != _out_file or \
+       len(record_files(out_file)) > 1:
+        summarize_bench(out_file, summary_file)
+        return
+    stop_noise_monitor()
+    if _stats.calls() == 0:
+        print "No calls were logged to " + out_file
+        return
+    import casa_summary, hostinfo
+    info = hostinfo.fingerprint()
+    casa_summary.write_summary( casa_summary.summary_lines(out_file, _stats,
+        info, timeouts=_timeouts), summary_file )
+    casa_summary.export_metrics(out_file, _stats, info, _timeouts)
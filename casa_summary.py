@@ -0,0 +1,166 @@
+#!/bin/env python
+'''
+Summaries of benchmark runs.
+
+Write the summary of a run logged by casa_call: the host fingerprint, the
+storage, run mode and noise lines, the streaming statistics of the run as a
+"Statistics:" line of JSON, the totals, timeouts and per-process busy times
+and one line per task.  casa_call imports this module only when it writes a
+summary (casa_call.finish_run, checkpoint_summary and summarize_bench), so
+that the benchmark scripts do not load it, or hostinfo, iobench and
+openmetrics, in casapy before the timing starts.
+
+Summarize a benchmarking file again, e.g. after a crash:
+
+    $ ./casa_summary.py myScript.benchmark.txt
+'''
+
+import sys, os, os.path, json
+from optparse import OptionParser
+import casa_call, hostinfo, iobench, noisemon, openmetrics, streamstats
+
+def imbalance(records):
+    """
+    Return a list of (process, calls, busy time) of *records* from
+    casa_call.read_merged, busiest first, and the load imbalance: the busiest
+    process's time over the mean minus one.
+    """
+    busy = {}
+    calls = {}
+    for rec in records:
+        busy[rec['process']] = busy.get(rec['process'], 0.0) + rec['delta']
+        calls[rec['process']] = calls.get(rec['process'], 0) + 1
+    procs = sorted(busy.keys(), key=lambda p: -busy[p])
+    table = [(p, calls[p], busy[p]) for p in procs]
+    if len(procs) == 0:
+        return table, 0.0
+    mean = sum(busy.values()) / len(procs)
+    if mean <= 0:
+        return table, 0.0
+    return table, busy[procs[0]] / mean - 1.0
+
+def summary_lines(in_file, stats, info=None, procs=[], load_imbalance=0.0,
+                  timeouts=[], complete=True):
+    """
+    Return the lines of the summary of benchmarking file *in_file*.
+
+    * stats = streamstats.RunStats of the run
+    * info = host fingerprint (see hostinfo.fingerprint), default this host
+    * procs, load_imbalance = per-process busy times and load imbalance, see
+      imbalance(); listed if there is more than one process
+    * timeouts = 'timeout' events of the run
+    * complete = false for a summary of a run still in progress
+    """
+    if info == None:
+        info = hostinfo.fingerprint()
+    lines = []
+    lines.append("Summary of file "+in_file+"\n")
+    lines += hostinfo.header_lines(info)
+    storage = iobench.read_result()
+    if storage != None:
+        lines.append( iobench.summary_line(storage) )
+    run_mode = {'cache': os.environ.get("CASA_BENCH_CACHEMODE") or None,
+                'repeat': None}
+    if os.environ.get("CASA_BENCH_REPEAT", "").isdigit():
+        run_mode['repeat'] = int(os.environ["CASA_BENCH_REPEAT"])
+    if os.environ.get("CASA_BENCH_SCALE", "") != "":
+        run_mode['scale'] = float(os.environ["CASA_BENCH_SCALE"])
+    for name in ['replicas', 'replica']:
+        value = os.environ.get("CASA_BENCH_" + name.upper(), "")
+        if value.isdigit():
+            run_mode[name] = int(value)
+    lines.append( "Run mode: " + json.dumps(run_mode, sort_keys=True) + "\n" )
+    if os.path.exists(in_file + ".noise"):
+        noise = noisemon.summarize( noisemon.read_samples(in_file + ".noise") )
+        lines.append( noisemon.summary_line(noise) )
+    state = stats.to_dict()
+    state['complete'] = complete
+    lines.append( "Statistics: " + json.dumps(state, sort_keys=True) + "\n" )
+    lines.append("\n")
+    total_time = stats.total_time()
+    total_time_hr = total_time / 3600.0
+    lines.append("Total time: "+str(total_time)+" ("+str(total_time_hr)+" hr)\n")
+    time_logged = stats.logged()
+    lines.append("Time inside logged tasks: "+str(time_logged)+"\n")
+    lines.append("Time outside logged tasks: "+str(total_time-time_logged)+"\n")
+    lines.append("Total logged calls: "+str(stats.calls())+"\n")
+    lines.append("Average time per call: "+
+                 str(time_logged / max(stats.calls(), 1))+"\n")
+    for event in timeouts:
+        lines.append("Timed out: "+event['task']+" "+event['tag']+ \
+                     " after "+str(event['elapsed'])+" s (limit "+ \
+                     str(event['limit'])+" s)\n")
+    if len(procs) > 1:
+        lines.append("Processes: "+str(len(procs))+"\n")
+        for label, ncalls, busy in procs:
+            lines.append("Process "+label+" "+str(ncalls)+" "+str(busy)+"\n")
+        lines.append("Load imbalance: "+str(load_imbalance)+"\n")
+
+    lines.append("\n")
+
+    tasks_called = sorted(stats.tasks.keys(),
+                          key=lambda task: stats.tasks[task].total)
+    for this_task in tasks_called:
+        task_stats = stats.tasks[this_task]
+        lines.append(this_task+" "+str(task_stats.count)+ \
+                         " "+str(task_stats.total / task_stats.count)+ \
+                         " "+str(task_stats.total)+"\n")
+    return lines
+
+def write_summary(lines, out_file=None):
+    """ Print summary *lines*, or replace *out_file* with them atomically. """
+    if out_file == None:
+        for line in lines:
+            print line
+        return
+    f = open(out_file + ".tmp", "w")
+    f.writelines(lines)
+    f.close()
+    os.rename(out_file + ".tmp", out_file)
+
+def export_metrics(in_file, stats, info, timeouts):
+    """ Export the run as OpenMetrics if CASA_BENCH_TEXTFILE_DIR is set. """
+    noise = None
+    if os.path.exists(in_file + ".noise"):
+        noise = noisemon.summarize( noisemon.read_samples(in_file + ".noise") )
+    openmetrics.export_run(in_file, stats, info, noise, len(timeouts))
+
+def summarize_bench(in_file=None,out_file=None):
+    """
+    Read and summarize a benchmarking file, merging the record files of all
+    processes of the run, and write the summary to *out_file* (printed if
+    None).
+    """
+    if in_file == None:
+        return
+    if not os.path.exists(in_file):
+        print "No calls were logged to " + in_file
+        return
+    records = casa_call.read_merged(in_file)
+    stats = streamstats.run_from_records(records)
+    timeouts = [event for event in casa_call.read_events(in_file)
+                if event.get('event') == 'timeout']
+    procs, load_imbalance = imbalance(records)
+    info = hostinfo.fingerprint()
+    write_summary( summary_lines(in_file, stats, info, procs, load_imbalance,
+                                 timeouts), out_file )
+    export_metrics(in_file, stats, info, timeouts)
+
+if __name__ == "__main__":
+    usage = """ %prog [options] BENCHFILE
+
+    Summarize the run logged in BENCHFILE (and the record files of its other
+    processes) to BENCHFILE.summary."""
+    parser = OptionParser( usage=usage )
+    parser.add_option( '-o', '--output', default=None,
+        help="summary file (default: BENCHFILE.summary); '-' prints it" )
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    out_file = options.output
+    if out_file == None:
+        out_file = args[0] + ".summary"
+    elif out_file == "-":
+        out_file = None
+    summarize_bench(args[0], out_file)
@@ -0,0 +1,416 @@
+#!/bin/env python
+'''
+Segmented download of benchmark data sets.
+
+Fetch a file over HTTP(S) in several segments at once with Range requests,
+one thread per segment.  Each segment is written to <file>.part<n>; the
+segment layout and the server's ETag and Last-Modified headers are kept in
+<file>.download.json, so that an interrupted download resumes where every
+segment stopped, unless the file on the server changed.  Failed requests are
+retried with backoff.  The joined file can be verified against a checksum
+before it is used.  Servers without Range support get a single stream.
+
+A summary line, "Download: {json}", with the size, time, throughput and
+checksum outcome is printed, e.g. into the .extraction.benchmark file of
+benchmark.sh.
+
+For tests, option --serve starts a stand-in HTTP server with Range support
+on a local directory:
+
+    $ ./download.py --serve /data -p 8000 &
+    $ ./download.py -j 4 -s md5:0123... http://localhost:8000/set.tgz
+'''
+
+import sys, os, os.path, time, json, re, hashlib, shutil, threading
+import urllib2, BaseHTTPServer, SimpleHTTPServer, SocketServer
+from optparse import OptionParser
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+# Bytes read per request read() call
+block_size = 1048576
+
+# Segments smaller than this are not split further
+min_segment = 4 * 1048576
+
+class DownloadError(Exception):
+    pass
+
+def open_url(url, first=None, last=None, verify=True, timeout=60):
+    """
+    Open *url*, from byte *first* to byte *last* (inclusive) if given.
+    Return the response.
+    """
+    request = urllib2.Request(url)
+    if first != None:
+        request.add_header("Range", "bytes=" + str(first) + "-" +
+                           (last != None and str(last) or ""))
+    if not verify and ssl != None and \
+       hasattr(ssl, "_create_unverified_context"):
+        return urllib2.urlopen(request, timeout=timeout,
+                               context=ssl._create_unverified_context())
+    return urllib2.urlopen(request, timeout=timeout)
+
+def probe(url, verify=True):
+    """
+    Return (size, validators, ranges) of *url*: the size in bytes (None if
+    unknown), the ETag and Last-Modified headers, and whether the server
+    honours Range requests.
+    """
+    response = open_url(url, 0, 0, verify)
+    info = response.info()
+    validators = {'etag': info.getheader("ETag"),
+                  'last_modified': info.getheader("Last-Modified")}
+    size = None
+    ranges = False
+    match = re.match(r"bytes\s+0-0/(\d+)",
+                     info.getheader("Content-Range") or "")
+    if response.getcode() == 206 and match:
+        size = int(match.group(1))
+        ranges = True
+    elif info.getheader("Content-Length") != None:
+        size = int(info.getheader("Content-Length"))
+    response.close()
+    return size, validators, ranges
+
+def split_segments(size, count):
+    """ Return *count* (first, last) byte ranges covering *size* bytes. """
+    count = max(1, min(count, size // min_segment or 1))
+    step = size // count
+    segments = []
+    for i in range(count):
+        first = i * step
+        last = (i == count - 1) and size - 1 or (i + 1) * step - 1
+        segments.append( [first, last] )
+    return segments
+
+def state_file(dest):
+    return dest + ".download.json"
+
+def part_file(dest, i):
+    return dest + ".part" + str(i)
+
+def load_state(dest, url, size, validators):
+    """
+    Return the saved segment layout of an interrupted download of *url* to
+    *dest*, or None if there is none or the file on the server changed.
+    """
+    try:
+        f = open(state_file(dest))
+        state = json.load(f)
+        f.close()
+    except (IOError, ValueError):
+        return None
+    if state.get('url') != url or state.get('size') != size or \
+       state.get('validators') != validators:
+        return None
+    return state['segments']
+
+def save_state(dest, url, size, validators, segments):
+    f = open(state_file(dest) + ".tmp", "w")
+    json.dump({'url': url, 'size': size, 'validators': validators,
+               'segments': segments}, f)
+    f.close()
+    os.rename(state_file(dest) + ".tmp", state_file(dest))
+
+def remove_parts(dest):
+    """
+    Remove all part files of *dest*, whatever layout or single fetch left
+    them.
+    """
+    directory = os.path.dirname(dest) or "."
+    prefix = os.path.basename(dest) + ".part"
+    for fname in os.listdir(directory):
+        if fname.startswith(prefix) and fname[len(prefix):].isdigit():
+            os.remove(os.path.join(directory, fname))
+
+class Segment(threading.Thread):
+    """
+    Thread fetching bytes *first* to *last* of a download into *fname*,
+    appending to what an earlier attempt left there.
+    """
+    def __init__(self, url, fname, first, last, verify=True, retries=5):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.url = url
+        self.fname = fname
+        self.first = first
+        self.last = last
+        self.verify = verify
+        self.retries = retries
+        self.resumed = 0
+        self.fetched = 0
+        self.error = None
+
+    def have(self):
+        if os.path.exists(self.fname):
+            return os.path.getsize(self.fname)
+        return 0
+
+    def run(self):
+        self.resumed = self.have()
+        attempt = 0
+        while self.first + self.have() <= self.last:
+            try:
+                self.fetch()
+                attempt = 0
+            except (IOError, urllib2.URLError, DownloadError), e:
+                attempt += 1
+                if attempt > self.retries:
+                    self.error = str(e)
+                    return
+                time.sleep(min(2 ** attempt, 60))
+
+    def fetch(self):
+        start = self.first + self.have()
+        response = open_url(self.url, start, self.last, self.verify)
+        if response.getcode() != 206:
+            raise DownloadError("no partial content for " + self.url)
+        f = open(self.fname, "ab")
+        before = start
+        try:
+            while start <= self.last:
+                data = response.read(min(block_size, self.last - start + 1))
+                if not data:
+                    break
+                f.write(data)
+                start += len(data)
+                self.fetched += len(data)
+        finally:
+            f.close()
+            response.close()
+        if start == before:
+            raise DownloadError("no data received from " + self.url)
+
+def fetch_single(url, dest, verify=True):
+    """ Fetch *url* to *dest* in one stream. Return the bytes fetched. """
+    response = open_url(url, verify=verify)
+    f = open(dest + ".part0", "wb")
+    fetched = 0
+    while True:
+        data = response.read(block_size)
+        if not data:
+            break
+        f.write(data)
+        fetched += len(data)
+    f.close()
+    response.close()
+    os.rename(dest + ".part0", dest)
+    return fetched
+
+def join_parts(dest, count):
+    """ Concatenate the part files of *dest* into *dest* and remove them. """
+    f = open(dest + ".tmp", "wb")
+    for i in range(count):
+        part = open(part_file(dest, i), "rb")
+        shutil.copyfileobj(part, f, block_size)
+        part.close()
+    f.close()
+    os.rename(dest + ".tmp", dest)
+    remove_parts(dest)
+
+def parse_checksum(spec, verify=True):
+    """
+    Return (algorithm, hex digest) of checksum *spec*: 'ALGO:HEX', or
+    'ALGO:URL' naming a checksum file (as written by md5sum, sha256sum, ...).
+    """
+    algo, value = spec.split(":", 1)
+    if not re.match(r"^[0-9a-fA-F]+$", value):
+        if os.path.exists(value):
+            f = open(value)
+        else:
+            f = open_url(value, verify=verify)
+        value = f.read().split()[0]
+        f.close()
+    hashlib.new(algo)
+    return algo, value.lower()
+
+def file_digest(fname, algo):
+    digest = hashlib.new(algo)
+    f = open(fname, "rb")
+    while True:
+        data = f.read(block_size)
+        if not data:
+            break
+        digest.update(data)
+    f.close()
+    return digest.hexdigest()
+
+def download(url, dest=None, segments=4, checksum=None, verify=True,
+             retries=5):
+    """
+    Download *url* to *dest* (default: its base name in the current
+    directory). Return a dictionary describing the download.  Raise
+    DownloadError if a segment fails for good, the joined file does not have
+    the size of the file on the server or the checksum does not match; the
+    part files are kept for a later resume in the first case.
+
+    * segments = number of segments fetched at the same time
+    * checksum = (algorithm, hex digest) to verify, or None
+    """
+    if dest == None:
+        dest = os.path.basename(url.split("?")[0])
+    start = time.time()
+    size, validators, ranges = probe(url, verify)
+    result = {'url': url, 'file': dest, 'size': size, 'segments': 1,
+              'resumed': 0, 'fetched': 0, 'checksum': None}
+    if os.path.exists(dest) and size != None and \
+       os.path.getsize(dest) == size and not os.path.exists(state_file(dest)):
+        # Already complete (like wget -N)
+        result['skipped'] = True
+    elif not ranges or not size:
+        result['fetched'] = fetch_single(url, dest, verify)
+    else:
+        layout = load_state(dest, url, size, validators)
+        if layout == None:
+            remove_parts(dest)
+            layout = split_segments(size, segments)
+            save_state(dest, url, size, validators, layout)
+        threads = [Segment(url, part_file(dest, i), first, last, verify,
+                           retries)
+                   for i, (first, last) in enumerate(layout)]
+        for thread in threads:
+            thread.start()
+        while [thread for thread in threads if thread.is_alive()]:
+            time.sleep(0.2)
+        result['segments'] = len(threads)
+        result['resumed'] = sum([thread.resumed for thread in threads])
+        result['fetched'] = sum([thread.fetched for thread in threads])
+        errors = [thread.error for thread in threads if thread.error]
+        if errors:
+            raise DownloadError("segment failed: " + errors[0])
+        join_parts(dest, len(threads))
+        joined = os.path.getsize(dest)
+        if joined != size:
+            os.rename(dest, dest + ".bad")
+            raise DownloadError("size mismatch for %s: %d bytes, expected %d"
+                                " (moved to %s.bad)" % (dest, joined, size,
+                                                        dest))
+        os.remove(state_file(dest))
+    result['seconds'] = time.time() - start
+    result['mb_per_s'] = result['fetched'] / 1048576.0 / \
+        max(result['seconds'], 1e-6)
+    if checksum != None:
+        ok = file_digest(dest, checksum[0]) == checksum[1]
+        result['checksum'] = checksum[0] + (ok and " ok" or " mismatch")
+        if not ok:
+            os.rename(dest, dest + ".bad")
+            raise DownloadError("checksum mismatch for " + dest +
+                                " (moved to " + dest + ".bad)")
+    return result
+
+def summary_line(result):
+    """ Return the "Download:" summary line of *result*. """
+    return "Download: " + json.dumps(result, sort_keys=True)
+
+class RangeHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """
+    Request handler serving files with single byte range support.  With
+    *drop_after* set, every response is cut off after that many bytes, to
+    test resuming.
+    """
+    drop_after = None
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) or not os.path.exists(path):
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+        size = os.path.getsize(path)
+        first, last = 0, size - 1
+        match = re.match(r"bytes=(\d*)-(\d*)$",
+                         self.headers.getheader("Range") or "")
+        if match:
+            if match.group(1):
+                first = int(match.group(1))
+                if match.group(2):
+                    last = min(int(match.group(2)), size - 1)
+            elif match.group(2):
+                first = max(size - int(match.group(2)), 0)
+            if first > last:
+                self.send_error(416, "Requested range not satisfiable")
+                return None
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" %
+                             (first, last, size))
+        else:
+            self.send_response(200)
+        mtime = os.path.getmtime(path)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(last - first + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Last-Modified", self.date_time_string(mtime))
+        self.send_header("ETag", '"%x-%x"' % (size, int(mtime)))
+        self.end_headers()
+        f = open(path, "rb")
+        f.seek(first)
+        self.remaining = last - first + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        limit = self.remaining
+        if self.drop_after != None:
+            limit = min(limit, self.drop_after)
+        while limit > 0:
+            data = source.read(min(block_size, limit))
+            if not data:
+                break
+            outputfile.write(data)
+            limit -= len(data)
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def serve(directory, port=8000, drop_after=None):
+    """ Serve *directory* on *port* until interrupted. """
+    os.chdir(directory)
+    RangeHandler.drop_after = drop_after
+    server = Server(("", port), RangeHandler)
+    print "Serving " + os.getcwd() + " on port " + str(server.server_port)
+    sys.stdout.flush()
+    server.serve_forever()
+
+if __name__ == "__main__":
+    usage = """ %prog [options] URL
+       %prog --serve DIRECTORY [-p PORT]
+
+    Download URL to the current directory in segments, resuming an
+    interrupted download, and print a "Download:" summary line.  With
+    --serve, serve DIRECTORY over HTTP with Range support instead."""
+    parser = OptionParser( usage=usage )
+    parser.add_option( '-j', '--segments', type="int", default=4,
+        help="number of segments fetched at the same time [default: %default]" )
+    parser.add_option( '-o', '--output', default=None,
+        help="file to write (default: the base name of URL)" )
+    parser.add_option( '-s', '--checksum', default=None,
+        help="verify the file against ALGO:HEX or ALGO:URL of a checksum " + \
+             "file, e.g. md5:d41d8cd98f00b204e9800998ecf8427e" )
+    parser.add_option( '-r', '--retries', type="int", default=5,
+        help="retries per segment [default: %default]" )
+    parser.add_option( '-C', '--no-check-certificate', action="store_false",
+        dest="verify", default=True,
+        help="do not verify the server certificate" )
+    parser.add_option( '--serve', action="store_true", default=False,
+        help="serve DIRECTORY instead of downloading" )
+    parser.add_option( '-p', '--port', type="int", default=8000,
+        help="port to serve on [default: %default]" )
+    parser.add_option( '--drop-after', type="int", default=None,
+        help="cut every served response off after this many bytes" )
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    if options.serve:
+        serve(args[0], options.port, options.drop_after)
+        sys.exit(0)
+    checksum = None
+    if options.checksum:
+        checksum = parse_checksum(options.checksum, options.verify)
+    try:
+        result = download(args[0], options.output, options.segments,
+                          checksum, options.verify, options.retries)
+    except (DownloadError, IOError, urllib2.URLError), e:
+        print >> sys.stderr, "download: " + str(e)
+        sys.exit(1)
+    print summary_line(result)
@@ -10,9 +10,12 @@ The script runs in one of three modes:
 1) interactive (default): Generates a casapy script that requests user input
    when interactive GUIs are invoked.
 
-2) non-interactive: Generates a casapy script that sleeps for 60s when an
-   interactive GUI is invoked.  (Note: 60s may not be enough time for some
-   plots.)
+2) non-interactive: Generates a casapy script that waits for plotms to
+   finish after each plotms call: until the plot file (if any) exists and
+   stops growing, the plotms processes stop using CPU and no other process
+   holds a lock on the plotted table, polled with backoff and capped by a
+   timeout.  Without /proc (e.g. Mac OS) only the plot file is watched, and
+   plotms calls without a plot file are followed by a 60s pause instead.
 
 3) benchmark: Generates a casapy script that makes all tasks noninteractive or
    removes their invocation all together.  The output script imports and makes
@@ -27,6 +30,10 @@ The script runs in one of three modes:
    The intended functionality of the benchmarking mode is (1) to allow easy
    assessment of whether the scripts are working and (2) to produce useful
    benchmarks of performance, e.g., as a function of machine.
+
+   With --deferplots, the diagnostic plot calls (plotms, plotants, plotcal,
+   plotxy) are queued with their argument values instead, and plotqueue.py
+   makes the plots outside the timed run.
 '''
 
 # =====================
@@ -204,6 +211,18 @@ nbsp = "&#160;"
 # plotants -- produces a table lock that causes wvrgcal to fail
 tasks_to_suppress = ["plotms", "plotants"]
 
+# diagnostic plot tasks queued for plotqueue.py instead of being run in a
+# benchmarking run with --deferplots (see casa_call.defer_plot)
+tasks_to_defer = tasks_to_suppress + ["plotcal", "plotxy"]
+
+# tasks after which a benchmarking run may snapshot the data set so that an
+# interrupted run can be resumed (see casa_call.checkpoint)
+checkpoint_tasks = ["importasdm", "importevla", "concat", "split", "applycal",
+                    "cvel", "mstransform", "uvcontsub"]
+
+# statements with file system side effects; skipped when resuming
+side_effects = re.compile(r"\s*(os\.system|os\.remove|os\.unlink|os\.rename|shutil\.\w+)\s*\(")
+
 # =====================
 # FUNCTIONS
 # =====================
@@ -256,14 +275,50 @@ def indentation(line):
     return spaces
 
 def add_benchmarking(line,tasknum=0):
+    """
+    Wrap a task call in timing calls.  The call is skipped when a resumed run
+    has already completed task number *tasknum*; top level calls to the tasks
+    in checkpoint_tasks are followed by a checkpoint.
+    """
     this_task = extract_task(line)
     indents = indentation(line)
     pre_string = ""
     for i in range(indents):
         pre_string+=" "
-    before = pre_string+"this_call = casa_call.Call('"+this_task+"','"+str(tasknum)+"')\n"
-    after = "\n"+pre_string+"this_call.end(out_file)"
-    return before+line+after
+    before = pre_string+"if casa_call.todo("+str(tasknum)+"):\n"
+    before += pre_string+"    this_call = casa_call.Call('"+this_task+"','"+str(tasknum)+"')\n"
+    after = "\n"+pre_string+"    this_call.end(out_file)"
+    if indents == 0 and this_task in checkpoint_tasks:
+        after += "\ncasa_call.checkpoint("+str(tasknum)+")"
+    return before+"    "+line+after
+
+def is_side_effect(line):
+    """
+    Tests if the line is a file system operation that a resumed run must not
+    repeat (e.g. removing a calibration table before it is recreated).
+    """
+    return re.match( side_effects, line ) != None
+
+def skip_if_done(line,tasknum=0):
+    """
+    Make a statement conditional on task number *tasknum* not having been
+    completed by a resumed run.
+    """
+    pre_string = ' '*indentation(line)
+    return pre_string+"if casa_call.todo("+str(tasknum)+"):\n    "+line
+
+def defer_plot(line,tasknum=0):
+    """
+    Replace a plot task call by a call queueing it with its argument values
+    for plotqueue.py.  A resumed run skips it if task number *tasknum* was
+    completed, since the plot was queued then; casa_call.defer_plot does not
+    queue it again if it comes right after the resume point.
+    """
+    this_task = extract_task(line)
+    start = line.find(this_task + "(") + len(this_task) + 1
+    line = line[:start - len(this_task) - 1] + "casa_call.defer_plot('" + \
+        this_task + "', '" + str(tasknum) + "', " + line[start:]
+    return skip_if_done(line,tasknum)
 
 def suppress_for_benchmark(line):
     if is_task_call(line) == False:
@@ -395,19 +450,148 @@ def addInteractivePause(outline):
     newoutline += "\n" + indent + "user_check=raw_input('When you are done with the window, close it and press enter to continue:')"
     return newoutline
 
+def call_arguments(line):
+    """
+    Return a dictionary of the keyword arguments of the task call in *line*,
+    mapping each keyword to the source text of its value.
+    """
+    args = {}
+    start = line.find("(")
+    if start == -1:
+        return args
+    depth = 0; quote = None; current = ""
+    for char in line[start:]:
+        if quote:
+            current += char
+            if char == quote:
+                quote = None
+            continue
+        if char in "'\"":
+            quote = char
+        elif char in "([{":
+            depth += 1
+            if depth == 1:
+                continue
+        elif char in ")]}":
+            depth -= 1
+            if depth == 0:
+                break
+        elif char == "," and depth == 1:
+            if "=" in current:
+                name, value = current.split("=", 1)
+                args[name.strip()] = value.strip()
+            current = ""
+            continue
+        current += char
+    if "=" in current:
+        name, value = current.split("=", 1)
+        args[name.strip()] = value.strip()
+    return args
+
 def addNonInteractivePause(outline):
-    newoutline = outline
-    newoutline += "\ninp()\nprint('Pausing for 60 seconds...')\n"
-    newoutline += "time.sleep(60)\n"
-    newoutline = string.replace(newoutline, '\n', '\n'+' '*indentation(outline))
-    return newoutline
+    """
+    Follow a plotms call with a wait for the plot to complete; see
+    noninteractive_header.
+    """
+    args = call_arguments(outline)
+    wait_args = []
+    for name in ['vis', 'plotfile']:
+        if name in args:
+            wait_args.append( name + "=" + args[name] )
+    return outline + "\n" + ' '*indentation(outline) + \
+        "wait_for_plot(" + ", ".join(wait_args) + ")"
+
+# Function definitions written at the top of non-interactive scripts
+noninteractive_material = """### Begin Non-interactive Material
+import os, time
+def plot_locked(vis):
+    \"\"\" Tests if another process holds a lock on table *vis*. \"\"\"
+    try:
+        inode = os.stat(os.path.join(vis, 'table.lock')).st_ino
+        f = open('/proc/locks')
+    except (OSError, IOError, TypeError):
+        return False
+    locked = False
+    for line in f:
+        fields = line.replace('->', '').split()
+        if len(fields) < 6 or fields[5].split(':')[-1] != str(inode):
+            continue
+        if fields[4] != str(os.getpid()):
+            locked = True
+    f.close()
+    return locked
+def plotms_cpu():
+    \"\"\"
+    Return the CPU time (in ticks) used so far by plotms processes; 0
+    without /proc.
+    \"\"\"
+    try:
+        pids = os.listdir('/proc')
+    except OSError:
+        return 0
+    total = 0
+    for pid in pids:
+        if not pid.isdigit():
+            continue
+        try:
+            f = open('/proc/' + pid + '/stat')
+            stat = f.read()
+            f.close()
+        except IOError:
+            continue
+        if 'plotms' not in stat[stat.find('(')+1:stat.rfind(')')]:
+            continue
+        fields = stat[stat.rfind(')')+2:].split()
+        total += int(fields[11]) + int(fields[12])
+    return total
+def wait_for_plot(vis=None, plotfile=None, timeout=600.0, delay=0.5,
+                  max_delay=10.0):
+    \"\"\"
+    Wait until plotms has finished: the plot file (if any) exists and stopped
+    growing, the plotms processes stopped using CPU and no other process
+    locks table *vis*.  Poll with exponential backoff for at most *timeout*
+    seconds.
+    \"\"\"
+    if not plotfile and not os.path.isdir('/proc'):
+        print('Pausing for 60 seconds...')
+        time.sleep(60)
+        return
+    print('Waiting for plotms to finish...')
+    start = time.time()
+    last = None
+    while True:
+        time.sleep(delay)
+        size = None
+        if plotfile and os.path.exists(plotfile):
+            size = os.path.getsize(plotfile)
+        state = (plotms_cpu(), size)
+        if state == last and (size or not plotfile) and \\
+           not (vis and plot_locked(vis)):
+            return
+        if time.time() - start > timeout:
+            print('Gave up waiting for plotms after %d seconds.' % timeout)
+            return
+        last = state
+        delay = min(delay * 1.5, max_delay)
+### End Non-interactive Material"""
+
+def noninteractive_header():
+    """
+    Return the lines defining wait_for_plot, which non-interactive scripts
+    call after each plotms call instead of sleeping for a fixed time.
+    """
+    return noninteractive_material.split("\n")
 
 # Return the pre-material needed to set up benchmarking
 def benchmark_header( scriptName='script' ):
     """
     Write the header of the benchmarking script.
 
-    * scriptName = Name of the benchmarking script
+    * scriptName = Name of the benchmarking script; progress is tracked
+      against the expected flow in scriptName+'.expected'
+
+    The previous benchmarking file is kept unless the run resumes an
+    interrupted one (see casa_call.start_run).
     """
     out_file = scriptName.replace('.py','.benchmark.txt')
     lines = []
@@ -417,12 +601,10 @@ def benchmark_header( scriptName='script' ):
     lines.append("    out_file")
     lines.append("except NameError:")
     lines.append("    out_file = '" + out_file + "'")
-    lines.append("if os.path.exists(out_file):")
-    lines.append("    counter = 1")
-    lines.append("    while os.path.exists(out_file+'.'+str(counter)):")
-    lines.append("        counter += 1")
-    lines.append("    os.system('mv '+out_file+' '+out_file+'.'+str(counter))")
-    lines.append("os.system('rm -rf '+out_file)")
+    lines.append("if not casa_call.resume_requested():")
+    lines.append("    casa_call.rotate_bench(out_file)")
+    lines.append("casa_call.start_run(out_file, expected_file='" + \
+                 scriptName + ".expected')")
     lines.append("### End Benchmarking Material")
     return lines
 
@@ -548,6 +730,157 @@ def checkModules():
         print "casa_call.py must exist in the casapy module search path!"
         raise
 
+def extract_code( responseLines ):
+    """
+    Return the lines of Python code in a CASA Guide web page, cleaned of HTML
+    markup.
+
+    * responseLines = list of lines of the HTML page
+    """
+    readingCode = False
+    lineList = []
+    # Loop over the lines read from the web page
+    for line in responseLines:
+        # If we are not currently reading code, see if this line
+        # begins a python code block.
+        if (readingCode == False):
+            if beginBlock in line:
+                readingCode = True
+                outline = loseTheJunk(line)
+                lineList += [outline]
+                if endBlock in line:
+                    readingCode = False
+        else:
+            outline = loseTheJunk(line)
+            lineList += [outline]
+            if endBlock in line:
+                readingCode = False
+    return lineList
+
+def compress_lines( lineList ):
+    """
+    Compress lines into individual commands, allowing for commands to span
+    multiple lines.  Lines are grouped by closed parentheses.
+
+    * lineList = list of lines of Python code
+    """
+    compressedList = []
+    iline = 0
+    while iline < len(lineList):
+        line = lineList[iline]
+        pcount = countParen(line)
+        while(pcount > 0):
+            line += '\n'
+            iline += 1
+            line += lineList[iline]
+            pcount = countParen(line)
+        line = string.expandtabs(line)
+        compressedList += [line]
+        iline += 1
+    return compressedList
+
+def benchmark_lines( compressedList, deferPlots=False ):
+    """
+    Apply the benchmarking markup to each statement.
+
+    Return a tuple (lines, task_list, task_nums): the marked-up statements, one
+    per input statement, and the name and number of each task call found.
+
+    * compressedList = list of compressed Python statements
+    * deferPlots = if true, queue the calls of tasks_to_defer for
+      plotqueue.py rather than suppressing or timing them
+    """
+    lines = []
+    task_list = []
+    task_nums = []
+    tasknum = 0
+    for line in compressedList:
+        if deferPlots and is_task_call(line) and \
+           extract_task(line) in tasks_to_defer:
+            line = defer_plot(suppress_gui(line),tasknum+1)
+        elif suppress_for_benchmark(line):
+            line = ' ' * indentation(line) + 'pass #' + line.replace('\n','')
+        else: 
+            line = suppress_gui(line)
+            if is_task_call(line):                
+                this_task = extract_task(line)
+                print "I found a task call for ", this_task                
+                tasknum += 1
+                line = add_benchmarking(line,tasknum)      
+                task_list.append(this_task)
+                task_nums.append(tasknum)
+            elif is_side_effect(line):
+                # Belongs to the preparation of the next task
+                line = skip_if_done(line,tasknum+1)
+        lines.append(line)
+    return lines, task_list, task_nums
+
+def write_benchmark_script( outFile, benchLines, task_list, task_nums ):
+    """
+    Write a benchmarking script and its expected flow (outFile+'.expected').
+
+    * outFile = name of the benchmarking script
+    * benchLines = statements with benchmarking markup
+    * task_list, task_nums = names and numbers of the task calls in the
+      expected order
+    """
+    f = codecs.open(outFile, 'w','utf-8')
+    header = benchmark_header( scriptName = outFile )
+    for line in header:
+        print >>f, line
+    for line in benchLines:
+        print >>f, line
+    print >>f, 'casa_call.finish_run( out_file, out_file+".summary" )'
+    f.close()        
+
+    # Write task list to expectation file
+    exp_file = outFile+'.expected'
+    print "I am writing the expected flow to a file called "+exp_file
+    f = codecs.open(exp_file, 'w','utf-8')
+    for i in range(len(task_list)):
+        print >>f, task_list[i], task_nums[i]
+    f.close()
+
+def write_stage_scripts( outFile, compressedList, benchLines, task_list,
+                         task_nums ):
+    """
+    Split a benchmarking script into stages that can run concurrently.
+
+    Write one benchmarking script per stage (outFile with '.py' replaced by
+    '.stageN.py') and a manifest of the stages and their dependencies
+    (outFile with '.py' replaced by '.stages.json').  See module stagesplit.
+
+    * outFile = name of the monolithic benchmarking script
+    * compressedList = statements before benchmarking markup
+    * benchLines = the same statements with benchmarking markup
+    * task_list, task_nums = names and numbers of the task calls
+    """
+    import stagesplit
+    # Suppressed calls have no effect on the data
+    statements = []
+    for line in compressedList:
+        if suppress_for_benchmark(line):
+            line = ' ' * indentation(line) + 'pass'
+        statements.append(line)
+    stages = stagesplit.split_stages( statements, casa_tasks )
+    tasks = dict( zip(task_nums, task_list) )
+    manifest = []
+    for stage in stages:
+        stageFile = outFile.replace('.py', '.stage' + str(stage.id) + '.py')
+        lines = [benchLines[i] for i in stage.statements]
+        found = set()
+        for line in lines:
+            for num in re.findall(r"casa_call\.Call\('[^']*','(\d+)'\)", line):
+                found.add( int(num) )
+        nums = [num for num in task_nums if num in found]
+        print "Writing stage " + str(stage.id) + " to " + stageFile
+        write_benchmark_script( stageFile, lines,
+                                [tasks[num] for num in nums], nums )
+        manifest.append( {'id': stage.id, 'script': stageFile,
+                          'depends_on': stage.depends_on, 'tasks': nums} )
+    stagesplit.write_manifest( outFile.replace('.py', '.stages.json'),
+                               outFile, manifest )
+
 # =====================
 # MAIN PROGRAM
 # =====================
@@ -591,46 +924,14 @@ def main( URL, options ):
         localFile = open( outFile , 'r' )
         responseLines = localFile.read().split("\n")
 
-    # Initialize the parser and output line list
-    readingCode = False
-    lineList = []
-
     if pyInput:
         lineList = responseLines
     else:
-        # Loop over the lines read from the web page
-        for line in responseLines:
-            # If we are not currently reading code, see if this line
-            # begins a python code block.
-            if (readingCode == False):
-                if beginBlock in line:
-                    readingCode = True
-                    outline = loseTheJunk(line)
-                    lineList += [outline]
-                    if endBlock in line:
-                        readingCode = False
-            else:
-                outline = loseTheJunk(line)
-                lineList += [outline]
-                if endBlock in line:
-                    readingCode = False
+        lineList = extract_code(responseLines)
                     
     # The python code is now loaded into a list of lines.  Now compress the
-    # lines into individual commands, allowing for commands to span multiple
-    # lines.  Lines are grouped by closed parentheses.
-    compressedList = []
-    iline = 0
-    while iline < len(lineList):
-        line = lineList[iline]
-        pcount = countParen(line)
-        while(pcount > 0):
-            line += '\n'
-            iline += 1
-            line += lineList[iline]
-            pcount = countParen(line)
-        line = string.expandtabs(line)
-        compressedList += [line]
-        iline += 1
+    # lines into individual commands.
+    compressedList = compress_lines(lineList)
 
     print str(len(lineList))+" total lines become"
     print str(len(compressedList))+" compressed lines"
@@ -646,42 +947,21 @@ def main( URL, options ):
 
     # Write script for benchmark mode
     if options.benchmark:
-        task_list = []
-        task_nums = []
         print "Writing file for execution in benchmarking mode."
-        tasknum = 0
-        f = codecs.open(outFile, 'w','utf-8')
         checkModules()
-        header = benchmark_header( scriptName = outFile )
-        for line in header:
-            print >>f, line
-        for line in compressedList:
-            if suppress_for_benchmark(line):
-                print >>f, ' ' * indentation(line) + 'pass #' + \
-                    line.replace('\n','')
-            else: 
-                line = suppress_gui(line)
-                if is_task_call(line):                
-                    this_task = extract_task(line)
-                    print "I found a task call for ", this_task                
-                    tasknum += 1
-                    line = add_benchmarking(line,tasknum)      
-                    task_list.append(this_task)
-                    task_nums.append(tasknum)
-                print >>f, line
-        print >>f, 'casa_call.summarize_bench( out_file, out_file+".summary" )'
-        f.close()        
-
-        # Write task list to expectation file
-        exp_file = outFile+'.expected'
-        print "I am writing the expected flow to a file called "+exp_file
-        f = codecs.open(exp_file, 'w','utf-8')
-        for i in range(len(task_list)):
-            print >>f, task_list[i], task_nums[i]
-        f.close()
+        benchLines, task_list, task_nums = benchmark_lines(compressedList,
+                                                           options.deferplots)
+        write_benchmark_script( outFile, benchLines, task_list, task_nums )
+        if options.stages:
+            write_stage_scripts( outFile, compressedList, benchLines,
+                                 task_list, task_nums )
     else:
         # Write script for interactive and noninteractive modes
         f = codecs.open(outFile, 'w','utf-8')
+        if options.noninteractive and not options.diagplotoff and \
+           not options.plotmsoff:
+            for line in noninteractive_header():
+                print >>f, line
         for line in compressedList:
             if options.diagplotoff:
                 print "Turning off diagnostic plots..."
@@ -719,6 +999,10 @@ a local file system path."""
         help="turn off all plotms commands")
     parser.add_option( '-d', '--diagplotoff', action="store_true",
         help="turn off diagnostic plots (plotms, plotcal, aU.plotbandpass, plotants, plotxy)" )
+    parser.add_option( '--deferplots', action="store_true", default=False,
+        help="queue diagnostic plots for plotqueue.py instead of suppressing them (benchmark mode only)" )
+    parser.add_option( '-s', '--stages', action="store_true", default=False,
+        help="also split the benchmark test into stages that can run concurrently (benchmark mode only)" )
     (options, args) = parser.parse_args()
     if len(args) != 1:
         parser.print_help()
@@ -0,0 +1,165 @@
+#!/bin/env python
+'''
+Host fingerprint for benchmark summaries.
+
+Collect, without starting any subprocess, what is needed to compare runs
+across hosts: host name, OS, CPU model and core counts, memory size, the
+file system and mount holding the working directory, the CASA version and
+the OpenMP and benchmarking environment.  casa_call.summarize_bench writes
+the result as a "Fingerprint:" line of JSON in every summary.
+'''
+
+import sys, os, os.path, time, json, socket, platform
+
+# Environment variables recorded in the fingerprint
+env_prefixes = ['OMP_', 'CASA_BENCH_']
+env_names = ['CASAPATH', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+def read_proc(fname):
+    """ Return the lines of *fname*, or an empty list if it is missing. """
+    try:
+        f = open(fname)
+    except IOError:
+        return []
+    lines = f.readlines()
+    f.close()
+    return lines
+
+def cpu_info():
+    """
+    Return a dictionary with the CPU model, number of logical CPUs and number
+    of physical cores (None where unknown).  The model is only taken from
+    /proc/cpuinfo: platform.processor runs uname -p on Linux.
+    """
+    model = None
+    logical = 0
+    cores = set()
+    physical_id = None
+    for line in read_proc("/proc/cpuinfo"):
+        if ":" not in line:
+            continue
+        key, value = [item.strip() for item in line.split(":", 1)]
+        if key == "processor":
+            logical += 1
+        elif key == "model name" and model == None:
+            model = value
+        elif key == "physical id":
+            physical_id = value
+        elif key == "core id":
+            cores.add( (physical_id, value) )
+    if logical == 0:
+        try:
+            logical = os.sysconf("SC_NPROCESSORS_ONLN")
+        except (ValueError, OSError, AttributeError):
+            logical = None
+    physical = len(cores) or None
+    return {'model': model, 'logical': logical, 'cores': physical}
+
+def mem_total():
+    """ Return the physical memory size in bytes, or None if unknown. """
+    for line in read_proc("/proc/meminfo"):
+        if line.startswith("MemTotal:"):
+            return int(line.split()[1]) * 1024
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def unescape_mount(field):
+    """ Undo the octal escapes (e.g. \\040 for space) of /proc/mounts. """
+    parts = field.split("\\")
+    result = parts[0]
+    for part in parts[1:]:
+        if len(part) >= 3 and part[:3].isdigit():
+            result += chr(int(part[:3], 8)) + part[3:]
+        else:
+            result += "\\" + part
+    return result
+
+def mount_of(path):
+    """
+    Return a dictionary with the mount point, file system type and device
+    holding *path* (all None if /proc/mounts is not available).
+    """
+    path = os.path.realpath(path)
+    best = {'mount': None, 'fstype': None, 'device': None}
+    for line in read_proc("/proc/mounts"):
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        mount = unescape_mount(fields[1])
+        inside = path == mount or mount == "/" or \
+            path.startswith(mount.rstrip("/") + "/")
+        if inside and (best['mount'] == None or
+                       len(mount) >= len(best['mount'])):
+            best = {'mount': mount, 'fstype': fields[2],
+                    'device': unescape_mount(fields[0])}
+    return best
+
+def casa_version():
+    """ Return the version of the CASA we run in, or None outside casapy. """
+    casa = getattr(sys.modules.get("__main__"), "casa", None)
+    if isinstance(casa, dict):
+        try:
+            return str(casa['build']['version'])
+        except (KeyError, TypeError):
+            pass
+    try:
+        import casadef
+    except ImportError:
+        return None
+    version = getattr(casadef, "casa_version", None)
+    revision = getattr(casadef, "subversion_revision", None)
+    if version != None and revision != None:
+        return str(version) + " r" + str(revision)
+    return version
+
+def environment():
+    """ Return the recorded environment variables as a dictionary. """
+    env = {}
+    for name in os.environ:
+        if name in env_names or \
+           [p for p in env_prefixes if name.startswith(p)]:
+            env[name] = os.environ[name]
+    return env
+
+def fingerprint(path=None):
+    """
+    Return the fingerprint of this host as a dictionary.
+
+    * path = directory whose file system is recorded; default the current
+      working directory
+    """
+    if path == None:
+        path = os.getcwd()
+    uname = os.uname()
+    return {'host': socket.gethostname(),
+            'system': uname[0], 'node': uname[1], 'release': uname[2],
+            'version': uname[3], 'machine': uname[4],
+            'python': platform.python_version(),
+            'cpu': cpu_info(), 'memory': mem_total(),
+            'cwd': os.path.abspath(path), 'filesystem': mount_of(path),
+            'casa': casa_version(), 'env': environment()}
+
+def uname_line(info):
+    """ Return the uname -a like line of fingerprint *info*. """
+    return " ".join( [info['system'], info['node'], info['release'],
+                      info['version'], info['machine']] )
+
+def date_line(when=None):
+    """ Return the time *when* (default now) formatted like date(1). """
+    return time.strftime("%a %b %d %H:%M:%S %Z %Y", time.localtime(when))
+
+def header_lines(info):
+    """ Return the summary header lines (with newlines) for *info*. """
+    return [date_line() + "\n", "\n",
+            uname_line(info) + "\n", "\n",
+            info['cwd'] + "\n", "\n",
+            "Fingerprint: " + json.dumps(info, sort_keys=True) + "\n"]
+
+def short_host(info):
+    """ Return the host name of *info* without its domain. """
+    return info['host'].split(".")[0]
+
+if __name__ == "__main__":
+    print json.dumps(fingerprint(), indent=1, sort_keys=True)
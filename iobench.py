@@ -0,0 +1,256 @@
+#!/bin/env python
+'''
+Storage I/O characterization of a benchmark data directory.
+
+Measure, in the directory a benchmark test runs in, the sequential and
+random read and write throughput and the latency of the metadata operations
+(create, stat and unlink of many small files) that dominate work on CASA
+tables.  The result is written as JSON to iobench.json in that directory;
+casa_call.summarize_bench copies it into the summary as a "Storage:" line so
+task times can be compared against the storage each run actually had.
+
+The page cache is dropped for the test file with posix_fadvise before each
+read pass where the C library provides it; otherwise reads may be served from
+memory and the result records "cache_dropped": false.
+'''
+
+import sys, os, os.path, time, json, random, shutil, tempfile, ctypes
+import ctypes.util
+from optparse import OptionParser
+import hostinfo
+
+# Name of the result file written to the measured directory
+result_file = "iobench.json"
+
+# posix_fadvise advice value that drops cached pages (Linux, BSD)
+POSIX_FADV_DONTNEED = 4
+
+_fadvise = None
+
+def fadvise_function():
+    """ Return the C library posix_fadvise function, or None. """
+    global _fadvise
+    if _fadvise == None:
+        _fadvise = False
+        name = ctypes.util.find_library("c")
+        if name != None:
+            try:
+                libc = ctypes.CDLL(name, use_errno=True)
+                _fadvise = libc.posix_fadvise
+                _fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong,
+                                     ctypes.c_longlong, ctypes.c_int]
+            except (OSError, AttributeError):
+                _fadvise = False
+    return _fadvise or None
+
+def drop_cache(fd):
+    """
+    Ask the kernel to drop the cached pages of open file *fd*. Return True if
+    the request was accepted.
+    """
+    fadvise = fadvise_function()
+    if fadvise == None:
+        return False
+    os.fsync(fd)
+    return fadvise(fd, 0, 0, POSIX_FADV_DONTNEED) == 0
+
+def rate(nbytes, seconds):
+    """ Return the throughput in MB/s. """
+    return nbytes / 1048576.0 / max(seconds, 1e-9)
+
+def sequential_write(fname, size, block):
+    """ Write *size* bytes to *fname* in *block* byte chunks. Return MB/s. """
+    data = os.urandom(block)
+    start = time.time()
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    written = 0
+    while written < size:
+        written += os.write(fd, data)
+    os.fsync(fd)
+    os.close(fd)
+    return rate(written, time.time() - start)
+
+def sequential_read(fname, block):
+    """
+    Read *fname* in *block* byte chunks. Return (MB/s, cache dropped).
+    """
+    fd = os.open(fname, os.O_RDONLY)
+    dropped = drop_cache(fd)
+    nread = 0
+    start = time.time()
+    while True:
+        data = os.read(fd, block)
+        if not data:
+            break
+        nread += len(data)
+    elapsed = time.time() - start
+    os.close(fd)
+    return rate(nread, elapsed), dropped
+
+def random_offsets(size, block, count, seed):
+    """ Return *count* random *block* aligned offsets within *size* bytes. """
+    rand = random.Random(seed)
+    nblocks = max(size / block, 1)
+    return [rand.randrange(nblocks) * block for i in range(count)]
+
+def random_read(fname, size, block, count):
+    """
+    Read *count* random blocks of *block* bytes from *fname*. Return
+    (operations per second, MB/s).
+    """
+    offsets = random_offsets(size, block, count, 1)
+    fd = os.open(fname, os.O_RDONLY)
+    drop_cache(fd)
+    start = time.time()
+    for offset in offsets:
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.read(fd, block)
+    elapsed = time.time() - start
+    os.close(fd)
+    return count / max(elapsed, 1e-9), rate(count * block, elapsed)
+
+def random_write(fname, size, block, count):
+    """
+    Write *count* random blocks of *block* bytes to *fname*, then fsync.
+    Return (operations per second, MB/s).
+    """
+    offsets = random_offsets(size, block, count, 2)
+    data = os.urandom(block)
+    fd = os.open(fname, os.O_WRONLY)
+    start = time.time()
+    for offset in offsets:
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, data)
+    os.fsync(fd)
+    elapsed = time.time() - start
+    os.close(fd)
+    return count / max(elapsed, 1e-9), rate(count * block, elapsed)
+
+def metadata_ops(directory, nfiles, file_size=512):
+    """
+    Create, stat and unlink *nfiles* files of *file_size* bytes in
+    *directory*. Return the mean latency of each operation in microseconds.
+    """
+    data = "x" * file_size
+    names = [os.path.join(directory, "f" + str(i)) for i in range(nfiles)]
+    start = time.time()
+    for name in names:
+        fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        os.write(fd, data)
+        os.close(fd)
+    create = time.time() - start
+    start = time.time()
+    for name in names:
+        os.stat(name)
+    stat = time.time() - start
+    start = time.time()
+    for name in names:
+        os.unlink(name)
+    unlink = time.time() - start
+    return {'create_us': 1e6 * create / nfiles,
+            'stat_us': 1e6 * stat / nfiles,
+            'unlink_us': 1e6 * unlink / nfiles}
+
+def measure(directory, size_mb=256, block_kb=1024, random_kb=64,
+            nrandom=2000, nfiles=2000):
+    """
+    Characterize the storage holding *directory*. Return the results as a
+    dictionary.
+
+    * size_mb = size of the sequential test file in MB
+    * block_kb = block size of sequential reads and writes in kB
+    * random_kb = block size of random reads and writes in kB
+    * nrandom = number of random reads and of random writes
+    * nfiles = number of small files for the metadata test
+    """
+    size = size_mb * 1048576
+    block = block_kb * 1024
+    rblock = random_kb * 1024
+    workdir = tempfile.mkdtemp(prefix=".iobench", dir=directory)
+    try:
+        fname = os.path.join(workdir, "sequential.dat")
+        result = {'directory': os.path.abspath(directory),
+                  'filesystem': hostinfo.mount_of(directory),
+                  'time': time.time(), 'size_mb': size_mb,
+                  'block_kb': block_kb, 'random_kb': random_kb}
+        result['seq_write_MBps'] = sequential_write(fname, size, block)
+        result['seq_read_MBps'], result['cache_dropped'] = \
+            sequential_read(fname, block)
+        result['rand_read_iops'], result['rand_read_MBps'] = \
+            random_read(fname, size, rblock, nrandom)
+        result['rand_write_iops'], result['rand_write_MBps'] = \
+            random_write(fname, size, rblock, nrandom)
+        os.remove(fname)
+        result.update( metadata_ops(workdir, nfiles) )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+def read_result(directory="."):
+    """ Return the result stored in *directory*, or None if there is none. """
+    fname = os.path.join(directory, result_file)
+    if not os.path.exists(fname):
+        return None
+    f = open(fname)
+    try:
+        return json.load(f)
+    except ValueError:
+        return None
+    finally:
+        f.close()
+
+def write_result(result, directory="."):
+    """ Store *result* in *directory*. """
+    f = open(os.path.join(directory, result_file), "w")
+    json.dump(result, f, indent=1, sort_keys=True)
+    f.close()
+
+def summary_line(result):
+    """ Return the "Storage:" summary line (with newline) for *result*. """
+    return "Storage: " + json.dumps(result, sort_keys=True) + "\n"
+
+def print_result(result):
+    """ Print *result* as a short table. """
+    fs = result['filesystem']
+    print "Directory: " + result['directory'] + " (" + str(fs['fstype']) + \
+        " on " + str(fs['mount']) + ")"
+    print "Sequential write: %8.1f MB/s" % result['seq_write_MBps']
+    print "Sequential read:  %8.1f MB/s" % result['seq_read_MBps'],
+    if not result['cache_dropped']:
+        print "(page cache not dropped)",
+    print
+    print "Random read:      %8.1f op/s %8.1f MB/s" % \
+        (result['rand_read_iops'], result['rand_read_MBps'])
+    print "Random write:     %8.1f op/s %8.1f MB/s" % \
+        (result['rand_write_iops'], result['rand_write_MBps'])
+    print "Create/stat/unlink: %.1f / %.1f / %.1f us" % \
+        (result['create_us'], result['stat_us'], result['unlink_us'])
+
+if __name__ == "__main__":
+    usage = """ %prog [options] [directory]
+
+    Measure the storage holding directory (default: the current directory)
+    and write the result to directory/""" + result_file + "."
+    parser = OptionParser( usage=usage )
+    parser.add_option( '-s', '--size', type="int", default=256,
+        help="sequential test file size in MB" )
+    parser.add_option( '-b', '--block', type="int", default=1024,
+        help="sequential block size in kB" )
+    parser.add_option( '-r', '--random-block', type="int", default=64,
+        help="random access block size in kB" )
+    parser.add_option( '-n', '--nrandom', type="int", default=2000,
+        help="number of random reads and of random writes" )
+    parser.add_option( '-f', '--nfiles', type="int", default=2000,
+        help="number of small files for the metadata test" )
+    (options, args) = parser.parse_args()
+    if len(args) > 1:
+        parser.print_help()
+        sys.exit(1)
+    directory = "."
+    if len(args) == 1:
+        directory = args[0]
+    result = measure(directory, size_mb=options.size, block_kb=options.block,
+        random_kb=options.random_block, nrandom=options.nrandom,
+        nfiles=options.nfiles)
+    write_result(result, directory)
+    print_result(result)
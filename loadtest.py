@@ -0,0 +1,231 @@
+#!/bin/env python
+'''
+Shared-storage contention load test.
+
+Run N replicas of a benchmark script at the same time, each in its own copy
+of the data set on the same filesystem, for a ramp of N (e.g. 1, 2, 4, 8).
+The copies are made next to the prepared data directory as
+<data directory>.replicaK and made again before every level (see
+runner.reset_data), so that every replica of every level starts from the
+same data as the single-replica baseline.  For every level of the ramp the
+test reports
+
+* the slowdown of each task: its mean time over the replicas divided by its
+  time when one replica runs alone
+* the aggregate throughput: replicas finished per hour and MB of data set
+  processed per second, and the efficiency, the throughput relative to N
+  times that of one replica
+
+The knee is the last level before the throughput grows by less than a given
+share (option -g) from one level to the next; more concurrent reductions
+than that only queue on the storage.  The number of replicas and the replica
+number are passed to the script in the environment variables
+CASA_BENCH_REPLICAS and CASA_BENCH_REPLICA and recorded in the "Run mode:"
+summary line.
+
+Offline, replay.py -m io makes the fake tasks write and read back data in
+the replica directory, so the storage tiers can be compared without casapy:
+
+    $ loadtest.py -l 1,2,4,8 -c "$PWD/replay.py -m io -t 2 -b 64" myScript.py
+'''
+
+import sys, os, os.path, time, json, shlex, subprocess
+from optparse import OptionParser
+import casa_call
+import replay
+import runner
+
+def replica_dir(source, k):
+    """ Return the directory of replica *k* of data directory *source*. """
+    source = os.path.abspath(source).rstrip("/")
+    return source + ".replica" + str(k)
+
+def data_size(directory):
+    """ Return the bytes in the regular files below *directory*. """
+    return sum([os.path.getsize(path)
+                for path in runner.data_files(directory)])
+
+def prepare_replicas(source, count, script):
+    """
+    Make *count* fresh copies of data directory *source*, leaving out the
+    results of earlier runs of *script*. Return the list of directories.
+    """
+    return [runner.reset_data(source, replica_dir(source, k), script)
+            for k in range(1, count + 1)]
+
+def run_level(command, script, dirs, verbose=True):
+    """
+    Run *script* with *command* in every directory of *dirs* at the same
+    time. Return a dictionary with the wall time of the level and, per
+    replica, the exit status, wall time and per-task totals.
+    """
+    processes = []
+    start = time.time()
+    for k, directory in enumerate(dirs):
+        env = dict(os.environ)
+        env["CASA_BENCH_REPLICAS"] = str(len(dirs))
+        env["CASA_BENCH_REPLICA"] = str(k + 1)
+        processes.append( subprocess.Popen(shlex.split(command) + [script],
+                                           env=env, cwd=directory) )
+    replicas = [None] * len(dirs)
+    while None in replicas:
+        for k, process in enumerate(processes):
+            if replicas[k] == None and process.poll() != None:
+                replicas[k] = {'replica': k + 1, 'status': process.returncode,
+                               'wall': time.time() - start}
+        time.sleep(0.1)
+    wall = time.time() - start
+    for k, directory in enumerate(dirs):
+        bench = os.path.join(directory, replay.bench_file_name(script))
+        replicas[k]['totals'] = {}
+        if os.path.exists(bench):
+            replicas[k]['totals'] = runner.task_totals(
+                casa_call.read_bench(bench) )
+    if verbose:
+        failed = len([r for r in replicas if r['status'] != 0])
+        print >> sys.stderr, "loadtest: %d replica(s) in %.1f s" % \
+            (len(dirs), wall) + (failed and ", %d failed" % failed or "")
+    return {'replicas': len(dirs), 'wall': wall, 'runs': replicas}
+
+def task_means(level):
+    """
+    Return a dictionary task -> mean time over the successful replicas of
+    *level* (see run_level).
+    """
+    samples = {}
+    for run in level['runs']:
+        if run['status'] != 0:
+            continue
+        for task, total in run['totals'].items():
+            samples.setdefault(task, []).append(total)
+    return dict([(task, sum(values) / len(values))
+                 for task, values in samples.items()])
+
+def analyze(levels, size):
+    """
+    Add the task means and slowdowns against the first level and the
+    throughput and efficiency to every level of *levels*.  *size* is the
+    data set size in bytes.
+    """
+    baseline = None
+    for level in levels:
+        level['tasks'] = task_means(level)
+        done = len([run for run in level['runs'] if run['status'] == 0])
+        level['completed'] = done
+        level['runs_per_hour'] = 3600.0 * done / max(level['wall'], 1e-9)
+        level['mb_per_s'] = done * size / 1048576.0 / max(level['wall'], 1e-9)
+        if baseline == None:
+            baseline = level
+        level['slowdown'] = {}
+        for task, mean in level['tasks'].items():
+            base = baseline['tasks'].get(task)
+            if base:
+                level['slowdown'][task] = mean / base
+        level['efficiency'] = None
+        if baseline['runs_per_hour'] > 0:
+            level['efficiency'] = level['runs_per_hour'] / \
+                (level['replicas'] * baseline['runs_per_hour'])
+
+def find_knee(levels, gain=0.1):
+    """
+    Return the number of replicas of the last level of *levels* before the
+    throughput grows by less than *gain* (a share) to the next level; the
+    highest level if it never does, None without levels.
+    """
+    if not levels:
+        return None
+    for previous, level in zip(levels[:-1], levels[1:]):
+        if level['runs_per_hour'] < previous['runs_per_hour'] * (1.0 + gain):
+            return previous['replicas']
+    return levels[-1]['replicas']
+
+def max_slowdown(level):
+    """ Return the largest task slowdown of *level*, or 1. """
+    return max(level['slowdown'].values() or [1.0])
+
+def run_ramp(script, command, source, counts, limit=None, verbose=True):
+    """
+    Run the ramp of replica numbers *counts* of *script* on copies of
+    *source*. Return (data set size in bytes, list of levels (see run_level
+    and analyze)).
+
+    * limit = stop the ramp after a level where a task slowed down more than
+      this factor, or None
+    """
+    size = data_size(source)
+    levels = []
+    for count in counts:
+        dirs = prepare_replicas(source, count, script)
+        levels.append( run_level(command, os.path.basename(script), dirs,
+                                 verbose) )
+        analyze(levels, size)
+        if limit != None and max_slowdown(levels[-1]) > limit:
+            if verbose:
+                print >> sys.stderr, "loadtest: slowdown limit reached"
+            break
+    return size, levels
+
+def print_tables(levels, knee):
+    """ Print the throughput of each level and the per-task slowdowns. """
+    print "%8s %9s %9s %9s %10s %9s" % ("Replicas", "Done", "Wall",
+        "Runs/h", "MB/s", "Effic.")
+    for level in levels:
+        efficiency = level['efficiency']
+        print "%8d %9d %9.1f %9.2f %10.1f %9s" % (level['replicas'],
+            level['completed'], level['wall'], level['runs_per_hour'],
+            level['mb_per_s'],
+            efficiency == None and "-" or "%.2f" % efficiency)
+    print
+    tasks = sorted(levels[0]['tasks'].keys(),
+                   key=lambda task: -levels[0]['tasks'][task])
+    print "%-20s %9s" % ("Task", "Base") + \
+        "".join(["%8sx" % ("%d" % level['replicas']) for level in levels])
+    for task in tasks:
+        row = "%-20s %9.2f" % (task, levels[0]['tasks'][task])
+        for level in levels:
+            if task in level['slowdown']:
+                row += "%9.2f" % level['slowdown'][task]
+            else:
+                row += "%9s" % "-"
+        print row
+    print
+    print "Knee: " + str(knee) + " concurrent replica(s)"
+
+if __name__ == "__main__":
+    usage = """ %prog [options] SCRIPT
+
+    Run benchmark SCRIPT (written by 'extractCASAscript.py -b') in several
+    copies of the data set in the current directory, the prepared data
+    directory, at the same time, ramping up the number of copies, and report
+    the per-task slowdown and the aggregate throughput.  The results are
+    written to SCRIPT.loadtest.json."""
+    parser = OptionParser( usage=usage )
+    parser.add_option( '-l', '--levels', default="1,2,4,8",
+        help="comma separated numbers of concurrent replicas " + \
+             "[default: %default]" )
+    parser.add_option( '-c', '--command',
+        default="casapy --nologger --nogui -c",
+        help="command that runs a script [default: %default]" )
+    parser.add_option( '-g', '--gain', type="float", default=0.1,
+        help="throughput growth per level below which the knee is " + \
+             "reached [default: %default]" )
+    parser.add_option( '-s', '--max-slowdown', type="float", default=None,
+        help="stop the ramp once a task is this many times slower" )
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    counts = sorted(set([int(n) for n in options.levels.split(",")]))
+    if counts[0] != 1:
+        counts.insert(0, 1)
+    size, levels = run_ramp(args[0], options.command, ".", counts,
+                            options.max_slowdown)
+    knee = find_knee(levels, options.gain)
+    print_tables(levels, knee)
+    f = open(args[0] + ".loadtest.json", "w")
+    json.dump({'script': args[0], 'command': options.command,
+               'data_bytes': size, 'gain': options.gain,
+               'knee': knee, 'levels': levels}, f, indent=1, sort_keys=True)
+    f.close()
+    if [level for level in levels if level['completed'] < level['replicas']]:
+        sys.exit(1)
@@ -0,0 +1,280 @@
+#!/bin/env python
+'''
+Micro-benchmarks for the script extractor and the reporting tools.
+
+Time the hot paths of extractCASAscript.py, casa_call.py and
+report.py on synthetic inputs of increasing size: CASA-Guide-shaped HTML,
+benchmark files and summary files.  The time a fresh interpreter takes to
+import casa_call (done in casapy before any timing starts) and casa_summary
+is measured as well.  Results are written as JSON so that the
+output of a later run can be compared with an earlier one (option -c).
+'''
+
+import sys, os, os.path, time, json, random, shutil, tempfile, platform
+import subprocess
+from optparse import OptionParser
+import extractCASAscript
+import casa_call
+import casa_summary
+import report
+
+# Input sizes used by default (number of statements, records or runs)
+default_sizes = [100, 1000, 10000]
+
+# Modules whose import time is measured
+import_modules = ['casa_call', 'casa_summary']
+
+# Script run by a fresh interpreter to time one import
+import_script = """import sys, time
+before = len(sys.modules)
+start = time.time()
+import %s
+print time.time() - start, len(sys.modules) - before
+"""
+
+# Tasks used to build synthetic inputs
+synthetic_tasks = ['importasdm', 'listobs', 'flagdata', 'gaincal', 'bandpass',
+    'applycal', 'split', 'clean', 'imstat', 'plotms', 'plotcal']
+
+class ReportOptions:
+    """ Stand-in for the report.py command line options object. """
+    header = False
+    csv = False
+    exclude = False
+    threshold = None
+
+class NullStream:
+    """ File-like object that discards everything written to it. """
+    def write(self, text):
+        pass
+
+def synthetic_statement(i):
+    """ Return the Python source of synthetic statement number *i*. """
+    task = synthetic_tasks[i % len(synthetic_tasks)]
+    if i % 5 == 0:
+        return ["vis_" + str(i) + " = 'uid___A002_X" + str(i) + ".ms'"]
+    if i % 7 == 0:
+        return ["os.system('rm -rf cal_" + str(i) + ".G')"]
+    return [task + "(vis = 'uid___A002_X" + str(i) + ".ms',",
+            "    field = '" + str(i % 3) + "', spw = '0,1,2,3',",
+            "    interactive = True)"]
+
+def synthetic_html(nstatements, per_block=10):
+    """
+    Return a list of lines shaped like a CASA Guide web page holding
+    *nstatements* Python statements in blocks of *per_block*.
+    """
+    lines = ['<html><body>', '<p>Some prose about the data set.</p>']
+    for i in range(nstatements):
+        if i % per_block == 0:
+            if i > 0:
+                lines[-1] += extractCASAscript.endBlock
+                lines.append('<p>Some prose between code blocks.</p>')
+            prefix = '<div dir="ltr" class="mw-geshi mw-code mw-content-ltr">' + \
+                '<div class="python source-python"><pre class="de1">'
+        else:
+            prefix = ''
+        for line in synthetic_statement(i):
+            line = line.replace('(', '&#40;').replace(')', '&#41;')
+            line = line.replace("'", '&quot;').replace(' ', '&#160;', 1)
+            line = '<span class="kw1">' + line + '</span>'
+            lines.append(prefix + line)
+            prefix = ''
+    lines[-1] += extractCASAscript.endBlock
+    lines.append('</body></html>')
+    return lines
+
+def synthetic_code(nstatements):
+    """ Return *nstatements* synthetic statements as lines of Python. """
+    lines = []
+    for i in range(nstatements):
+        lines += synthetic_statement(i)
+    return lines
+
+def write_bench_file(fname, nrecords):
+    """ Write a benchmark file holding *nrecords* logged calls. """
+    rand = random.Random(nrecords)
+    now = 1.4e9
+    f = open(fname, 'w')
+    for i in range(nrecords):
+        this_call = casa_call.Call( synthetic_tasks[i % len(synthetic_tasks)],
+            str(i), begin=False )
+        delta = rand.expovariate(0.1)
+        this_call.begin(user_time=now)
+        this_call.end(user_time=now + delta)
+        f.write(this_call.to_string())
+        now += delta + rand.random()
+    f.close()
+
+def write_summary_files(directory, nruns, nguides=4):
+    """
+    Write *nguides* summary files holding *nruns* appended summaries in total
+    to *directory*. Return the glob pattern that matches them.
+    """
+    rand = random.Random(nruns)
+    for g in range(nguides):
+        f = open(os.path.join(directory, 'guide' + str(g) + '.summary'), 'w')
+        for r in range(nruns / nguides):
+            f.write("Summary of file guide" + str(g) + ".benchmark.txt\n")
+            f.write("Mon Jan  1 00:00:00 UTC 2014\n\n")
+            f.write("Linux host" + str(g) + ".example.edu 2.6.32 x86_64\n\n")
+            f.write("/export/raid0/benchmark\n\n\n")
+            f.write("Total time: " + str(rand.uniform(1e3, 1e4)) + " (1 hr)\n")
+            for task in synthetic_tasks:
+                f.write(task + " 1 10.0 10.0\n")
+            f.write("\n")
+        f.close()
+    return os.path.join(directory, '*.summary')
+
+def time_it(func, repeat):
+    """
+    Call *func* *repeat* times. Return a dictionary with the best and mean
+    wall time in seconds.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return {'best': min(times), 'mean': sum(times) / len(times),
+            'repeat': repeat}
+
+def bench_extractor(size, repeat):
+    """ Time the extractor passes on *size* synthetic statements. """
+    results = {}
+    html = synthetic_html(size)
+    results['loseTheJunk'] = time_it(
+        lambda: [extractCASAscript.loseTheJunk(line) for line in html], repeat)
+    results['extract_code'] = time_it(
+        lambda: extractCASAscript.extract_code(html), repeat)
+    code = synthetic_code(size)
+    results['compress_lines'] = time_it(
+        lambda: extractCASAscript.compress_lines(code), repeat)
+    statements = extractCASAscript.compress_lines(code)
+    def transforms():
+        tasknum = 0
+        for line in statements:
+            line = extractCASAscript.pythonize_shell_commands(line)
+            line = extractCASAscript.make_noninteractive(line)
+            if extractCASAscript.suppress_for_benchmark(line):
+                continue
+            line = extractCASAscript.suppress_gui(line)
+            if extractCASAscript.is_task_call(line):
+                tasknum += 1
+                line = extractCASAscript.add_benchmarking(line, tasknum)
+    results['transforms'] = time_it(transforms, repeat)
+    return results
+
+def bench_reporting(size, repeat, workdir):
+    """ Time reading and summarizing a benchmark file of *size* records. """
+    results = {}
+    bench = os.path.join(workdir, 'synthetic.benchmark.txt')
+    write_bench_file(bench, size)
+    stdout = sys.stdout
+    sys.stdout = NullStream()
+    try:
+        results['read_bench'] = time_it(
+            lambda: casa_call.read_bench(bench), repeat)
+        results['summarize_bench'] = time_it(
+            lambda: casa_summary.summarize_bench(bench, bench + '.summary'),
+            repeat)
+        pattern = write_summary_files(workdir, size)
+        results['make_report'] = time_it(
+            lambda: report.make_report(ReportOptions(), globPattern=pattern),
+            repeat)
+    finally:
+        sys.stdout = stdout
+    return results
+
+def time_import(module, repeat):
+    """
+    Import *module* in *repeat* fresh interpreters. Return a dictionary with
+    the best and mean wall time in seconds and the number of modules the
+    import loaded.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.abspath(__file__)) + \
+        os.pathsep + env.get('PYTHONPATH', '')
+    times = []
+    for i in range(repeat):
+        process = subprocess.Popen([sys.executable, '-c',
+                                    import_script % module],
+                                   env=env, stdout=subprocess.PIPE)
+        seconds, modules = process.communicate()[0].split()
+        times.append(float(seconds))
+    return {'best': min(times), 'mean': sum(times) / len(times),
+            'repeat': repeat, 'modules': int(modules)}
+
+def bench_imports(repeat):
+    """ Time the import of each module of import_modules. """
+    results = {}
+    for module in import_modules:
+        results['import ' + module] = time_import(module, repeat)
+    return results
+
+def run_suite(sizes, repeat):
+    """ Run all micro-benchmarks. Return the JSON-serializable results. """
+    workdir = tempfile.mkdtemp(prefix='microbench')
+    results = []
+    timings = bench_imports(repeat)
+    for name in sorted(timings.keys()):
+        entry = {'name': name, 'size': 0}
+        entry.update(timings[name])
+        results.append(entry)
+    try:
+        for size in sizes:
+            timings = bench_extractor(size, repeat)
+            timings.update( bench_reporting(size, repeat, workdir) )
+            for name in sorted(timings.keys()):
+                entry = {'name': name, 'size': size}
+                entry.update(timings[name])
+                results.append(entry)
+    finally:
+        shutil.rmtree(workdir)
+    meta = {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'host': platform.node(), 'python': platform.python_version()}
+    return {'meta': meta, 'results': results}
+
+def print_results(suite, baseline=None):
+    """ Print a table of *suite* results, with ratios against *baseline*. """
+    old = {}
+    if baseline is not None:
+        for entry in baseline['results']:
+            old[(entry['name'], entry['size'])] = entry['best']
+    print "%-20s %8s %12s %12s %8s" % ('Benchmark', 'Size', 'Best (s)',
+                                       'Mean (s)', 'Ratio')
+    for entry in suite['results']:
+        ratio = ''
+        key = (entry['name'], entry['size'])
+        if key in old and old[key] > 0:
+            ratio = "%8.2f" % (entry['best'] / old[key])
+        print "%-20s %8d %12.6f %12.6f %8s" % (entry['name'], entry['size'],
+            entry['best'], entry['mean'], ratio)
+
+if __name__ == "__main__":
+    usage = """ %prog [options]
+
+    Run the micro-benchmark suite and write the results as JSON."""
+    parser = OptionParser( usage=usage )
+    parser.add_option( '-s', '--sizes', default=None,
+        help="comma separated input sizes (default: 100,1000,10000)" )
+    parser.add_option( '-r', '--repeat', type="int", default=3,
+        help="repetitions per measurement; the best is reported" )
+    parser.add_option( '-o', '--output', default='microbench.json',
+        help="JSON output file" )
+    parser.add_option( '-c', '--compare', default=None, metavar="FILE",
+        help="JSON output of an earlier run to compare against" )
+    (options, args) = parser.parse_args()
+    sizes = default_sizes
+    if options.sizes:
+        sizes = [int(size) for size in options.sizes.split(',')]
+    suite = run_suite(sizes, options.repeat)
+    f = open(options.output, 'w')
+    json.dump(suite, f, indent=1, sort_keys=True)
+    f.close()
+    baseline = None
+    if options.compare:
+        f = open(options.compare)
+        baseline = json.load(f)
+        f.close()
+    print_results(suite, baseline)
@@ -0,0 +1,269 @@
+#!/bin/env python
+'''
+Background system-noise monitor for benchmark runs.
+
+Sample, at a fixed interval while a benchmark runs, the load average, the
+CPU time split from /proc/stat (including iowait and steal), memory pressure
+and the processes outside the benchmark that use the most CPU.  Samples are
+appended as JSON lines to <benchmark file>.noise.  casa_call.start_run starts
+the monitor when the environment variable CASA_BENCH_NOISEMON is set to the
+sampling interval in seconds, and summarize_bench writes the contamination
+score of the run to the summary; report.py shows it and can leave flagged
+runs out of the averages.
+
+The contamination score is the mean over samples of the fraction of the
+machine used by other processes plus the steal fraction plus the memory
+pressure (fraction of time stalled on memory).  Runs scoring above
+score_threshold are flagged.
+'''
+
+import sys, os, os.path, time, json
+from optparse import OptionParser
+
+# Runs with a contamination score above this are flagged
+score_threshold = 0.1
+
+# Number of other processes recorded per sample
+ntop = 3
+
+# Order of the CPU time fields of /proc/stat
+cpu_fields = ['user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq',
+              'steal']
+
+def read_first_line(fname):
+    """ Return the first line of *fname*, or None if it cannot be read. """
+    try:
+        f = open(fname)
+    except IOError:
+        return None
+    try:
+        return f.readline()
+    except IOError:
+        return None
+    finally:
+        f.close()
+
+def cpu_times():
+    """ Return the aggregate CPU times of /proc/stat as a dictionary. """
+    line = read_first_line("/proc/stat")
+    if line == None or not line.startswith("cpu "):
+        return None
+    values = [int(value) for value in line.split()[1:]]
+    values += [0] * (len(cpu_fields) - len(values))
+    return dict(zip(cpu_fields, values))
+
+def cpu_count():
+    """ Return the number of online CPUs. """
+    try:
+        return os.sysconf("SC_NPROCESSORS_ONLN")
+    except (ValueError, OSError, AttributeError):
+        return 1
+
+def load_average():
+    """ Return the 1 minute load average, or None. """
+    line = read_first_line("/proc/loadavg")
+    if line == None:
+        return None
+    return float(line.split()[0])
+
+def memory():
+    """
+    Return (fraction of memory available, memory pressure) where pressure is
+    the 10 s average fraction of time some task stalled on memory (None if
+    the kernel has no pressure stall information).
+    """
+    available = None
+    total = None
+    try:
+        f = open("/proc/meminfo")
+        for line in f:
+            if line.startswith("MemTotal:"):
+                total = float(line.split()[1])
+            elif line.startswith("MemAvailable:"):
+                available = float(line.split()[1])
+        f.close()
+    except IOError:
+        pass
+    fraction = None
+    if total and available != None:
+        fraction = available / total
+    pressure = None
+    line = read_first_line("/proc/pressure/memory")
+    if line != None and line.startswith("some"):
+        for item in line.split()[1:]:
+            if item.startswith("avg10="):
+                pressure = float(item[6:]) / 100.0
+    return fraction, pressure
+
+def process_times():
+    """
+    Return a dictionary pid -> (ppid, name, cpu seconds) of all processes.
+    """
+    ticks = float(os.sysconf("SC_CLK_TCK"))
+    procs = {}
+    try:
+        pids = [int(name) for name in os.listdir("/proc") if name.isdigit()]
+    except OSError:
+        return procs
+    for pid in pids:
+        line = read_first_line("/proc/" + str(pid) + "/stat")
+        if line == None or ")" not in line:
+            continue
+        name = line[line.find("(") + 1:line.rfind(")")]
+        fields = line[line.rfind(")") + 2:].split()
+        procs[pid] = (int(fields[1]), name,
+                      (int(fields[11]) + int(fields[12])) / ticks)
+    return procs
+
+def descendants(procs, roots):
+    """ Return the set of *roots* and all their descendants in *procs*. """
+    tree = set(roots)
+    added = True
+    while added:
+        added = False
+        for pid in procs:
+            if pid not in tree and procs[pid][0] in tree:
+                tree.add(pid)
+                added = True
+    return tree
+
+class Sampler:
+    """
+    Take noise samples of the machine running process *pid*; the process,
+    its descendants and the sampler itself count as the benchmark.
+    """
+    def __init__(self, pid):
+        self.pid = pid
+        self.ncpu = cpu_count()
+        self.last_time = time.time()
+        self.last_cpu = cpu_times()
+        self.last_procs = process_times()
+
+    def sample(self):
+        """ Return a sample covering the time since the previous one. """
+        now = time.time()
+        cpu = cpu_times()
+        procs = process_times()
+        elapsed = max(now - self.last_time, 1e-3)
+        sample = {'time': now, 'load1': load_average(), 'ncpu': self.ncpu}
+        if cpu != None and self.last_cpu != None:
+            diff = dict([(key, cpu[key] - self.last_cpu[key])
+                         for key in cpu_fields])
+            total = float(sum(diff.values())) or 1.0
+            for key in ['user', 'system', 'idle', 'iowait', 'steal']:
+                sample[key] = diff[key] / total
+        own = descendants(procs, [self.pid, os.getpid()])
+        others = []
+        for pid in procs:
+            if pid in own or pid not in self.last_procs:
+                continue
+            used = (procs[pid][2] - self.last_procs[pid][2]) / elapsed
+            if used > 0:
+                others.append( (used, procs[pid][1], pid) )
+        others.sort(reverse=True)
+        sample['other_cpu'] = sum([item[0] for item in others])
+        sample['top'] = [[name, pid, round(share, 3)]
+                         for share, name, pid in others[:ntop]]
+        sample['mem_available'], sample['mem_pressure'] = memory()
+        sample['score'] = sample_score(sample)
+        self.last_time = now
+        self.last_cpu = cpu
+        self.last_procs = procs
+        return sample
+
+def sample_score(sample):
+    """ Return the contamination score of one sample. """
+    score = sample['other_cpu'] / max(sample['ncpu'], 1)
+    score += sample.get('steal') or 0.0
+    score += sample.get('mem_pressure') or 0.0
+    return score
+
+def alive(pid):
+    """ Tests if process *pid* exists. """
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def monitor(pid, out_file, interval=5.0):
+    """
+    Append samples to *out_file* every *interval* seconds until process *pid*
+    exits.
+    """
+    sampler = Sampler(pid)
+    while True:
+        time.sleep(interval)
+        if not alive(pid):
+            break
+        f = open(out_file, "a")
+        f.write( json.dumps(sampler.sample(), sort_keys=True) + "\n" )
+        f.close()
+
+def read_samples(noise_file):
+    """ Return the samples in *noise_file*. """
+    samples = []
+    f = open(noise_file)
+    for line in f:
+        try:
+            samples.append( json.loads(line) )
+        except ValueError:
+            pass
+    f.close()
+    return samples
+
+def mean(values):
+    values = [value for value in values if value != None]
+    if len(values) == 0:
+        return None
+    return sum(values) / float(len(values))
+
+def summarize(samples, threshold=None):
+    """
+    Return a dictionary with the contamination score of a run, whether it is
+    flagged, and the mean load, iowait, steal and memory pressure.
+    """
+    if threshold == None:
+        threshold = score_threshold
+    score = mean([sample['score'] for sample in samples]) or 0.0
+    consumers = {}
+    for sample in samples:
+        for name, pid, used in sample['top']:
+            consumers[name] = consumers.get(name, 0.0) + used / len(samples)
+    top = sorted(consumers.items(), key=lambda item: -item[1])[:ntop]
+    return {'score': score, 'flagged': score > threshold,
+            'threshold': threshold, 'samples': len(samples),
+            'load1': mean([s.get('load1') for s in samples]),
+            'iowait': mean([s.get('iowait') for s in samples]),
+            'steal': mean([s.get('steal') for s in samples]),
+            'mem_pressure': mean([s.get('mem_pressure') for s in samples]),
+            'top': [[name, round(used, 3)] for name, used in top]}
+
+def summary_line(summary):
+    """ Return the "Noise:" summary line (with newline) for *summary*. """
+    return "Noise: " + json.dumps(summary, sort_keys=True) + "\n"
+
+if __name__ == "__main__":
+    usage = """ %prog [options] OUTFILE
+
+    Append noise samples to OUTFILE until the monitored process exits.
+    With option -s, print the summary of the samples in OUTFILE instead."""
+    parser = OptionParser( usage=usage )
+    parser.add_option( '-p', '--pid', type="int", default=None,
+        help="process to monitor (default: the parent process)" )
+    parser.add_option( '-i', '--interval', type="float", default=5.0,
+        help="seconds between samples" )
+    parser.add_option( '-s', '--summarize', action="store_true",
+        default=False, help="summarize OUTFILE and exit" )
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    if options.summarize:
+        print json.dumps(summarize(read_samples(args[0])), indent=1,
+                         sort_keys=True)
+    else:
+        pid = options.pid
+        if pid == None:
+            pid = os.getppid()
+        monitor(pid, args[0], options.interval)
@@ -0,0 +1,232 @@
+#!/bin/env python
+'''
+OpenMetrics (Prometheus text format) exporter of benchmark results.
+
+Turn the statistics of a benchmark run into a metrics file that the textfile
+collector of a node exporter can scrape:
+
+* casa_bench_task_duration_seconds = histogram of the call durations of
+  each task
+* casa_bench_total_seconds, casa_bench_logged_seconds,
+  casa_bench_unlogged_seconds = wall time of the run, inside and outside the
+  logged calls
+* casa_bench_calls = number of logged calls
+* casa_bench_run_timestamp_seconds = start of the run
+* casa_bench_timeouts = task calls aborted by the watchdog
+* casa_bench_noise_score = contamination score, if the noise was monitored
+* casa_bench_run_info = 1, with the run metadata as labels
+
+Every metric is labelled with the guide, host and CASA version.  The file is
+<directory>/casa_bench_<guide>.prom; it is written to a temporary file and
+renamed, so the collector never reads half a file.  casa_call.summarize_bench
+exports each run when the environment variable CASA_BENCH_TEXTFILE_DIR names
+the collector's directory.
+'''
+
+import sys, os, os.path, json, re
+from optparse import OptionParser
+import runarchive
+
+# Upper bounds (seconds) of the task duration histogram buckets
+duration_buckets = [1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600,
+                    7200, 14400]
+
+def escape(value):
+    """ Return label value *value* escaped for the text format. """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n")
+
+def label_string(labels):
+    """ Return *labels* (a dictionary) as '{name="value",...}'. """
+    if not labels:
+        return ""
+    return "{" + ",".join(['%s="%s"' % (name, escape(labels[name]))
+                           for name in sorted(labels.keys())]) + "}"
+
+def format_value(value):
+    if isinstance(value, (int, long)):
+        return str(value)
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+class MetricFamily:
+    """ The samples of one metric, with its help text and type. """
+    def __init__(self, name, kind, help):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.samples = []
+
+    def add(self, value, labels={}, suffix=""):
+        self.samples.append( (self.name + suffix, dict(labels), value) )
+
+    def lines(self):
+        lines = ["# HELP " + self.name + " " + self.help,
+                 "# TYPE " + self.name + " " + self.kind]
+        for name, labels, value in self.samples:
+            lines.append(name + label_string(labels) + " " +
+                         format_value(value))
+        return lines
+
+def add_histogram(family, stats, labels, buckets=duration_buckets):
+    """
+    Add the bucket, count and sum samples of *stats* (a
+    streamstats.TaskStats) to *family*.  Bucket counts are estimated from
+    the quantile sketch of *stats*.
+    """
+    for bound in list(buckets) + [float("inf")]:
+        bucket = dict(labels)
+        bucket['le'] = format_value(float(bound))
+        family.add(stats.count_below(bound), bucket, "_bucket")
+    family.add(stats.count, labels, "_count")
+    family.add(stats.total, labels, "_sum")
+
+def run_metrics(out_file, stats, info, noise=None, timeouts=0):
+    """
+    Return the metric families of a run.
+
+    * out_file = benchmarking file of the run
+    * stats = streamstats.RunStats of the run
+    * info = host fingerprint, see hostinfo.fingerprint
+    * noise = noise summary (see noisemon.summarize), or None
+    * timeouts = number of calls aborted by the watchdog
+    """
+    labels = {'guide': runarchive.guide_name(out_file),
+              'host': info.get('host'), 'casa': info.get('casa') or "unknown"}
+    families = []
+    family = MetricFamily("casa_bench_task_duration_seconds", "histogram",
+                          "Duration of the calls of a CASA task.")
+    for task in sorted(stats.tasks.keys()):
+        task_labels = dict(labels)
+        task_labels['task'] = task
+        add_histogram(family, stats.tasks[task], task_labels)
+    families.append(family)
+    start = stats.start
+    total = stats.total_time()
+    logged = stats.logged()
+    for name, help, value in [
+        ("casa_bench_total_seconds", "Wall time of the run.", total),
+        ("casa_bench_logged_seconds", "Time inside logged task calls.",
+         logged),
+        ("casa_bench_unlogged_seconds", "Time outside logged task calls.",
+         total - logged),
+        ("casa_bench_calls", "Number of logged task calls.", stats.calls()),
+        ("casa_bench_run_timestamp_seconds", "Start of the run.", start),
+        ("casa_bench_timeouts", "Task calls aborted by the watchdog.",
+         timeouts)]:
+        family = MetricFamily(name, "gauge", help)
+        family.add(value, labels)
+        families.append(family)
+    if noise != None:
+        family = MetricFamily("casa_bench_noise_score", "gauge",
+                              "System noise contamination score of the run.")
+        family.add(noise['score'], labels)
+        families.append(family)
+    family = MetricFamily("casa_bench_run_info", "gauge",
+                          "Metadata of the run.")
+    info_labels = dict(labels)
+    info_labels['cpu'] = info.get('cpu', {}).get('model') or "unknown"
+    info_labels['omp_num_threads'] = os.environ.get("OMP_NUM_THREADS", "")
+    info_labels['cache'] = os.environ.get("CASA_BENCH_CACHEMODE", "")
+    family.add(1, info_labels)
+    families.append(family)
+    return families
+
+def metrics_text(families):
+    """ Return *families* in the text format, ending with '# EOF'. """
+    lines = []
+    for family in families:
+        lines += family.lines()
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+def metrics_file(directory, out_file):
+    """ Return the metrics file of the guide of *out_file* in *directory*. """
+    name = re.sub(r"[^A-Za-z0-9_.-]", "_", runarchive.guide_name(out_file))
+    return os.path.join(directory, "casa_bench_" + name + ".prom")
+
+def write_metrics(fname, text):
+    """
+    Replace *fname* with *text* atomically: the text is written to a
+    temporary file in the same directory (whose name the collector ignores)
+    and renamed.
+    """
+    tmp = os.path.join(os.path.dirname(fname) or ".",
+                       "." + os.path.basename(fname) + "." +
+                       str(os.getpid()) + ".tmp")
+    f = open(tmp, "w")
+    try:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.chmod(tmp, 0644)
+    os.rename(tmp, fname)
+
+def export_run(out_file, stats, info, noise=None, timeouts=0,
+               directory=None):
+    """
+    Write the metrics of a run (see run_metrics) to the textfile collector
+    directory *directory*, default from environment variable
+    CASA_BENCH_TEXTFILE_DIR. Return the file written, or None if no
+    directory is set or no calls were logged.
+    """
+    if directory == None:
+        directory = os.environ.get("CASA_BENCH_TEXTFILE_DIR", "")
+    if directory == "" or stats.calls() == 0:
+        return None
+    fname = metrics_file(directory, out_file)
+    write_metrics(fname, metrics_text(run_metrics(out_file, stats, info,
+                                                  noise, timeouts)))
+    return fname
+
+def summary_fingerprint(summary_file):
+    """ Return the fingerprint in a summary file, or None. """
+    f = open(summary_file)
+    try:
+        for line in f:
+            if line.startswith("Fingerprint: "):
+                return json.loads(line[len("Fingerprint: "):])
+    finally:
+        f.close()
+    return None
+
+if __name__ == "__main__":
+    usage = """ %prog [options] BENCHFILE
+
+    Export the run logged in BENCHFILE as metrics for a node exporter
+    textfile collector.  The run metadata is taken from BENCHFILE.summary if
+    it exists, else from this host."""
+    parser = OptionParser( usage=usage )
+    parser.add_option( '-d', '--directory', default=None,
+        help="textfile collector directory (default: " + \
+             "$CASA_BENCH_TEXTFILE_DIR); '-' prints the metrics" )
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    import casa_call, hostinfo, noisemon, streamstats
+    out_file = args[0]
+    stats = streamstats.run_from_records( casa_call.read_merged(out_file) )
+    info = None
+    if os.path.exists(out_file + ".summary"):
+        info = summary_fingerprint(out_file + ".summary")
+    if info == None:
+        info = hostinfo.fingerprint()
+    noise = None
+    if os.path.exists(out_file + ".noise"):
+        noise = noisemon.summarize( noisemon.read_samples(out_file + ".noise") )
+    timeouts = len([event for event in casa_call.read_events(out_file)
+                    if event.get('event') == 'timeout'])
+    if options.directory == "-":
+        sys.stdout.write( metrics_text(run_metrics(out_file, stats, info,
+                                                   noise, timeouts)) )
+    else:
+        fname = export_run(out_file, stats, info, noise, timeouts,
+                           options.directory)
+        if fname == None:
+            print >> sys.stderr, "No directory given or no calls logged."
+            sys.exit(1)
+        print "Wrote " + fname
@@ -1,4 +1,7 @@
 # CASA Guide parameters
+#
+# A parameter set may also set dataMD5, the MD5 checksum of the tarball at
+# dataURL; benchmark.sh -u then verifies the download before extracting it.
 
 # Benchmark test parameters for 2011.0.00099.S; casa 4.0
 function 2011_0_00099_S ()
@@ -0,0 +1,249 @@
+#!/bin/env python
+'''
+Worker making the diagnostic plots deferred by a benchmark run.
+
+A benchmark script written by 'extractCASAscript.py -b --deferplots' does not
+run its plot tasks (plotms, plotants, plotcal, plotxy); casa_call.defer_plot
+appends each call with its argument values to <benchmark file>.plots.  This
+worker replays the queue with casapy, outside the timed run:
+
+* the calls are sharded by the table they plot; the calls of one shard run
+  in order in one casapy process, so that no two processes lock the same
+  table, and at most -j shards run at a time
+* plots without an output file are written to <benchmark file>.figures/
+* the outcome of every call is appended to <benchmark file>.plots.results
+
+By default the queue is replayed as it is, after the run.  With option -f
+the worker follows the queue while the run goes on and stops when the run
+has been summarized; only calls whose tables were copied when they were
+queued (environment variable CASA_BENCH_PLOTSNAPSHOT set during the run) are
+made before the run ends, the others wait for it.
+'''
+
+import sys, os, os.path, time, json, shlex, subprocess
+from optparse import OptionParser
+
+# Argument naming the output file of each plot task
+figure_args = {'plotms': 'plotfile', 'plotcal': 'figfile',
+               'plotants': 'figfile', 'plotxy': 'figfile'}
+
+# Arguments naming the plotted table, as in casa_call.plot_table_args
+table_args = ['vis', 'caltable']
+
+# casapy script making the calls of one shard
+shard_script = """import os, json, time, traceback
+def plain(value):
+    if isinstance(value, unicode):
+        return str(value)
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    if isinstance(value, dict) and '__ndarray__' in value:
+        import numpy
+        return numpy.array(plain(value['__ndarray__']),
+                           dtype=value['dtype'] or None)
+    if isinstance(value, dict):
+        return dict([(str(k), plain(v)) for k, v in value.items()])
+    return value
+for entry in plain(json.loads(%(entries)r)):
+    result = {'seq': entry['seq'], 'task': entry['task']}
+    start = time.time()
+    try:
+        os.chdir(entry['cwd'])
+        eval(entry['task'])(*entry['args'], **entry['kwargs'])
+        result['status'] = 'ok'
+    except Exception, e:
+        result['status'] = 'error'
+        result['error'] = traceback.format_exc().splitlines()[-1]
+    result['elapsed'] = time.time() - start
+    fd = os.open(%(results)r, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    os.write(fd, json.dumps(result, sort_keys=True) + '\\n')
+    os.close(fd)
+"""
+
+def bench_file(queue_file):
+    """ Return the benchmarking file whose plots *queue_file* holds. """
+    if queue_file.endswith(".plots"):
+        return queue_file[:-len(".plots")]
+    return queue_file
+
+def read_queue(queue_file):
+    """ Return the complete entries of *queue_file*, oldest first. """
+    entries = []
+    if not os.path.exists(queue_file):
+        return entries
+    f = open(queue_file)
+    for line in f:
+        if not line.endswith("\n"):
+            # Being written
+            break
+        try:
+            entries.append( json.loads(line) )
+        except ValueError:
+            pass
+    f.close()
+    return entries
+
+def table_of(entry):
+    """ Return the absolute path of the table *entry* plots, or None. """
+    table = None
+    if entry['args'] and isinstance(entry['args'][0], basestring):
+        table = entry['args'][0]
+    for name in table_args:
+        if entry['kwargs'].get(name):
+            table = entry['kwargs'][name]
+    if table == None:
+        return None
+    return os.path.normpath( os.path.join(entry['cwd'], table) )
+
+def add_figure(entry, figure_dir):
+    """
+    Give *entry* an output file in *figure_dir* if it does not name one.
+    """
+    name = figure_args.get(entry['task'])
+    if name == None or entry['kwargs'].get(name):
+        return
+    entry['kwargs'][name] = os.path.join( os.path.abspath(figure_dir),
+        "%03d.%s.png" % (entry['seq'], entry['task']) )
+
+def make_shards(entries):
+    """
+    Group *entries* by the table they plot. Return a list of (table, list of
+    entries), in the order the tables are first plotted.
+    """
+    shards = []
+    index = {}
+    for entry in entries:
+        table = table_of(entry)
+        if table not in index:
+            index[table] = len(shards)
+            shards.append( (table, []) )
+        shards[index[table]][1].append(entry)
+    return shards
+
+def run_finished(out_file):
+    """
+    Tests if the run logging to *out_file* has been summarized, i.e. its
+    summary is newer than the start of the run.
+    """
+    summary = out_file + ".summary"
+    if not os.path.exists(summary):
+        return False
+    try:
+        f = open(out_file)
+        event = json.loads(f.readline())
+        f.close()
+    except (IOError, ValueError):
+        return True
+    return os.path.getmtime(summary) >= event.get('time', 0)
+
+def start_shard(command, entries, script, results, nice=0):
+    """
+    Start a process making the calls of *entries* with *command*, through
+    the casapy script *script*. Return the process.
+    """
+    f = open(script, "w")
+    f.write( shard_script % {'entries': json.dumps(entries),
+                             'results': os.path.abspath(results)} )
+    f.close()
+    def lower_priority():
+        if nice:
+            os.nice(nice)
+    return subprocess.Popen( shlex.split(command) + [script],
+                             preexec_fn=lower_priority )
+
+def process_queue(queue_file, command, jobs=1, follow=False, poll=5.0,
+                  nice=0, verbose=True):
+    """
+    Make the plots queued in *queue_file*, at most *jobs* shards at a time.
+    Return the number of calls made.
+
+    * command = command line that runs one script, e.g. 'casapy -c'; the
+      script name is appended
+    * follow = if true, keep reading the queue until the run is summarized;
+      calls on tables not snapshotted wait until then
+    * poll = seconds between reads of the queue when following
+    * nice = niceness increment of the plotting processes
+    """
+    out_file = bench_file(queue_file)
+    figure_dir = out_file + ".figures"
+    if not os.path.isdir(figure_dir):
+        os.makedirs(figure_dir)
+    results = queue_file + ".results"
+    if os.path.exists(results):
+        os.remove(results)
+    seen = 0
+    held = []
+    pending = []
+    running = {}
+    nscripts = 0
+    while True:
+        finished = not follow or run_finished(out_file)
+        entries = read_queue(queue_file)
+        for entry in entries[seen:]:
+            add_figure(entry, figure_dir)
+            held.append(entry)
+        seen = len(entries)
+        ready = [entry for entry in held
+                 if finished or entry.get('snapshot')]
+        held = [entry for entry in held if entry not in ready]
+        pending += make_shards(ready)
+        busy = set([table for table, process in running.values()])
+        for shard in pending[:]:
+            if len(running) >= jobs:
+                break
+            table, calls = shard
+            if table in busy and table != None:
+                continue
+            pending.remove(shard)
+            nscripts += 1
+            script = queue_file + ".shard" + str(nscripts) + ".py"
+            if verbose:
+                print "Plotting " + str(len(calls)) + " call(s) on " + \
+                    str(table)
+            running[script] = (table, start_shard(command, calls, script,
+                                                  results, nice))
+            busy.add(table)
+        for script in running.keys():
+            if running[script][1].poll() != None:
+                del running[script]
+                os.remove(script)
+        if finished and not held and not pending and not running:
+            break
+        time.sleep(poll if follow and not finished else 0.1)
+    return seen
+
+def read_results(results_file):
+    """ Return the outcomes in *results_file*, one dictionary per call. """
+    return read_queue(results_file)
+
+if __name__ == "__main__":
+    usage = """ %prog [options] QUEUE
+
+    Make the plots queued in QUEUE (<benchmark file>.plots) by a benchmark
+    script written with 'extractCASAscript.py -b --deferplots'."""
+    parser = OptionParser( usage=usage )
+    parser.add_option( '-j', '--jobs', type="int", default=1,
+        help="number of plotting processes at the same time" )
+    parser.add_option( '-c', '--command',
+        default="casapy --nologger --nogui -c",
+        help="command that runs one script (default: %default)" )
+    parser.add_option( '-f', '--follow', action="store_true", default=False,
+        help="follow the queue while the run goes on" )
+    parser.add_option( '-p', '--poll', type="float", default=5.0,
+        help="seconds between reads of the queue with -f" )
+    parser.add_option( '-n', '--nice', type="int", default=0,
+        help="niceness increment of the plotting processes" )
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    count = process_queue(args[0], options.command, options.jobs,
+                          options.follow, options.poll, options.nice)
+    outcomes = read_results(args[0] + ".results")
+    failed = [r for r in outcomes if r['status'] != 'ok']
+    print "Plot calls: " + str(count) + ", failed: " + str(len(failed))
+    for result in failed:
+        print "  " + str(result['seq']) + " " + result['task'] + ": " + \
+            result.get('error', '')
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,351 @@
+#!/bin/env python
+'''
+Dry-run replay harness for benchmark scripts.
+
+Execute a script generated by 'extractCASAscript.py -b' outside of casapy.
+Every task in the casa_tasks registry of extractCASAscript.py is replaced by
+a fake that sleeps, burns CPU, does synthetic I/O or nothing, and inp, tget, default and go
+are stubbed.  After the run the records in the benchmark file are checked
+against the .expected file written by the extractor, and the instrumentation
+overhead per logged call is reported.
+
+This allows the extract -> instrument -> record -> summarize pipeline to be
+tested and timed without casapy or real data.
+'''
+
+import sys, os, os.path, time, tempfile
+from optparse import OptionParser
+import extractCASAscript
+import casa_call
+import iobench
+
+# Modes understood by FakeTask
+fake_modes = ['noop', 'sleep', 'cpu', 'io']
+
+class StubValue(float):
+    """
+    Permissive stand-in for values returned by casapy tasks and tools.
+
+    Behaves as the number 0.0 in arithmetic and formatting; indexing, calling
+    and attribute access return the stub itself so that expressions such as
+    imstat(...)['rms'][0] or es.getBaselineInfo() evaluate.
+    """
+    def __getitem__(self, key):
+        return self
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self
+    def __call__(self, *args, **kwargs):
+        return self
+    def __iter__(self):
+        return iter([])
+    def __len__(self):
+        return 0
+
+def burn_cpu(duration):
+    """ Keep one core busy for *duration* seconds. """
+    stop = time.time() + duration
+    x = 1.0
+    while time.time() < stop:
+        for i in range(1000):
+            x = x * 1.0000001
+    return x
+
+def synthetic_io(nbytes, directory=".", block=1048576):
+    """
+    Write *nbytes* to a scratch file in *directory*, flush it to storage,
+    drop it from the page cache and read it back, so that the storage under
+    *directory* does the work. Return the number of bytes written.
+    """
+    path = os.path.join(directory, ".replay-io." + str(os.getpid()))
+    data = "\0" * block
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+    try:
+        written = 0
+        while written < nbytes:
+            written += os.write(fd, data[:min(block, nbytes - written)])
+        iobench.drop_cache(fd)
+        os.lseek(fd, 0, 0)
+        while os.read(fd, block):
+            pass
+    finally:
+        os.close(fd)
+        os.remove(path)
+    return written
+
+def data_scale():
+    """ Return CASA_BENCH_SCALE, the fraction of the data set, or 1. """
+    try:
+        return float(os.environ.get('CASA_BENCH_SCALE', '1'))
+    except ValueError:
+        return 1.0
+
+def omp_threads():
+    """ Return OMP_NUM_THREADS, or 1 if it is not set. """
+    try:
+        return max(int(os.environ.get('OMP_NUM_THREADS', '1')), 1)
+    except ValueError:
+        return 1
+
+class FakeTask:
+    """
+    Fake casapy task.
+
+    * name = task name
+    * mode = one of fake_modes
+    * duration = seconds spent per call in modes sleep and cpu
+    * parallel = fraction of *duration* that is divided among OMP_NUM_THREADS
+      threads (Amdahl's law), to test sweep.py offline
+    * exponent = the duration is multiplied by CASA_BENCH_SCALE to this
+      power, to test scaling.py offline
+    * io_rate = MB written and read back per second of *duration* in mode
+      io, in the current directory, to test loadtest.py offline
+    """
+    def __init__(self, name, mode='noop', duration=0.0, parallel=0.0,
+                 exponent=0.0, io_rate=0.0):
+        self.name = name
+        self.mode = mode
+        self.duration = duration
+        self.parallel = parallel
+        self.exponent = exponent
+        self.io_rate = io_rate
+        self.calls = 0
+        self.time_inside = 0.0
+
+    def __call__(self, *args, **kwargs):
+        start = time.time()
+        duration = self.duration * data_scale() ** self.exponent * \
+            ((1.0 - self.parallel) + self.parallel / omp_threads())
+        if self.mode == 'sleep':
+            time.sleep(duration)
+        elif self.mode == 'cpu':
+            burn_cpu(duration)
+        elif self.mode == 'io':
+            synthetic_io(int(duration * self.io_rate * 1048576))
+        self.calls += 1
+        self.time_inside += time.time() - start
+        return StubValue(0.0)
+
+class StubNamespace:
+    """
+    Build the global namespace a generated script is executed in.
+
+    * mode = default FakeTask mode
+    * duration = default FakeTask duration
+    * task_durations = dictionary of per-task durations overriding *duration*
+    * stubs = extra names (e.g. analysisUtils instances) bound to StubValue
+    * parallel = default parallel fraction of FakeTask
+    * task_parallel = dictionary of per-task parallel fractions
+    * exponent = default data scaling exponent of FakeTask
+    * task_exponents = dictionary of per-task data scaling exponents
+    * io_rate = MB per second of duration moved by FakeTask in mode io
+    """
+    def __init__(self, mode='noop', duration=0.0, task_durations={},
+                 stubs=[], parallel=0.0, task_parallel={}, exponent=0.0,
+                 task_exponents={}, io_rate=0.0):
+        self.tasks = {}
+        for name in extractCASAscript.casa_tasks:
+            if not is_identifier(name):
+                continue
+            self.tasks[name] = FakeTask( name, mode,
+                task_durations.get(name, duration),
+                task_parallel.get(name, parallel),
+                task_exponents.get(name, exponent), io_rate )
+        self.current = None
+        self.stubs = stubs
+
+    def lookup(self, task):
+        """ Return the fake for *task*, given as a fake or a task name. """
+        if isinstance(task, FakeTask):
+            return task
+        return self.tasks.get(task)
+
+    def inp(self, task=None, *args, **kwargs):
+        if task is not None:
+            self.current = self.lookup(task)
+
+    def default(self, task=None, *args, **kwargs):
+        if task is not None:
+            self.current = self.lookup(task)
+
+    def tget(self, task=None, *args, **kwargs):
+        if task is not None:
+            self.current = self.lookup(task)
+
+    def go(self, task=None, *args, **kwargs):
+        if task is not None:
+            self.current = self.lookup(task)
+        if self.current is not None:
+            return self.current()
+
+    def globals(self, script):
+        """ Return a fresh globals dictionary for executing *script*. """
+        namespace = {'__name__': '__main__', '__file__': script,
+                     'os': os, 'sys': sys, 'time': time}
+        namespace.update(self.tasks)
+        namespace['inp'] = self.inp
+        namespace['default'] = self.default
+        namespace['tget'] = self.tget
+        namespace['go'] = self.go
+        for name in self.stubs:
+            namespace[name] = StubValue(0.0)
+        return namespace
+
+    def time_inside(self):
+        """ Return total seconds spent inside fake tasks. """
+        total = 0.0
+        for fake in self.tasks.values():
+            total += fake.time_inside
+        return total
+
+def is_identifier(name):
+    """ Tests if *name* can be bound in a Python namespace. """
+    return name.replace('_','a').isalnum() and not name[0].isdigit()
+
+def verify_flow(records, expected):
+    """
+    Compare logged records with the expected flow.
+
+    Return a tuple (missing, unexpected): the expected (task, tasknum) pairs
+    that were never logged, and the logged (task, tag) pairs that do not
+    appear in the expected flow.  Tasks inside loops are logged once per
+    iteration under the same tag; this is not an error.
+    """
+    expected_set = set()
+    for task, num in expected:
+        expected_set.add( (task, str(num)) )
+    logged = set()
+    unexpected = []
+    for rec in records:
+        key = (rec['task'], rec['tag'])
+        logged.add(key)
+        if key not in expected_set and key not in unexpected:
+            unexpected.append(key)
+    missing = []
+    for task, num in expected:
+        if (task, str(num)) not in logged:
+            missing.append( (task, num) )
+    return missing, unexpected
+
+def measure_overhead(ncalls=1000):
+    """
+    Return the mean wall time in seconds of one casa_call.Call instantiation
+    and end(out_file) pair, measured on a scratch benchmark file.
+    """
+    fd, fname = tempfile.mkstemp(suffix='.benchmark.txt')
+    os.close(fd)
+    # Measure the bare recorder, without progress tracking
+    casa_call.start_run(fname, socket_path="", noise_interval="",
+                        watchdog="", summary_interval="")
+    start = time.time()
+    for i in range(ncalls):
+        this_call = casa_call.Call('overhead', str(i))
+        this_call.end(fname)
+    elapsed = time.time() - start
+    os.remove(fname)
+    return elapsed / ncalls
+
+def replay( script, namespace ):
+    """
+    Execute benchmark *script* in the stub *namespace*. Return the elapsed
+    wall time.  The current directory must be the script directory.
+    """
+    start = time.time()
+    execfile( script, namespace.globals(script) )
+    return time.time() - start
+
+def bench_file_name( script ):
+    """ Return the default benchmark file name used by *script*. """
+    return script.replace('.py','.benchmark.txt')
+
+def main( script, options ):
+    """
+    Replay *script*, verify its records and report overhead. Return the
+    process exit status.
+    """
+    task_durations = {}
+    for item in options.task_duration:
+        name, value = item.split('=')
+        task_durations[name] = float(value)
+    task_parallel = {}
+    for item in options.task_parallel:
+        name, value = item.split('=')
+        task_parallel[name] = float(value)
+    task_exponents = {}
+    for item in options.task_exponent:
+        name, value = item.split('=')
+        task_exponents[name] = float(value)
+    namespace = StubNamespace( mode=options.mode, duration=options.duration,
+        task_durations=task_durations, stubs=options.stub,
+        parallel=options.parallel, task_parallel=task_parallel,
+        exponent=options.data_exponent, task_exponents=task_exponents,
+        io_rate=options.io_rate )
+
+    os.chdir( os.path.dirname(os.path.abspath(script)) )
+    script = os.path.basename(script)
+    wall = replay( script, namespace )
+
+    records = []
+    if os.path.exists( bench_file_name(script) ):
+        records = casa_call.read_bench( bench_file_name(script) )
+    print "Replayed " + script + " in " + ("%.3f" % wall) + " s"
+    print "Logged calls: " + str(len(records))
+    status = 0
+    if os.path.exists( script + '.expected' ):
+        expected = casa_call.read_expected( script + '.expected' )
+        missing, unexpected = verify_flow( records, expected )
+        for task, num in missing:
+            print "Missing from benchmark file: " + task + " " + str(num)
+        for task, tag in unexpected:
+            print "Not in expected flow: " + task + " " + tag
+        if unexpected or (missing and not options.allowmissing):
+            status = 1
+        else:
+            print "Benchmark records match the expected flow."
+    else:
+        print "No expected flow file found; skipping verification."
+
+    if len(records) > 0:
+        outside = wall - namespace.time_inside()
+        print "Time outside fake tasks per logged call: " + \
+            ("%.1f" % (1e6 * outside / len(records))) + " us"
+    print "casa_call.Call overhead per call: " + \
+        ("%.1f" % (1e6 * measure_overhead(options.ncalls))) + " us"
+    return status
+
+if __name__ == "__main__":
+    usage = \
+""" %prog [options] SCRIPT
+
+SCRIPT is a benchmark script written by 'extractCASAscript.py -b'. It is run
+in its own directory; the benchmark and summary files are written there."""
+    parser = OptionParser( usage=usage )
+    parser.add_option( '-m', '--mode', type="choice", choices=fake_modes,
+        default='noop', help="fake task behavior: noop, sleep, cpu or io" )
+    parser.add_option( '-t', '--duration', type="float", default=0.0,
+        help="seconds per fake task call in modes sleep, cpu and io" )
+    parser.add_option( '-T', '--task-duration', action="append", default=[],
+        metavar="TASK=SEC", help="per-task duration; may be repeated" )
+    parser.add_option( '-P', '--parallel', type="float", default=0.0,
+        help="fraction of each fake task that scales with OMP_NUM_THREADS" )
+    parser.add_option( '-F', '--task-parallel', action="append", default=[],
+        metavar="TASK=FRAC", help="per-task parallel fraction; may be repeated" )
+    parser.add_option( '-D', '--data-exponent', type="float", default=0.0,
+        help="scale fake task durations by CASA_BENCH_SCALE to this power" )
+    parser.add_option( '-E', '--task-exponent', action="append", default=[],
+        metavar="TASK=EXP", help="per-task data exponent; may be repeated" )
+    parser.add_option( '-b', '--io-rate', type="float", default=16.0,
+        help="MB written and read back per second of duration in mode " + \
+             "io [default: %default]" )
+    parser.add_option( '-s', '--stub', action="append", default=[],
+        metavar="NAME", help="bind NAME (e.g. aU, es) to a permissive stub" )
+    parser.add_option( '-a', '--allowmissing', action="store_true",
+        default=False, help="do not fail if expected tasks were not logged" )
+    parser.add_option( '-n', '--ncalls', type="int", default=1000,
+        help="calls used to measure the casa_call overhead" )
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    sys.exit( main(args[0], options) )
@@ -1,6 +1,7 @@
 #!/bin/env python
 
-import sys, re, numpy, glob
+import sys, os, re, numpy, glob, json
+import runarchive
 from optparse import OptionParser
 
 def make_report( options, globPattern="./*.summary" ):
@@ -19,47 +20,173 @@ def make_report( options, globPattern="./*.summary" ):
         fileObj = open(file)
         summary = fileObj.read()
         fileObj.close()
-        # Get test name
-        pattern = r'''Summary\ of\ file\ (.*).benchmark.*'''
-        match = re.search( pattern, summary )
-        testName = match.group(1)
-        # Get host name
-        pattern = r'''^(Linux|Darwin)\ ([^\ \.]+)'''
-        match = re.search( pattern, summary, re.MULTILINE )
-        hostname = match.group(2)
-        # Get total times
+        report_summary( options, summary )
+
+def make_archive_report( options, benchFiles ):
+    """
+    Generate a report from the summaries of the runs in the run archives
+    (see runarchive.py) of the benchmark files *benchFiles*, plus the
+    summary of the latest run of each.
+    """
+    if options.header:
+        print_header( options.csv )
+    for benchFile in benchFiles:
+        summaries = []
+        for entry in runarchive.list_runs( benchFile ):
+            path = runarchive.run_file( benchFile, entry, '.summary' )
+            if path:
+                summaries.append( runarchive.read_file(path) )
+        if os.path.exists( benchFile + '.summary' ):
+            fileObj = open( benchFile + '.summary' )
+            summaries.append( fileObj.read() )
+            fileObj.close()
+        if summaries:
+            report_summary( options, "\n".join(summaries) )
+
+def report_summary( options, summary ):
+    """
+    Print the rows for the text of a summary file, which holds the
+    summaries of one or more runs of the same test.
+    """
+    # Get test name
+    pattern = r'''Summary\ of\ file\ (.*).benchmark.*'''
+    match = re.search( pattern, summary )
+    testName = match.group(1)
+    # Get host name
+    hostname = get_hostname( summary )
+    # Get total times and noise scores, one per run, grouped by the
+    # page cache mode of the runs
+    modes = []; runs = {}
+    for run in split_summaries( summary ):
         pattern = r'''^Total\ time:\ ([0-9\.]+)'''
-        times = re.findall( pattern, summary, re.MULTILINE )
-        for i,time in enumerate(times):
-            times[i] = float(time) 
-        avg = numpy.average(times)
-        std = numpy.std(times)
+        match = re.search( pattern, run, re.MULTILINE )
+        if not match:
+            continue
+        mode = get_cache_mode( run )
+        if mode not in runs:
+            modes.append( mode )
+            runs[mode] = []
+        score, flagged = get_noise( run, options.threshold )
+        runs[mode].append( (float(match.group(1)), score, flagged) )
+    for mode in modes:
+        times = [run[0] for run in runs[mode]]
+        flags = [run[2] for run in runs[mode]]
+        kept = times
+        if options.exclude:
+            kept = [t for t, noisy in zip(times, flags) if not noisy]
+        if len(kept) > 0:
+            avg = numpy.average(kept)
+            std = numpy.std(kept)
+        else:
+            avg = std = float('nan')
+        noise = [run[1] for run in runs[mode] if run[1] != None]
+        worst = None
+        if noise:
+            worst = max(noise)
         # Print summary
-        print_row( testName, hostname, times, avg, std, options.csv )
+        print_row( testName, hostname, times, avg, std, options.csv,
+                   worst=worst, flags=flags, cache=mode )
+
+def split_summaries( summary ):
+    """
+    Split the text of a summary file into the summaries of the individual
+    runs appended to it.
+    """
+    starts = [m.start() for m in re.finditer( r'''^Summary\ of\ file''',
+                                              summary, re.MULTILINE )]
+    if len(starts) == 0:
+        return [summary]
+    starts.append( len(summary) )
+    return [summary[starts[i]:starts[i+1]] for i in range(len(starts)-1)]
+
+def get_noise( run, threshold=None ):
+    """
+    Return (contamination score, flagged) of the summary of one *run*;
+    (None, False) if no noise was monitored.  If *threshold* is given, runs
+    scoring above it are flagged; otherwise the flag of the summary is used.
+    """
+    pattern = r'''^Noise:\ (.*)$'''
+    match = re.search( pattern, run, re.MULTILINE )
+    if not match:
+        return None, False
+    try:
+        noise = json.loads( match.group(1) )
+    except ValueError:
+        return None, False
+    if threshold != None:
+        return noise['score'], noise['score'] > threshold
+    return noise['score'], noise['flagged']
+
+def get_cache_mode( run ):
+    """
+    Return the page cache mode (cold, warm) of the summary of one *run*, or
+    '-' if the run did not manage the page cache.
+    """
+    pattern = r'''^Run\ mode:\ (.*)$'''
+    match = re.search( pattern, run, re.MULTILINE )
+    if not match:
+        return '-'
+    try:
+        return json.loads( match.group(1) ).get('cache') or '-'
+    except ValueError:
+        return '-'
+
+def get_hostname( summary ):
+    """
+    Return the short host name of the first summary in *summary*, taken from
+    the fingerprint line or, for older summaries, the uname line.
+    """
+    pattern = r'''^Fingerprint:\ (.*)$'''
+    match = re.search( pattern, summary, re.MULTILINE )
+    if match:
+        try:
+            info = json.loads( match.group(1) )
+            return info['host'].split('.')[0]
+        except (ValueError, KeyError):
+            pass
+    pattern = r'''^(Linux|Darwin)\ ([^\ \.]+)'''
+    match = re.search( pattern, summary, re.MULTILINE )
+    return match.group(2)
 
 def print_header( csv ):
     """ Print table header """
     format = ""
     if csv:
-        format = "%33s, %12s, %8s, %8s, %s"
+        format = "%33s, %12s, %5s, %8s, %8s, %6s, %s"
     else:
-        format = "%33s %12s %8s %8s %s"
-    print format % ('Script Name', "Host", "AvgTime", "StDTime", "Runtimes (s)")
+        format = "%33s %12s %5s %8s %8s %6s %s"
+    print format % ('Script Name', "Host", "Cache", "AvgTime", "StDTime",
+                    "Noise", "Runtimes (s)")
     if not csv: 
-        print format % ("-"*33, "-"*12, "-"*8, "-"*8, "-"*12)
+        print format % ("-"*33, "-"*12, "-"*5, "-"*8, "-"*8, "-"*6, "-"*12)
 
-def print_row( testName, hostname, times, avg, std, csv ):
-    """ Print 1 row of the summary ASCII table. """
+def print_row( testName, hostname, times, avg, std, csv, worst=None,
+               flags=None, cache='-' ):
+    """
+    Print 1 row of the summary ASCII table.
+
+    * worst = highest contamination score of the runs, or None
+    * flags = per-run booleans; flagged runtimes are marked with '*'
+    * cache = page cache mode of the runs
+    """
     rowFormat = ""; timeFormat = ""
     if csv:
-        rowFormat = "%33s, %12s, %8.1f, %8.1f,"
-        timeFormat = "%d, "
+        rowFormat = "%33s, %12s, %5s, %8.1f, %8.1f, %6s,"
+        timeFormat = "%d%s, "
     else:
-        rowFormat = "%33s %12s %8.1f %8.1f"
-        timeFormat = "%d "
-    print rowFormat % (testName, hostname, avg, std) ,
-    for time in times:
-        print timeFormat % time, 
+        rowFormat = "%33s %12s %5s %8.1f %8.1f %6s"
+        timeFormat = "%d%s "
+    noise = "-"
+    if worst != None:
+        noise = "%.2f" % worst
+    if flags == None:
+        flags = [False] * len(times)
+    print rowFormat % (testName, hostname, cache, avg, std, noise) ,
+    for time, flagged in zip(times, flags):
+        mark = ""
+        if flagged:
+            mark = "*"
+        print timeFormat % (time, mark), 
     print
 
 if __name__ == "__main__":
@@ -79,9 +206,19 @@ if __name__ == "__main__":
         help="write only the table header" )
     parser.add_option( '-c', '--csv', action="store_true", default=False,
         help="wite table in comma separated ariable format" )
+    parser.add_option( '-a', '--archive', action="append", default=[],
+        metavar="BENCHFILE", help="report the runs archived for " + \
+        "benchmark file BENCHFILE instead of summary files; may be repeated" )
+    parser.add_option( '-x', '--exclude', action="store_true", default=False,
+        help="leave runs flagged as noisy (marked '*') out of the averages" )
+    parser.add_option( '-t', '--threshold', type="float", default=None,
+        help="flag runs with a contamination score above THRESHOLD " + \
+             "instead of using the flags in the summaries" )
     (options, args) = parser.parse_args()
     if options.headeronly:
         print_header( options.csv )
+    elif options.archive:
+        make_archive_report( options, options.archive )
     else:
         if len(args) > 1:
             parser.print_help()
@@ -0,0 +1,193 @@
+#!/bin/env python
+'''
+Archive of finished benchmark runs.
+
+When a benchmark script starts, the files of the previous run (the benchmark
+file, the record files of its other processes, its summary, status, noise,
+deferred plot queue and hang dump files) are compressed into
+<benchmark file>.archive/<run id>/ and listed in
+<benchmark file>.archive/index.json with the run id, time, host and guide.
+The next run id is kept in the index, so archiving does not probe for free
+names.  With the environment variable CASA_BENCH_KEEP set to N, only the N
+newest runs are kept.
+
+list_runs and run_file give report.py and casa_call access to archived runs
+without globbing:
+
+    $ ./runarchive.py myScript.benchmark.txt
+'''
+
+import sys, os, os.path, time, json, gzip, shutil, socket
+from optparse import OptionParser
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Suffixes of the per-run files archived next to the benchmark file
+run_suffixes = ['.summary', '.status', '.noise', '.plots']
+
+def archive_dir(out_file):
+    """ Return the archive directory of benchmarking file *out_file*. """
+    return out_file + ".archive"
+
+def index_file(archive):
+    return os.path.join(archive, "index.json")
+
+def read_index(archive):
+    """ Return the index of *archive*; an empty one if there is none. """
+    try:
+        f = open(index_file(archive))
+    except IOError:
+        return {'next_id': 1, 'runs': []}
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def write_index(archive, index):
+    """ Replace the index of *archive* atomically. """
+    tmp = index_file(archive) + ".tmp"
+    f = open(tmp, "w")
+    json.dump(index, f, indent=1, sort_keys=True)
+    f.close()
+    os.rename(tmp, index_file(archive))
+
+class IndexLock:
+    """ Exclusive lock on the index of an archive, where fcntl exists. """
+    def __init__(self, archive):
+        self.fd = os.open(os.path.join(archive, "index.lock"),
+                          os.O_WRONLY | os.O_CREAT, 0644)
+        if fcntl != None:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def release(self):
+        if fcntl != None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+
+def compress(src, dst):
+    """ Compress file *src* to *dst* and remove *src*. """
+    fin = open(src, "rb")
+    fout = gzip.open(dst, "wb")
+    shutil.copyfileobj(fin, fout)
+    fout.close()
+    fin.close()
+    os.remove(src)
+
+def guide_name(out_file):
+    """ Return the guide (script) name of benchmarking file *out_file*. """
+    name = os.path.basename(out_file)
+    for suffix in ['.benchmark.txt', '.txt']:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def archive_run(out_file, record_files, keep=None):
+    """
+    Move the files of the run logged in *out_file* into the archive,
+    compressed. Return the new run id, or None if there was nothing to
+    archive.
+
+    * record_files = benchmark file, per-process record files and other
+      files (e.g. hang dumps) of the run
+    * keep = number of runs to keep; default from environment variable
+      CASA_BENCH_KEEP, all if unset
+    """
+    files = [fname for fname in record_files if os.path.exists(fname)]
+    files += [out_file + suffix for suffix in run_suffixes
+              if os.path.exists(out_file + suffix)]
+    if len(files) == 0:
+        return None
+    archive = archive_dir(out_file)
+    if not os.path.isdir(archive):
+        os.makedirs(archive)
+    if keep == None and os.environ.get("CASA_BENCH_KEEP", "").isdigit():
+        keep = int(os.environ["CASA_BENCH_KEEP"])
+    lock = IndexLock(archive)
+    try:
+        index = read_index(archive)
+        run_id = index['next_id']
+        index['next_id'] = run_id + 1
+        run_path = os.path.join(archive, str(run_id))
+        os.mkdir(run_path)
+        names = []
+        for fname in files:
+            name = os.path.basename(fname) + ".gz"
+            compress(fname, os.path.join(run_path, name))
+            names.append(name)
+        start, host = time.time(), socket.gethostname()
+        main = os.path.join(run_path, os.path.basename(out_file) + ".gz")
+        if os.path.exists(main):
+            start, host = run_info(main, start, host)
+        index['runs'].append( {'id': run_id, 'time': start,
+                               'archived': time.time(), 'host': host,
+                               'guide': guide_name(out_file),
+                               'files': names} )
+        if keep:
+            for entry in index['runs'][:-keep]:
+                shutil.rmtree(os.path.join(archive, str(entry['id'])),
+                              ignore_errors=True)
+            index['runs'] = index['runs'][-keep:]
+        write_index(archive, index)
+    finally:
+        lock.release()
+    return run_id
+
+def run_info(fname, start, host):
+    """
+    Return (start time, host) of the run logged in compressed *fname*, from
+    its first event; *start* and *host* where the event does not tell.
+    """
+    f = gzip.open(fname)
+    line = f.readline()
+    f.close()
+    if line.startswith("{"):
+        try:
+            event = json.loads(line)
+            start = event.get('time', event.get('start', start))
+            host = event.get('host', host)
+        except ValueError:
+            pass
+    return start, host
+
+def list_runs(out_file):
+    """
+    Return the index entries (dictionaries with id, time, archived, host,
+    guide and files) of the archived runs of *out_file*, oldest first.
+    """
+    return read_index(archive_dir(out_file))['runs']
+
+def run_file(out_file, entry, suffix=""):
+    """
+    Return the path of the compressed file out_file+suffix of archived run
+    *entry*, or None if it was not archived.
+    """
+    name = os.path.basename(out_file) + suffix + ".gz"
+    if name not in entry['files']:
+        return None
+    return os.path.join(archive_dir(out_file), str(entry['id']), name)
+
+def read_file(path):
+    """ Return the text of compressed file *path*. """
+    f = gzip.open(path)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+if __name__ == "__main__":
+    usage = """ %prog BENCHMARKFILE
+
+    List the archived runs of BENCHMARKFILE."""
+    parser = OptionParser( usage=usage )
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    print "%6s %19s %-12s %s" % ("Run", "Started", "Host", "Files")
+    for entry in list_runs(args[0]):
+        started = time.strftime("%Y-%m-%d %H:%M:%S",
+                                time.localtime(entry['time']))
+        print "%6d %19s %-12s %s" % (entry['id'], started, entry['host'],
+                                     " ".join(entry['files']))
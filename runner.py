@@ -0,0 +1,298 @@
+#!/bin/env python
+'''
+Repeated benchmark runs with a controlled page cache.
+
+Run a benchmark script again and again in its data directory until the
+95% confidence interval of the time of every task is narrower than a target
+(relative to the mean) or a maximum number of runs is reached.  Before each
+run the data directory is brought into a known page cache state:
+
+* cold = every file is evicted from the page cache with
+  posix_fadvise(POSIX_FADV_DONTNEED); no root privileges are needed
+* warm = every file is read once so that it is cached
+* none = the cache is left as it is
+
+Every run starts from the same data: the prepared data directory is left as
+it is, and each run happens in a fresh copy of it, <data directory>.work.
+The benchmark file and summary of the latest run are copied back to the data
+directory, and moved to its run archive (see runarchive.py) before the next
+run.  The work copy links to that archive, so each run sees the earlier ones
+(progress estimates, watchdog limits).
+
+The mode and the repetition number are passed to the script in the
+environment variables CASA_BENCH_CACHEMODE and CASA_BENCH_REPEAT;
+casa_call.summarize_bench records them in a "Run mode:" summary line.
+'''
+
+import sys, os, os.path, time, json, math, shutil, shlex, subprocess
+from optparse import OptionParser
+import casa_call
+import iobench
+import replay
+import runarchive
+
+# Suffixes of the files next to the benchmark file copied back from the work
+# copy of a run
+result_suffixes = ['.summary', '.status', '.noise', '.plots']
+
+# Page cache modes
+cache_modes = ['cold', 'warm', 'none']
+
+# Two-sided 95% Student t quantiles for 1..30 degrees of freedom
+t_table = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262,
+           2.228, 2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101,
+           2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052,
+           2.048, 2.045, 2.042]
+
+def data_files(directory):
+    """ Yield the paths of all regular files below *directory*. """
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                yield path
+
+def evict_cache(directory):
+    """
+    Drop the files below *directory* from the page cache. Return the number
+    of files whose eviction the kernel accepted.
+    """
+    count = 0
+    for path in data_files(directory):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            if iobench.drop_cache(fd):
+                count += 1
+        except OSError:
+            pass
+        os.close(fd)
+    return count
+
+def warm_cache(directory, block=1048576):
+    """ Read every file below *directory* once. Return the bytes read. """
+    total = 0
+    for path in data_files(directory):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        while True:
+            data = os.read(fd, block)
+            if not data:
+                break
+            total += len(data)
+        os.close(fd)
+    return total
+
+def prepare_cache(mode, directory):
+    """ Bring *directory* into page cache state *mode*. """
+    if mode == 'cold':
+        evict_cache(directory)
+    elif mode == 'warm':
+        warm_cache(directory)
+
+def t_quantile(df):
+    """ Return the two-sided 95% Student t quantile for *df* >= 1. """
+    if df <= len(t_table):
+        return t_table[df - 1]
+    return 1.96
+
+def confidence(values):
+    """
+    Return (mean, half width of the 95% confidence interval) of *values*;
+    the half width is None for fewer than two values.
+    """
+    n = len(values)
+    mean = sum(values) / float(n)
+    if n < 2:
+        return mean, None
+    var = sum([(v - mean) ** 2 for v in values]) / (n - 1)
+    return mean, t_quantile(n - 1) * math.sqrt(var / n)
+
+def task_totals(records):
+    """ Return a dictionary task -> total time of *records* of one run. """
+    totals = {}
+    for rec in records:
+        totals[rec['task']] = totals.get(rec['task'], 0.0) + rec['delta']
+    return totals
+
+def widest(samples, min_time=1.0):
+    """
+    Return (task, relative half width) of the task with the widest
+    confidence interval among *samples* (task -> list of per-run times);
+    tasks with a mean under *min_time* seconds are ignored.  The width is
+    None while it cannot be computed.
+    """
+    worst = (None, 0.0)
+    for task in sorted(samples.keys()):
+        mean, half = confidence(samples[task])
+        if mean < min_time:
+            continue
+        if half == None:
+            return task, None
+        if half / mean > worst[1]:
+            worst = (task, half / mean)
+    return worst
+
+def append_summary(summary_file, directory):
+    """ Append *summary_file* to the file of the same name in *directory*. """
+    if not os.path.exists(summary_file):
+        return
+    f = open(summary_file)
+    text = f.read()
+    f.close()
+    f = open(os.path.join(directory, os.path.basename(summary_file)), "a")
+    f.write("\n\n" + text)
+    f.close()
+
+def work_dir(source):
+    """ Return the directory the runs on data directory *source* use. """
+    return os.path.abspath(source).rstrip("/") + ".work"
+
+def reset_data(source, dest, script):
+    """
+    Replace *dest* with a fresh copy of the prepared data directory
+    *source*, leaving out the results of earlier runs of *script*, so that
+    every run starts from the same data. Return *dest*.
+
+    The results of the last run left in *source* are first moved to the run
+    archive of *source*, and *dest* gets a link to that archive instead of
+    a copy, so that the run in *dest* reads the history of earlier runs.
+    """
+    if os.path.isdir(dest):
+        shutil.rmtree(dest)
+    script = os.path.basename(script)
+    bench = replay.bench_file_name(script)
+    casa_call.rotate_bench(os.path.join(source, bench))
+    shutil.copytree(source, dest, symlinks=True,
+        ignore=shutil.ignore_patterns(bench + "*", script + ".*.json"))
+    archive = runarchive.archive_dir(os.path.join(source, bench))
+    if not os.path.isdir(archive):
+        os.makedirs(archive)
+    os.symlink(os.path.abspath(archive),
+               runarchive.archive_dir(os.path.join(dest, bench)))
+    return dest
+
+def collect_results(work, script, dest="."):
+    """
+    Copy the benchmark file of *script*, the record files of its other
+    processes, its hang dumps and its summary, status, noise and plot queue
+    files from work copy *work* to directory *dest*.
+    """
+    bench = os.path.join(work,
+                         replay.bench_file_name(os.path.basename(script)))
+    paths = casa_call.record_files(bench) + casa_call.run_files(bench, "hang")
+    for suffix in result_suffixes:
+        if os.path.exists(bench + suffix):
+            paths.append(bench + suffix)
+    for path in paths:
+        shutil.copy2(path, dest)
+
+def run_once(command, script, env, cwd=None):
+    """
+    Run *command* on *script* with environment *env* in directory *cwd*
+    (default the current directory). Return (exit status, per-task totals of
+    the run).
+    """
+    status = subprocess.call(shlex.split(command) + [script], env=env,
+                             cwd=cwd)
+    bench = replay.bench_file_name(script)
+    if cwd != None:
+        bench = os.path.join(cwd, bench)
+    totals = {}
+    if os.path.exists(bench):
+        totals = task_totals( casa_call.read_bench(bench) )
+    return status, totals
+
+def run(script, command, mode='none', target=0.05, min_runs=3, max_runs=10,
+        min_time=1.0, archive=None, verbose=True):
+    """
+    Run *script* until every task's 95% confidence interval half width is
+    below *target* times its mean, or *max_runs* runs were made. Return a
+    dictionary describing the runs.  The current directory must be the data
+    directory of the script; each run uses a fresh copy of it (see
+    reset_data).
+
+    * command = command the script name is appended to
+    * mode = page cache mode, one of cache_modes
+    * archive = directory to append each run's summary to, or None
+    """
+    samples = {}
+    runs = []
+    reason = "max_runs"
+    work = work_dir(".")
+    for i in range(1, max_runs + 1):
+        reset_data(".", work, script)
+        prepare_cache(mode, work)
+        env = dict(os.environ)
+        env["CASA_BENCH_CACHEMODE"] = mode
+        env["CASA_BENCH_REPEAT"] = str(i)
+        start = time.time()
+        status, totals = run_once(command, script, env, cwd=work)
+        runs.append( {'repeat': i, 'status': status,
+                      'wall': time.time() - start} )
+        collect_results(work, script)
+        if archive != None:
+            append_summary(replay.bench_file_name(script) + ".summary",
+                           archive)
+        if status != 0:
+            reason = "failed"
+            break
+        for task in totals:
+            samples.setdefault(task, []).append(totals[task])
+        task, width = widest(samples, min_time)
+        if verbose:
+            message = "runner: run " + str(i) + " done"
+            if width != None and task != None:
+                message += ", widest interval: " + task + \
+                    " +/- %.1f%%" % (100 * width)
+            print >> sys.stderr, message
+        if i >= min_runs and width != None and width <= target:
+            reason = "converged"
+            break
+    task, width = widest(samples, min_time)
+    return {'script': script, 'mode': mode, 'target': target,
+            'runs': runs, 'reason': reason, 'widest_task': task,
+            'widest_width': width}
+
+if __name__ == "__main__":
+    usage = """ %prog [options] SCRIPT
+
+    Run benchmark SCRIPT (written by 'extractCASAscript.py -b') repeatedly in
+    the current directory, the data directory, until the per-task timings
+    converge.  The outcome is written to SCRIPT.runner.json."""
+    parser = OptionParser( usage=usage )
+    parser.add_option( '-m', '--mode', type="choice", choices=cache_modes,
+        default='none', help="page cache mode: cold, warm or none" )
+    parser.add_option( '-c', '--command',
+        default="casapy --nologger --nogui -c",
+        help="command that runs a script [default: %default]" )
+    parser.add_option( '-w', '--width', type="float", default=0.05,
+        help="target 95%% confidence half width relative to the mean " + \
+             "[default: %default]" )
+    parser.add_option( '-n', '--max-runs', type="int", default=10,
+        help="maximum number of runs [default: %default]" )
+    parser.add_option( '-N', '--min-runs', type="int", default=3,
+        help="minimum number of runs [default: %default]" )
+    parser.add_option( '-t', '--min-time', type="float", default=1.0,
+        help="ignore tasks shorter than this many seconds " + \
+             "[default: %default]" )
+    parser.add_option( '-a', '--archive', default=None, metavar="DIR",
+        help="append the summary of every run to the summary file in DIR" )
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    result = run(args[0], options.command, mode=options.mode,
+                 target=options.width, min_runs=options.min_runs,
+                 max_runs=options.max_runs, min_time=options.min_time,
+                 archive=options.archive)
+    f = open(args[0] + ".runner.json", "w")
+    json.dump(result, f, indent=1, sort_keys=True)
+    f.close()
+    print "Runs: " + str(len(result['runs'])) + " (" + result['reason'] + ")"
+    if result['reason'] == "failed":
+        sys.exit(1)
@@ -0,0 +1,274 @@
+#!/bin/env python
+'''
+Data-size scaling benchmark.
+
+Prepare fractional versions of a data set (e.g. 1/8, 1/4, 1/2 of it) next to
+the prepared data directory, run a benchmark script on each one and on the
+full data set, and fit a power law
+
+    T(f) = c * f**k
+
+to each task's time versus the data fraction f.  Tasks with k near 1 scale
+linearly with the data; k well above 1 means super-linear scaling.
+
+Subsets are made by a pluggable backend (option -b):
+
+* casa = split every measurement set in the data directory by time range or
+  spectral window with casapy; other files are copied
+* synthetic = keep the first fraction of the bytes of every file; for
+  offline tests with a stand-in data set and replay.py (option -D)
+
+More backends are registered by adding a class with a prepare method to the
+backends dictionary.  The subsets are kept as prepared; every run, the full
+data set's included, happens in a fresh copy of its data in
+<data directory>.work (see runner.reset_data), so no run sees the output of
+an earlier one.  The fraction of a run is passed to the script in the
+environment variable CASA_BENCH_SCALE and recorded in its summary.
+'''
+
+import sys, os, os.path, math, json, shutil, shlex, subprocess
+from optparse import OptionParser
+import runner
+
+# Exponent limits for classifying scaling behavior
+linear_range = (0.8, 1.2)
+
+class SyntheticSubset:
+    """ Keep the first *fraction* of the bytes of every file. """
+    def prepare(self, source, dest, fraction, by):
+        for root, dirs, files in os.walk(source):
+            target = os.path.join(dest, os.path.relpath(root, source))
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            for name in files:
+                path = os.path.join(root, name)
+                size = int(os.path.getsize(path) * fraction)
+                fin = open(path, "rb")
+                fout = open(os.path.join(target, name), "wb")
+                while size > 0:
+                    data = fin.read(min(size, 1048576))
+                    if not data:
+                        break
+                    fout.write(data)
+                    size -= len(data)
+                fout.close()
+                fin.close()
+
+# casapy script that splits the measurement sets of the current directory
+casa_subset_script = """
+import glob, os, shutil
+fraction = %(fraction)r
+by = %(by)r
+dest = %(dest)r
+for vis in sorted(glob.glob('*.ms')):
+    ms.open(vis)
+    r = ms.range(['time', 'spectral_window_id'])
+    ms.close()
+    timerange = ''
+    spw = ''
+    if by == 'time':
+        t0 = min(r['time'])
+        t1 = t0 + fraction * (max(r['time']) - t0)
+        timerange = qa.time(qa.quantity(t0, 's'), form='ymd')[0] + '~' + \\
+            qa.time(qa.quantity(t1, 's'), form='ymd')[0]
+    else:
+        spws = sorted(r['spectral_window_id'])
+        keep = max(int(round(fraction * len(spws))), 1)
+        spw = ','.join([str(s) for s in spws[:keep]])
+    split(vis=vis, outputvis=os.path.join(dest, vis), timerange=timerange,
+          spw=spw, datacolumn='all', keepflags=True)
+"""
+
+class CasaSubset:
+    """
+    Split the measurement sets (*.ms) in the data directory with casapy by
+    time range or spectral window; copy everything else.
+    """
+    command = "casapy --nologger --nogui -c"
+
+    def prepare(self, source, dest, fraction, by):
+        os.makedirs(dest)
+        for name in os.listdir(source):
+            path = os.path.join(source, name)
+            if name.endswith(".ms"):
+                continue
+            if os.path.isdir(path):
+                shutil.copytree(path, os.path.join(dest, name), symlinks=True)
+            else:
+                shutil.copy2(path, dest)
+        script = os.path.join(dest, "subset.py")
+        f = open(script, "w")
+        f.write( casa_subset_script % {'fraction': fraction, 'by': by,
+                                       'dest': os.path.abspath(dest)} )
+        f.close()
+        status = subprocess.call(shlex.split(self.command) +
+                                 [os.path.abspath(script)], cwd=source)
+        os.remove(script)
+        if status != 0:
+            raise RuntimeError("casapy subsetting failed for fraction " +
+                               str(fraction))
+
+backends = {'casa': CasaSubset, 'synthetic': SyntheticSubset}
+
+def parse_fraction(text):
+    """ Return the value of *text*, a fraction such as '1/8' or '0.125'. """
+    if "/" in text:
+        num, den = text.split("/")
+        return float(num) / float(den)
+    return float(text)
+
+def subset_dir(source, fraction):
+    """ Return the directory holding the *fraction* subset of *source*. """
+    source = os.path.abspath(source).rstrip("/")
+    return source + ".scale" + ("%g" % fraction)
+
+def prepare_subsets(backend, source, fractions, by='time', force=False):
+    """
+    Prepare the subsets of *source* for *fractions* with *backend*. Return a
+    dictionary fraction -> directory; the full data set is used in place.
+    """
+    dirs = {}
+    for fraction in fractions:
+        if fraction >= 1.0:
+            dirs[fraction] = os.path.abspath(source)
+            continue
+        dest = subset_dir(source, fraction)
+        if os.path.isdir(dest):
+            if not force:
+                dirs[fraction] = dest
+                continue
+            shutil.rmtree(dest)
+        backend.prepare(source, dest, fraction, by)
+        dirs[fraction] = dest
+    return dirs
+
+def power_fit(fractions, times):
+    """
+    Fit T = c * f**k by least squares in log-log space. Return (c, k), or
+    None if there are fewer than two distinct positive points.
+    """
+    points = [(math.log(f), math.log(t)) for f, t in zip(fractions, times)
+              if f > 0 and t > 0]
+    if len(set([p[0] for p in points])) < 2:
+        return None
+    n = len(points)
+    mx = sum([p[0] for p in points]) / n
+    my = sum([p[1] for p in points]) / n
+    sxx = sum([(p[0] - mx) ** 2 for p in points])
+    sxy = sum([(p[0] - mx) * (p[1] - my) for p in points])
+    k = sxy / sxx
+    return math.exp(my - k * mx), k
+
+def classify(k):
+    """ Return 'sub-linear', 'linear' or 'super-linear' for exponent *k*. """
+    if k < linear_range[0]:
+        return "sub-linear"
+    if k > linear_range[1]:
+        return "super-linear"
+    return "linear"
+
+def run_scaling(script, command, dirs, verbose=True):
+    """
+    Run *script* on a fresh copy of each subset directory of *dirs*. Return
+    a dictionary task -> {fraction: time}.
+    """
+    tasks = {}
+    work = runner.work_dir(".")
+    for fraction in sorted(dirs.keys()):
+        runner.reset_data(dirs[fraction], work, script)
+        shutil.copy2(script, work)
+        if os.path.exists(script + ".expected"):
+            shutil.copy2(script + ".expected", work)
+        env = dict(os.environ)
+        env["CASA_BENCH_SCALE"] = "%g" % fraction
+        status, totals = runner.run_once(command, os.path.basename(script),
+                                         env, cwd=work)
+        if verbose:
+            print >> sys.stderr, "scaling: fraction %g" % fraction + \
+                (status and " failed" or " done")
+        if status != 0:
+            continue
+        for task in totals:
+            tasks.setdefault(task, {})[fraction] = totals[task]
+    return tasks
+
+def fit_tasks(tasks, extrapolate=None):
+    """
+    Fit every task of *tasks* (task -> {fraction: time}). Return a
+    dictionary task -> fit results, with the time predicted for a data set
+    *extrapolate* times the full size if given.
+    """
+    fits = {}
+    for task in tasks:
+        fractions = sorted(tasks[task].keys())
+        times = [tasks[task][f] for f in fractions]
+        fit = power_fit(fractions, times)
+        entry = {'fractions': fractions, 'times': times, 'coefficient': None,
+                 'exponent': None, 'scaling': None, 'predicted': None}
+        if fit != None:
+            entry['coefficient'], entry['exponent'] = fit
+            entry['scaling'] = classify(fit[1])
+            if extrapolate:
+                entry['predicted'] = fit[0] * extrapolate ** fit[1]
+        fits[task] = entry
+    return fits
+
+def print_table(fits, fractions):
+    """ Print per-task times, exponents and scaling classes. """
+    header = "%-20s" % "Task" + "".join(["%10s" % ("%g" % f)
+                                         for f in fractions])
+    print header + "%10s %-12s %10s" % ("Exponent", "Scaling", "Predicted")
+    names = sorted(fits.keys(), key=lambda task: -max(fits[task]['times']))
+    for task in names:
+        entry = fits[task]
+        row = "%-20s" % task
+        for f in fractions:
+            if f in entry['fractions']:
+                row += "%10.1f" % entry['times'][entry['fractions'].index(f)]
+            else:
+                row += "%10s" % "-"
+        if entry['exponent'] == None:
+            row += "%10s %-12s" % ("-", "-")
+        else:
+            row += "%10.2f %-12s" % (entry['exponent'], entry['scaling'])
+        if entry['predicted'] != None:
+            row += "%10.1f" % entry['predicted']
+        print row
+
+if __name__ == "__main__":
+    usage = """ %prog [options] SCRIPT
+
+    Run benchmark SCRIPT (written by 'extractCASAscript.py -b') on fractions
+    of the data set in the current directory, the prepared data directory,
+    and fit per-task time versus data size.  The subsets are kept next to
+    the data directory for later runs; the results are written to
+    SCRIPT.scaling.json."""
+    parser = OptionParser( usage=usage )
+    parser.add_option( '-f', '--fractions', default="1/8,1/4,1/2,1",
+        help="comma separated data fractions [default: %default]" )
+    parser.add_option( '-b', '--backend', type="choice",
+        choices=sorted(backends.keys()), default='casa',
+        help="subsetting backend: casa or synthetic [default: %default]" )
+    parser.add_option( '-y', '--by', type="choice", choices=['time', 'spw'],
+        default='time', help="subset by time range or spw (casa backend)" )
+    parser.add_option( '-c', '--command',
+        default="casapy --nologger --nogui -c",
+        help="command that runs a script [default: %default]" )
+    parser.add_option( '-x', '--extrapolate', type="float", default=None,
+        help="predict task times for a data set this many times larger" )
+    parser.add_option( '--force', action="store_true", default=False,
+        help="prepare subsets again even if they exist" )
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    fractions = sorted([parse_fraction(f)
+                        for f in options.fractions.split(",")])
+    dirs = prepare_subsets(backends[options.backend](), ".", fractions,
+                           options.by, options.force)
+    tasks = run_scaling(args[0], options.command, dirs)
+    fits = fit_tasks(tasks, options.extrapolate)
+    print_table(fits, fractions)
+    f = open(args[0] + ".scaling.json", "w")
+    json.dump(fits, f, indent=1, sort_keys=True)
+    f.close()
@@ -0,0 +1,675 @@
+#!/bin/env python
+'''
+Split a casapy script into stages that can run concurrently.
+
+The compressed statements of a script (see extractCASAscript.compress_lines)
+are grouped into top level blocks.  For each block the Python names it
+defines and uses and the files its task calls read and write (the vis=,
+outputvis=, imagename=, caltable=, ... arguments) are determined.  Blocks
+that only compute values from literals ("prelude" blocks) are copied into
+every stage.  Other blocks become nodes of a def-use dependency graph:
+
+* a block that uses a name defined by another node must run in the same
+  process, so the two are merged;
+* a block that reads or writes a file written by an earlier block, or writes
+  a file an earlier block reads, depends on it;
+* statements whose effect cannot be determined (calls of tools or unknown
+  functions, task calls without file arguments, shell commands other than
+  rm) are barriers that depend on everything before them.
+
+A file written is taken to include the files derived from its name, so a
+clean with imagename='img' comes before an imstat of 'img.image', and a
+uvcontsub of 'x.ms' before a clean of 'x.ms.contsub'.  Numbers, booleans and
+None given for file arguments are ignored.  The dependency graph is condensed
+into a DAG of stages, stages without task calls are folded into a
+neighbouring stage, and chains of stages with no fan-in or fan-out are
+merged.
+
+Run from the command line, this module executes the stages listed in a
+manifest written by 'extractCASAscript.py -b -s', starting each stage as soon
+as the stages it depends on have finished.
+'''
+
+import ast, re, json, sys, time, shlex, subprocess
+from optparse import OptionParser
+
+# Keyword arguments of tasks that name files
+file_keywords = ['vis', 'outputvis', 'imagename', 'caltable', 'gaintable',
+    'infile', 'infiles', 'outfile', 'fitsimage', 'fitsfile', 'tablename',
+    'tablenames', 'fluxtable', 'concatvis', 'mask', 'modelimage', 'asdm',
+    'output', 'outputfile', 'template', 'outtable', 'model']
+
+# File keyword arguments that are always written
+write_keywords = ['outputvis', 'caltable', 'fluxtable', 'outfile',
+    'concatvis', 'output', 'outputfile', 'fitsimage', 'outtable']
+
+# Tasks that only read the files given by keywords not in write_keywords.
+# Every other task is assumed to write all the files it is given.
+read_only_tasks = ['listobs', 'listcal', 'listvis', 'listhistory', 'plotms',
+    'plotants', 'plotcal', 'plotuv', 'plotxy', 'plotbandpass', 'plotweather',
+    'visstat', 'imstat', 'imval', 'imview', 'viewer', 'gaincal', 'bandpass',
+    'polcal', 'blcal', 'split', 'mstransform', 'cvel', 'concat', 'exportfits',
+    'exportuvfits', 'exportasdm', 'calstat', 'imfit', 'uvmodelfit',
+    'fluxscale', 'smoothcal', 'listsdm', 'asdmsummary']
+
+# Functions without side effects
+pure_functions = ['str', 'int', 'float', 'len', 'range', 'xrange', 'round',
+    'abs', 'min', 'max', 'sum', 'list', 'dict', 'tuple', 'set', 'sorted',
+    'zip', 'enumerate', 'map', 'filter', 'bool', 'repr', 'type', 'isinstance',
+    'reversed', 'any', 'all']
+
+# Modules and tools whose methods have no side effects
+pure_objects = ['os.path', 'string', 'math', 'np', 'numpy', 're', 'qa', 'pl']
+
+# casapy tools; calling their methods is a barrier
+casa_tools = ['tb', 'ms', 'ia', 'cb', 'im', 'cl', 'fg', 'af', 'me', 'rg',
+    'sm', 'cs', 'mp', 'tp', 'vp', 'at', 'ca', 'sl', 'dc', 'imd', 'msmd',
+    'au', 'aU', 'es']
+
+# Shell commands (via os.system) that do not modify files
+read_only_commands = ['ls', 'pwd', 'echo', 'du', 'df', 'cat', 'more',
+    'less', 'head', 'tail', 'date']
+
+# Resource that conflicts with every file
+anything = '*'
+
+# Names of constants that are never file names
+constant_names = ['True', 'False', 'None']
+
+class Block:
+    """
+    A top level statement of the script with the statements nested in it.
+
+    * index = position among the blocks of the script
+    * statements = indices of the compressed statements in the block
+    * source = Python source of the block
+    """
+    def __init__(self, index, statements, source):
+        self.index = index
+        self.statements = statements
+        self.source = source
+        self.defs = set()
+        self.uses = set()
+        self.reads = set()
+        self.writes = set()
+        self.calls_tasks = False
+        self.prelude = False
+
+class Stage:
+    """
+    A group of blocks run by one script.
+
+    * id = stage number, in a topological order of the stages
+    * statements = indices of the compressed statements of the stage,
+      including the prelude statements it needs
+    * depends_on = ids of the stages that must finish first
+    """
+    def __init__(self, id, statements, depends_on):
+        self.id = id
+        self.statements = statements
+        self.depends_on = depends_on
+
+def is_continuation(statement):
+    """
+    Tests if a top level statement continues the block before it (blank
+    lines, comments and else/elif/except/finally clauses).
+    """
+    stripped = statement.strip()
+    if stripped == '' or stripped.startswith('#'):
+        return True
+    if indentation(statement) > 0:
+        return True
+    return re.match(r'(else|elif|except|finally)\b', stripped) != None
+
+def indentation(statement):
+    return len(statement) - len(statement.lstrip(' '))
+
+def make_blocks(statements):
+    """ Group compressed *statements* into a list of Blocks. """
+    groups = []
+    for i, statement in enumerate(statements):
+        if groups and is_continuation(statement):
+            groups[-1].append(i)
+        else:
+            groups.append([i])
+    blocks = []
+    for index, group in enumerate(groups):
+        source = '\n'.join([statements[i] for i in group])
+        blocks.append( Block(index, group, source) )
+    return blocks
+
+def dotted_name(node):
+    """ Return 'a.b.c' for an attribute chain, or None. """
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        base = dotted_name(node.value)
+        if base != None:
+            return base + '.' + node.attr
+    return None
+
+def resolve(node, env):
+    """
+    Return the list of strings an argument expression evaluates to, using the
+    literal values of names in *env*, or None if it cannot be determined.
+    """
+    if isinstance(node, ast.Str):
+        return [node.s]
+    if isinstance(node, ast.Name) and node.id in env:
+        return env[node.id]
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        left = resolve(node.left, env)
+        right = resolve(node.right, env)
+        if left == None or right == None:
+            return None
+        if len(left) == 1 or len(right) == 1:
+            # e.g. a loop variable over a list of names plus a suffix
+            return [l + r for l in left for r in right]
+        return None
+    if isinstance(node, (ast.List, ast.Tuple)):
+        values = []
+        for elt in node.elts:
+            value = resolve(elt, env)
+            if value == None:
+                return None
+            values += value
+        return values
+    return None
+
+def is_constant(node):
+    """ Tests if argument expression *node* is a number, bool or None. """
+    if isinstance(node, ast.Num):
+        return True
+    return isinstance(node, ast.Name) and node.id in constant_names
+
+def file_resources(values):
+    """ Return the file names in argument *values* (None = unknown). """
+    if values == None:
+        return set([anything])
+    names = set()
+    for value in values:
+        for name in value.split(','):
+            name = name.strip()
+            if name != '':
+                names.add(name.rstrip('/'))
+    return names
+
+def shell_resources(command):
+    """
+    Return (reads, writes) for a shell command run with os.system.
+    """
+    words = command.split()
+    if not words:
+        return set(), set()
+    if words[0] in read_only_commands:
+        return set(), set()
+    if words[0] in ['rm', 'cp', 'mv', 'mkdir', 'touch']:
+        names = set()
+        for word in words[1:]:
+            if word.startswith('-'):
+                continue
+            word = re.split(r'[\*\?\[]', word)[0].rstrip('.').rstrip('/')
+            if word == '':
+                return set(), set([anything])
+            names.add(word)
+        return set(), names
+    return set(), set([anything])
+
+class BlockVisitor(ast.NodeVisitor):
+    """ Collect the names and files a block defines, uses, reads and writes. """
+    def __init__(self, block, env, casa_tasks):
+        self.block = block
+        self.env = env
+        self.casa_tasks = casa_tasks
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, (ast.Store, ast.Param, ast.Del)):
+            self.block.defs.add(node.id)
+        else:
+            self.block.uses.add(node.id)
+
+    def visit_AugAssign(self, node):
+        if isinstance(node.target, ast.Name):
+            self.block.uses.add(node.target.id)
+        self.generic_visit(node)
+
+    def visit_For(self, node):
+        # The loop variable takes each value of a list of literals in turn
+        values = resolve(node.iter, self.env)
+        if values != None and isinstance(node.target, ast.Name):
+            saved = self.env.get(node.target.id)
+            self.env[node.target.id] = values
+            self.generic_visit(node)
+            if saved == None:
+                del self.env[node.target.id]
+            else:
+                self.env[node.target.id] = saved
+        else:
+            self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        # The body runs only when the function is called, which is a barrier
+        self.block.defs.add(node.name)
+
+    def visit_ClassDef(self, node):
+        self.block.defs.add(node.name)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self.block.defs.add( (alias.asname or alias.name).split('.')[0] )
+
+    def visit_ImportFrom(self, node):
+        for alias in node.names:
+            self.block.defs.add(alias.asname or alias.name)
+
+    def visit_Exec(self, node):
+        self.block.writes.add(anything)
+        self.generic_visit(node)
+
+    def visit_Call(self, node):
+        name = dotted_name(node.func)
+        if name in self.casa_tasks:
+            self.task_call(name, node)
+        elif name == 'os.system':
+            command = None
+            if node.args:
+                command = resolve(node.args[0], self.env)
+            if command == None or len(command) != 1:
+                self.block.writes.add(anything)
+            else:
+                reads, writes = shell_resources(command[0])
+                self.block.reads.update(reads)
+                self.block.writes.update(writes)
+        elif name in pure_functions:
+            pass
+        elif name != None and '.' in name:
+            base = name.rsplit('.', 1)[0]
+            if base.split('.')[0] in casa_tools and base not in pure_objects:
+                self.block.writes.add(anything)
+            # Methods of ordinary values (str.join, list.append) are pure
+        elif isinstance(node.func, ast.Attribute):
+            pass
+        else:
+            self.block.writes.add(anything)
+        self.generic_visit(node)
+
+    def task_call(self, task, node):
+        self.block.calls_tasks = True
+        read_only = task in read_only_tasks
+        if not node.args and not node.keywords:
+            # Parameters are taken from global variables
+            self.block.writes.add(anything)
+        if node.starargs != None or node.kwargs != None:
+            self.block.writes.add(anything)
+        for arg in node.args:
+            if is_constant(arg):
+                continue
+            names = file_resources( resolve(arg, self.env) )
+            if read_only:
+                self.block.reads.update(names)
+            else:
+                self.block.writes.update(names)
+        for keyword in node.keywords:
+            if keyword.arg not in file_keywords or is_constant(keyword.value):
+                continue
+            names = file_resources( resolve(keyword.value, self.env) )
+            if keyword.arg in write_keywords or not read_only:
+                self.block.writes.update(names)
+            else:
+                self.block.reads.update(names)
+
+def analyze_blocks(blocks, casa_tasks):
+    """
+    Fill in the names and files of each block and decide which blocks are
+    prelude blocks. Return the map from name to the block defining it last.
+    """
+    env = {}
+    definer = {}
+    for block in blocks:
+        try:
+            tree = ast.parse(block.source.strip('\n') + '\n')
+        except SyntaxError:
+            block.writes.add(anything)
+            continue
+        BlockVisitor(block, env, casa_tasks).visit(tree)
+        block.prelude = not block.calls_tasks and not block.reads and \
+            not block.writes
+        for name in block.uses:
+            if name in definer and not definer[name].prelude:
+                block.prelude = False
+        # Remember literal values assigned by prelude blocks
+        for name in block.defs:
+            env.pop(name, None)
+            definer[name] = block
+        if block.prelude:
+            for statement in tree.body:
+                if isinstance(statement, ast.Assign) and \
+                        len(statement.targets) == 1 and \
+                        isinstance(statement.targets[0], ast.Name):
+                    value = resolve(statement.value, env)
+                    if value != None:
+                        env[statement.targets[0].id] = value
+    return definer
+
+def covers(written, name):
+    """
+    Tests if writing file *written* may change file *name*.  A task writing
+    'img' also writes the files 'img.image', 'img.model', ..., and one
+    writing 'x.ms' may create 'x.ms.contsub' or 'x.ms.flagversions'.
+    """
+    if written == anything or name == anything:
+        return True
+    return name == written or (name.startswith(written) and
+                               name[len(written)] in './')
+
+def conflicts(first, second):
+    """ Tests if *second* must run after *first* because of their files. """
+    for written in first.writes:
+        for name in second.reads:
+            if covers(written, name):
+                return True
+        for name in second.writes:
+            if covers(written, name) or covers(name, written):
+                return True
+    for read in first.reads:
+        for name in second.writes:
+            if covers(name, read):
+                return True
+    return False
+
+def find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def union(parent, i, j):
+    parent[find(parent, i)] = find(parent, j)
+
+def reaches(edges, start, goal, skip_direct=False):
+    """ Tests if node *goal* can be reached from *start*. """
+    stack = [n for n in edges[start] if not (skip_direct and n == goal)]
+    seen = set()
+    while stack:
+        node = stack.pop()
+        if node == goal:
+            return True
+        if node in seen:
+            continue
+        seen.add(node)
+        stack += list(edges[node])
+    return False
+
+def strongly_connected(edges):
+    """
+    Return the strongly connected components of *edges* (a dict from node to
+    set of successor nodes) as lists of nodes, by Tarjan's algorithm.
+    """
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    components = []
+    for root in edges:
+        if root in index:
+            continue
+        work = [(root, iter(edges[root]))]
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, successors = work[-1]
+            descended = False
+            for succ in successors:
+                if succ not in index:
+                    index[succ] = low[succ] = len(index)
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append( (succ, iter(edges[succ])) )
+                    descended = True
+                    break
+                if succ in on_stack:
+                    low[node] = min(low[node], index[succ])
+            if descended:
+                continue
+            work.pop()
+            if work:
+                low[work[-1][0]] = min(low[work[-1][0]], low[node])
+            if low[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+    return components
+
+def condense(edges, parent):
+    """
+    Merge the groups on each cycle of *edges* (a dict from group to set of
+    successor groups), so that the group graph becomes a DAG. Return True if
+    any were merged.
+    """
+    merged = False
+    for component in strongly_connected(edges):
+        for group in component[1:]:
+            union(parent, group, component[0])
+            merged = True
+    return merged
+
+def direct_edges(edges, group):
+    """
+    Return the direct predecessors and successors of *group* in DAG *edges*:
+    those not also reached through another group.
+    """
+    preds = [p for p in edges if group in edges[p] and
+             not reaches(edges, p, group, skip_direct=True)]
+    succs = [s for s in edges[group]
+             if not reaches(edges, group, s, skip_direct=True)]
+    return preds, succs
+
+def group_edges(nodes, pairs, parent):
+    """ Return the edges between groups implied by block edges *pairs*. """
+    groups = set([find(parent, n) for n in nodes])
+    edges = dict([(g, set()) for g in groups])
+    for i, j in pairs:
+        gi = find(parent, i)
+        gj = find(parent, j)
+        if gi != gj:
+            edges[gi].add(gj)
+    return edges
+
+def split_stages(statements, casa_tasks):
+    """
+    Split compressed *statements* into stages. Return a list of Stages in
+    a topological order.
+
+    * statements = compressed Python statements of the script
+    * casa_tasks = names of the casapy tasks
+    """
+    blocks = make_blocks(statements)
+    analyze_blocks(blocks, casa_tasks)
+    nodes = [block.index for block in blocks if not block.prelude]
+    parent = dict([(n, n) for n in nodes])
+
+    # Blocks sharing non-prelude variables run in the same process
+    definer = {}
+    for block in blocks:
+        if block.prelude:
+            for name in block.defs:
+                definer.pop(name, None)
+            continue
+        for name in block.uses:
+            if name in definer:
+                union(parent, block.index, definer[name])
+        for name in block.defs:
+            definer[name] = block.index
+
+    # File dependencies between blocks
+    pairs = []
+    for a in nodes:
+        for b in nodes:
+            if a < b and conflicts(blocks[a], blocks[b]):
+                pairs.append( (a, b) )
+
+    # Shell commands that clear files before a task recreates them are part
+    # of that task's preparation
+    for a in nodes:
+        block = blocks[a]
+        if block.calls_tasks or anything in block.writes:
+            continue
+        later = [b for (first, b) in pairs if first == a]
+        if later:
+            union(parent, a, min(later))
+
+    # Condense cycles between groups so that the group graph is a DAG
+    condense(group_edges(nodes, pairs, parent), parent)
+
+    # Fold groups without task calls (e.g. clean-up shell commands, tool
+    # calls) into a neighbouring group: an earlier one they depend on
+    # directly, else a later one depending on them directly, else the group
+    # nearest in the script.  Merging along a direct edge keeps the DAG.
+    merged = True
+    while merged:
+        merged = False
+        edges = group_edges(nodes, pairs, parent)
+        if len(edges) < 2:
+            break
+        members = {}
+        for n in nodes:
+            members.setdefault(find(parent, n), []).append(n)
+        for g in sorted(edges.keys(), key=lambda g: min(members[g])):
+            if [n for n in members[g] if blocks[n].calls_tasks]:
+                continue
+            preds, succs = direct_edges(edges, g)
+            if preds:
+                target = max(preds, key=lambda p: max(members[p]))
+            elif succs:
+                target = min(succs, key=lambda s: min(members[s]))
+            else:
+                target = min([h for h in edges if h != g],
+                    key=lambda h: min([abs(a - b) for a in members[g]
+                                       for b in members[h]]))
+            union(parent, g, target)
+            merged = True
+            break
+
+    # Merge chains: a group with one successor that has it as only predecessor
+    merged = True
+    while merged:
+        merged = False
+        edges = group_edges(nodes, pairs, parent)
+        for g in edges:
+            direct = direct_edges(edges, g)[1]
+            if len(direct) != 1:
+                continue
+            successor = direct[0]
+            if direct_edges(edges, successor)[0] == [g]:
+                union(parent, successor, g)
+                merged = True
+                break
+
+    # Order the groups topologically, earliest statement first
+    edges = group_edges(nodes, pairs, parent)
+    members = {}
+    for n in nodes:
+        members.setdefault(find(parent, n), []).append(n)
+    order = []
+    remaining = sorted(members.keys(), key=lambda g: min(members[g]))
+    while remaining:
+        for g in remaining:
+            if not [p for p in remaining if g in edges[p]]:
+                order.append(g)
+                remaining.remove(g)
+                break
+    ids = dict([(g, i + 1) for i, g in enumerate(order)])
+
+    stages = []
+    for g in order:
+        last = max(members[g])
+        indices = []
+        for block in blocks:
+            if block.index in members[g] or \
+                    (block.prelude and block.index < last):
+                indices += block.statements
+        depends_on = sorted([ids[p] for p in order if g in edges[p] and
+                             not reaches(edges, p, g, skip_direct=True)])
+        stages.append( Stage(ids[g], sorted(indices), depends_on) )
+    return stages
+
+def write_manifest(fname, script, stages):
+    """
+    Write the DAG manifest of a split script as JSON.
+
+    * fname = manifest file name
+    * script = name of the monolithic script
+    * stages = list of dictionaries with keys id, script, depends_on, tasks
+    """
+    f = open(fname, 'w')
+    json.dump( {'script': script, 'stages': stages}, f, indent=1,
+               sort_keys=True )
+    f.close()
+
+def run_stages(manifest, command, jobs=1):
+    """
+    Run the stage scripts of *manifest* (as read from a manifest file),
+    at most *jobs* at a time. Return the elapsed wall time, or None if a
+    stage failed.
+
+    * command = command line that runs one script, e.g. 'casapy -c'; the
+      script name is appended
+    """
+    stages = dict([(stage['id'], stage) for stage in manifest['stages']])
+    done = set()
+    running = {}
+    start = time.time()
+    failed = False
+    while len(done) < len(stages) and not failed:
+        for id in sorted(stages.keys()):
+            if len(running) >= jobs:
+                break
+            if id in done or id in running:
+                continue
+            if set(stages[id]['depends_on']).issubset(done):
+                print "Starting stage " + str(id) + ": " + stages[id]['script']
+                running[id] = subprocess.Popen(
+                    shlex.split(command) + [stages[id]['script']] )
+        time.sleep(0.1)
+        for id in running.keys():
+            status = running[id].poll()
+            if status == None:
+                continue
+            del running[id]
+            if status != 0:
+                print "Stage " + str(id) + " failed with status " + str(status)
+                failed = True
+            done.add(id)
+    for process in running.values():
+        process.wait()
+    if failed:
+        return None
+    return time.time() - start
+
+if __name__ == "__main__":
+    usage = """ %prog [options] MANIFEST
+
+    Run the stages in MANIFEST (a .stages.json file) concurrently."""
+    parser = OptionParser( usage=usage )
+    parser.add_option( '-j', '--jobs', type="int", default=1,
+        help="number of stages to run at the same time" )
+    parser.add_option( '-c', '--command',
+        default="casapy --nologger --nogui -c",
+        help="command that runs one stage script (default: %default)" )
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    f = open(args[0])
+    manifest = json.load(f)
+    f.close()
+    elapsed = run_stages(manifest, options.command, options.jobs)
+    if elapsed == None:
+        sys.exit(1)
+    print "All stages finished in %.1f s" % elapsed
@@ -0,0 +1,208 @@
+'''
+Streaming statistics of task call durations.
+
+casa_call keeps one TaskStats per task while a benchmark runs, updated in
+constant time per call: the count, sum, minimum and maximum, the mean and
+variance by Welford's method and a quantile sketch.  The sketch counts
+durations in logarithmic buckets, bucket i holding the durations in
+(gamma**(i-1), gamma**i] with gamma = (1 + a) / (1 - a), so that every
+quantile is estimated to within a relative error a (sketch_accuracy).
+Sketches of the same accuracy merge by adding bucket counts, so the
+statistics of processes or runs can be combined.
+
+The statistics of a run are written to its summary as a "Statistics:" line
+of JSON (see RunStats.to_dict) and read back with run_from_dict.  This
+module uses only the standard library.
+'''
+
+import math
+
+# Relative accuracy of the quantile estimates
+sketch_accuracy = 0.01
+
+# Durations up to this many seconds count as zero in the sketch
+min_duration = 1e-6
+
+class TaskStats:
+    """ Running statistics of the call durations of one task. """
+    def __init__(self, accuracy=None):
+        if accuracy == None:
+            accuracy = sketch_accuracy
+        self.accuracy = accuracy
+        self.gamma = (1.0 + accuracy) / (1.0 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.count = 0
+        self.total = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.zeros = 0
+        self.buckets = {}
+
+    def add(self, value):
+        """ Add duration *value* (seconds). """
+        self.count += 1
+        self.total += value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.min == None or value < self.min:
+            self.min = value
+        if self.max == None or value > self.max:
+            self.max = value
+        if value <= min_duration:
+            self.zeros += 1
+        else:
+            index = int(math.ceil(math.log(value) / self.log_gamma))
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other):
+        """ Add the statistics of *other*, of the same accuracy. """
+        if other.count == 0:
+            return
+        if other.accuracy != self.accuracy:
+            raise ValueError("cannot merge sketches of different accuracy")
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.total += other.total
+        for value in [other.min, other.max]:
+            if self.min == None or value < self.min:
+                self.min = value
+            if self.max == None or value > self.max:
+                self.max = value
+        self.zeros += other.zeros
+        for index, n in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + n
+
+    def variance(self):
+        """ Return the sample variance, or None for fewer than two calls. """
+        if self.count < 2:
+            return None
+        return self.m2 / (self.count - 1)
+
+    def std(self):
+        variance = self.variance()
+        if variance == None:
+            return None
+        return math.sqrt(max(variance, 0.0))
+
+    def bucket_value(self, index):
+        """ Return the representative duration of bucket *index*. """
+        return 2.0 * self.gamma ** index / (self.gamma + 1.0)
+
+    def quantile(self, q):
+        """
+        Return the estimated nearest-rank *q* quantile (0 <= q <= 1), as
+        casa_call.percentile computes it from the call times, or None.
+        """
+        if self.count == 0:
+            return None
+        rank = max(int(math.ceil(q * self.count)), 1)
+        seen = self.zeros
+        if rank <= seen:
+            return self.min
+        for index in sorted(self.buckets.keys()):
+            seen += self.buckets[index]
+            if rank <= seen:
+                value = self.bucket_value(index)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def count_below(self, bound):
+        """ Return the estimated number of calls taking at most *bound*. """
+        count = self.zeros
+        for index, n in self.buckets.items():
+            if self.bucket_value(index) <= bound:
+                count += n
+        return count
+
+    def to_dict(self):
+        """ Return the statistics as a dictionary that JSON can hold. """
+        return {'count': self.count, 'total': self.total, 'mean': self.mean,
+                'm2': self.m2, 'min': self.min, 'max': self.max,
+                'std': self.std(), 'p50': self.quantile(0.5),
+                'p90': self.quantile(0.9), 'p99': self.quantile(0.99),
+                'accuracy': self.accuracy, 'zeros': self.zeros,
+                'buckets': dict([(str(i), n)
+                                 for i, n in self.buckets.items()])}
+
+class RunStats:
+    """
+    Running statistics of a benchmark run: a TaskStats per task and the
+    time span of the logged calls.
+    """
+    def __init__(self, accuracy=None):
+        self.accuracy = accuracy
+        self.tasks = {}
+        self.start = None
+        self.stop = None
+
+    def add(self, task, start, stop, delta):
+        """ Add a call of *task* from *start* to *stop* lasting *delta*. """
+        if task not in self.tasks:
+            self.tasks[task] = TaskStats(self.accuracy)
+        self.tasks[task].add(delta)
+        if self.start == None or start < self.start:
+            self.start = start
+        if self.stop == None or stop > self.stop:
+            self.stop = stop
+
+    def merge(self, other):
+        """ Add the statistics of run or process *other*. """
+        for task, stats in other.tasks.items():
+            if task not in self.tasks:
+                self.tasks[task] = TaskStats(stats.accuracy)
+            self.tasks[task].merge(stats)
+        for value in [other.start, other.stop]:
+            if value == None:
+                continue
+            if self.start == None or value < self.start:
+                self.start = value
+            if self.stop == None or value > self.stop:
+                self.stop = value
+
+    def calls(self):
+        return sum([stats.count for stats in self.tasks.values()])
+
+    def logged(self):
+        """ Return the time spent inside logged calls. """
+        return sum([stats.total for stats in self.tasks.values()])
+
+    def total_time(self):
+        """ Return the time from the first call's start to the last's end. """
+        if self.start == None:
+            return 0.0
+        return self.stop - self.start
+
+    def to_dict(self):
+        return {'start': self.start, 'stop': self.stop,
+                'tasks': dict([(task, stats.to_dict())
+                               for task, stats in self.tasks.items()])}
+
+def task_from_dict(data):
+    """ Return the TaskStats written by TaskStats.to_dict as *data*. """
+    stats = TaskStats(data['accuracy'])
+    for name in ['count', 'total', 'mean', 'm2', 'min', 'max', 'zeros']:
+        setattr(stats, name, data[name])
+    stats.buckets = dict([(int(i), n) for i, n in data['buckets'].items()])
+    return stats
+
+def run_from_dict(data):
+    """ Return the RunStats written by RunStats.to_dict as *data*. """
+    run = RunStats()
+    run.start = data['start']
+    run.stop = data['stop']
+    run.tasks = dict([(task, task_from_dict(stats))
+                      for task, stats in data['tasks'].items()])
+    return run
+
+def run_from_records(records, accuracy=None):
+    """ Return the RunStats of timing *records* (see casa_call.read_bench). """
+    run = RunStats(accuracy)
+    for rec in records:
+        run.add(rec['task'], rec['start'], rec['stop'], rec['delta'])
+    return run
@@ -0,0 +1,237 @@
+#!/bin/env python
+'''
+Thread and parallelism sweep of a benchmark script.
+
+Run a prepared benchmark script once per configuration in a matrix of
+OMP_NUM_THREADS values, CPU affinity masks (applied with taskset) and
+optional mpicasa process counts, and collect the per-task times of every
+configuration.  For each task the speedup and parallel efficiency against
+the configuration with the fewest cores are tabulated, and Amdahl's law,
+
+    T(p) = T(1) * (s + (1 - s) / p),
+
+is fitted to give the serial fraction s.  Tasks with a small serial fraction
+are the ones worth buying more cores for.
+
+Every configuration and repetition runs in a fresh copy of the prepared data
+directory, <data directory>.work (see runner.reset_data), so that all
+configurations are compared on the same input.
+
+The sweep works offline with replay.py as the command; with its option -P
+the fake tasks scale with OMP_NUM_THREADS.
+'''
+
+import sys, os, os.path, json
+from optparse import OptionParser
+import runner
+
+class Config:
+    """
+    One sweep configuration.
+
+    * threads = OMP_NUM_THREADS value
+    * mask = taskset CPU list (e.g. '0-3'), or None for no affinity
+    * procs = mpicasa process count, or None to run without mpicasa
+    """
+    def __init__(self, threads, mask=None, procs=None):
+        self.threads = threads
+        self.mask = mask
+        self.procs = procs
+
+    def cores(self):
+        """ Return the number of cores the configuration can use. """
+        cores = self.threads * (self.procs or 1)
+        if self.mask != None:
+            cores = min(cores, mask_size(self.mask))
+        return cores
+
+    def label(self):
+        label = "t" + str(self.threads)
+        if self.procs != None:
+            label += "p" + str(self.procs)
+        if self.mask != None:
+            label += "m" + self.mask
+        return label
+
+    def command(self, base):
+        """ Return the command line for *base* in this configuration. """
+        command = base
+        if self.procs != None:
+            command = "mpicasa -n " + str(self.procs) + " " + command
+        if self.mask != None:
+            command = "taskset -c " + self.mask + " " + command
+        return command
+
+    def environment(self):
+        env = dict(os.environ)
+        env["OMP_NUM_THREADS"] = str(self.threads)
+        return env
+
+def mask_size(mask):
+    """ Return the number of CPUs in taskset CPU list *mask*. """
+    count = 0
+    for item in mask.split(","):
+        if "-" in item:
+            first, last = item.split("-")
+            count += int(last) - int(first) + 1
+        elif item != "":
+            count += 1
+    return count
+
+def make_configs(threads, masks=[None], procs=[None]):
+    """ Return the configurations of the full matrix, fewest cores first. """
+    configs = []
+    for t in threads:
+        for mask in masks:
+            for p in procs:
+                configs.append( Config(t, mask, p) )
+    configs.sort(key=lambda config: config.cores())
+    return configs
+
+def amdahl_fit(cores, times):
+    """
+    Fit T(p) = a + b / p to *times* measured on *cores*. Return the serial
+    fraction s = a / (a + b), clipped to [0, 1], or None if it cannot be
+    determined.
+    """
+    n = len(cores)
+    if n < 2 or len(set(cores)) < 2:
+        return None
+    x = [1.0 / p for p in cores]
+    mx = sum(x) / n
+    my = sum(times) / n
+    sxx = sum([(xi - mx) ** 2 for xi in x])
+    sxy = sum([(xi - mx) * (yi - my) for xi, yi in zip(x, times)])
+    b = sxy / sxx
+    a = my - b * mx
+    if a + b <= 0:
+        return None
+    return min(max(a / (a + b), 0.0), 1.0)
+
+def sweep(script, base, configs, repeat=1, verbose=True):
+    """
+    Run *script* with command *base* in each of *configs*, *repeat* times.
+    Return a list of (config, per-task times) with the fastest time of each
+    task over the repetitions; failed configurations are left out.  The
+    current directory must be the data directory of the script.
+    """
+    results = []
+    work = runner.work_dir(".")
+    for config in configs:
+        best = {}
+        failed = False
+        for i in range(repeat):
+            runner.reset_data(".", work, script)
+            status, totals = runner.run_once(config.command(base), script,
+                                             config.environment(), cwd=work)
+            runner.collect_results(work, script)
+            if status != 0:
+                failed = True
+                break
+            for task in totals:
+                if task not in best or totals[task] < best[task]:
+                    best[task] = totals[task]
+        if verbose:
+            print >> sys.stderr, "sweep: " + config.label() + \
+                (failed and " failed" or " done")
+        if not failed:
+            results.append( (config, best) )
+    return results
+
+def scaling(results):
+    """
+    Return a dictionary task -> {'cores', 'times', 'speedup', 'efficiency',
+    'serial_fraction'} from sweep *results*; speedups are relative to the
+    configuration with the fewest cores.  The pseudo task 'total' covers the
+    sum of all tasks.
+    """
+    tasks = {}
+    for config, times in results:
+        times = dict(times)
+        times['total'] = sum(times.values())
+        for task in times:
+            entry = tasks.setdefault(task, {'cores': [], 'times': []})
+            entry['cores'].append(config.cores())
+            entry['times'].append(times[task])
+    for task in tasks:
+        entry = tasks[task]
+        base_cores = entry['cores'][0]
+        base_time = entry['times'][0]
+        entry['speedup'] = []
+        entry['efficiency'] = []
+        for cores, t in zip(entry['cores'], entry['times']):
+            speedup = base_time / max(t, 1e-9)
+            entry['speedup'].append(speedup)
+            entry['efficiency'].append(speedup * base_cores / float(cores))
+        entry['serial_fraction'] = amdahl_fit(entry['cores'], entry['times'])
+    return tasks
+
+def print_tables(results, tasks):
+    """ Print per-task speedup and efficiency tables. """
+    labels = [config.label() for config, times in results]
+    names = sorted(tasks.keys(), key=lambda task: -tasks[task]['times'][0])
+    for title, key, fmt in [("Time (s)", 'times', "%10.1f"),
+                            ("Speedup", 'speedup', "%10.2f"),
+                            ("Efficiency", 'efficiency', "%10.2f")]:
+        print title
+        print "%-20s" % "Task" + "".join(["%10s" % l for l in labels]) + \
+            "%10s" % "Serial"
+        for task in names:
+            entry = tasks[task]
+            serial = entry['serial_fraction']
+            row = "%-20s" % task + "".join([fmt % v for v in entry[key]])
+            if serial == None:
+                row += "%10s" % "-"
+            else:
+                row += "%10.2f" % serial
+            print row
+        print
+
+def parse_list(text, convert=str):
+    """ Split colon separated *text*; [None] for empty input. """
+    if not text:
+        return [None]
+    return [convert(item) for item in text.split(":")]
+
+if __name__ == "__main__":
+    usage = """ %prog [options] SCRIPT
+
+    Run benchmark SCRIPT (written by 'extractCASAscript.py -b') in the
+    current directory, the prepared data directory, once per configuration
+    and print per-task speedup, efficiency and Amdahl serial fraction.  The
+    results are also written to SCRIPT.sweep.json."""
+    parser = OptionParser( usage=usage )
+    parser.add_option( '-c', '--command',
+        default="casapy --nologger --nogui -c",
+        help="command that runs a script [default: %default]" )
+    parser.add_option( '-t', '--threads', default="1,2,4,8",
+        help="comma separated OMP_NUM_THREADS values [default: %default]" )
+    parser.add_option( '-a', '--affinity', default=None,
+        help="colon separated taskset CPU lists, e.g. '0-3:0,2,4,6'; " + \
+             "'compact' binds each configuration to its first cores" )
+    parser.add_option( '-p', '--procs', default=None,
+        help="colon separated mpicasa process counts" )
+    parser.add_option( '-r', '--repeat', type="int", default=1,
+        help="runs per configuration; the fastest is used" )
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    threads = [int(t) for t in options.threads.split(",")]
+    procs = parse_list(options.procs, int)
+    if options.affinity == "compact":
+        configs = make_configs(threads, procs=procs)
+        for config in configs:
+            config.mask = "0-" + str(config.threads * (config.procs or 1) - 1)
+    else:
+        configs = make_configs(threads, parse_list(options.affinity), procs)
+    results = sweep(args[0], options.command, configs, options.repeat)
+    if len(results) == 0:
+        print "All configurations failed."
+        sys.exit(1)
+    tasks = scaling(results)
+    print_tables(results, tasks)
+    f = open(args[0] + ".sweep.json", "w")
+    json.dump({'configs': [config.label() for config, times in results],
+               'tasks': tasks}, f, indent=1, sort_keys=True)
+    f.close()